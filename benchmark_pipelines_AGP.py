@@ -0,0 +1,555 @@
+#!/usr/bin/env python
+
+from sys import stdout
+from os import fdopen, remove
+from os.path import join, dirname
+from itertools import izip
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp
+from timeit import default_timer
+from subprocess import Popen, PIPE
+from json import dump as dump_json, load as load_json
+from platform import python_version
+from time import strftime
+from numpy import (random, delete, median, array, empty, \
+                   __version__ as numpy_version)
+from biom.parse import table_factory
+from argparse import ArgumentParser
+
+from generate_otu_signifigance_tables_AGP import (taxa_importer,
+    calculate_tax_rank_1, calculate_tax_rank_batch, tax_rank_from_batch,
+    top_taxa_batch, convert_taxa, taxa_to_table, taxa_to_list)
+from significance_stats import summarize_population
+from make_phyla_plots_AGP import (summarize_human_taxa,
+    most_common_taxa_gg_13_5, plot_stacked_phyla)
+
+__author__ = "Justine Debelius"
+__copyright__ = "Copyright 2013, The American Gut Project"
+__credits__ = ["Justine Debelius"]
+__license__ = "BSD"
+__version__ = "unversioned"
+__maintainer__ = "Justine Debelius"
+__email__ = "j.debelius@gmail.com"
+
+# Benchmark scales as (number of samples, number of taxa)
+SCALES = {'small': (100, 100),
+          'medium': (10000, 1000),
+          'large': (100000, 5000)}
+
+# Stages which can be benchmarked
+STAGES = ('taxa_importer', 'calculate_tax_rank_1', 'calculate_tax_rank_batch',
+          'top_taxa_batch', 'taxa_to_table', 'taxa_to_list',
+          'summarize_human_taxa', 'plot_stacked_phyla')
+
+# Version of the results file format
+RESULTS_VERSION = 1
+
+def make_taxa_blocks(num_taxa, num_samples, seed = 0):
+    """Creates a seeded synthetic taxonomy table a block of samples at a time
+
+    INPUTS:
+        num_taxa -- the number of taxa (rows) in the table
+
+        num_samples -- the number of samples (columns) in the table
+
+        seed -- the seed for the random number generator
+
+    OUTPUTS:
+        taxonomy -- a numpy vector with greengenes taxonomy strings
+
+        blocks -- an iterator over the table in blocks of samples. Each
+                    block is a tuple of the first and last sample in the
+                    block and a numpy array with the relative frequencies
+                    of taxonomies (rows) for each sample (column) in the
+                    block. Each taxon is present in a random fraction of
+                    the samples. The iterator can only be used once.
+
+        sample_ids -- a numpy vector of sample ids
+    """
+    # Sets the greengenes level prefixes
+    LEVELS = ['k__', 'p__', 'c__', 'o__', 'f__', 'g__']
+    BLOCK_SIZE = 1000
+
+    generator = random.RandomState(seed)
+
+    # Taxa are named down to a random level, leaving the remaining levels
+    # empty
+    taxonomy = []
+    for idx in xrange(num_taxa):
+        depth = generator.randint(2, len(LEVELS) + 1)
+        levels = []
+        for level_idx, prefix in enumerate(LEVELS):
+            if level_idx == 0:
+                levels.append('%sBacteria' % prefix)
+            elif level_idx < depth:
+                levels.append('%sTaxon%i_%i' % (prefix, level_idx, \
+                    idx % (10*level_idx)))
+            else:
+                levels.append(prefix)
+        taxonomy.append('; '.join(levels))
+
+    prevalence = generator.uniform(0.01, 1, num_taxa)
+
+    # The random draws for the whole table are never held at once
+    def table_blocks():
+        for start in xrange(0, num_samples, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, num_samples)
+            block = generator.gamma(0.5, 1, (num_taxa, end - start))
+            block[generator.uniform(size = block.shape) > \
+                prevalence[:, None]] = 0
+            yield start, end, block / block.sum(0).clip(1e-12)
+
+    sample_ids = array(['%09i.%i' % (idx, seed) for idx in \
+        xrange(num_samples)])
+
+    return array(taxonomy), table_blocks(), sample_ids
+
+def make_taxa_table(num_taxa, num_samples, seed = 0):
+    """Creates a seeded synthetic taxonomy table
+
+    INPUTS:
+        num_taxa -- the number of taxa (rows) in the table
+
+        num_samples -- the number of samples (columns) in the table
+
+        seed -- the seed for the random number generator
+
+    OUTPUTS:
+        taxonomy -- a numpy vector with greengenes taxonomy strings
+
+        tax_table -- a numpy array with the relative frequencies of taxonomies
+                    (rows) for each sample (column), filled from the blocks
+                    made by make_taxa_blocks. The array takes 8 bytes per
+                    value.
+
+        sample_ids -- a numpy vector of sample ids
+    """
+    (taxonomy, blocks, sample_ids) = make_taxa_blocks(num_taxa, \
+        num_samples, seed)
+
+    tax_table = empty((num_taxa, num_samples))
+    for (start, end, block) in blocks:
+        tax_table[:, start:end] = block
+
+    return taxonomy, tax_table, sample_ids
+
+def write_taxa_table(taxa_table_fp, taxonomy, blocks, sample_ids):
+    """Saves a taxonomy table in the tab delimited format read by
+    taxa_importer
+
+    Each block of samples is first written to its own scratch file beside
+    the table, and the scratch files are then joined line by line, so only
+    one block is held in memory. The scratch files need about as much disk
+    space as the table, and are removed once it is written.
+
+    INPUTS:
+        taxa_table_fp -- the location where the table should be saved
+
+        taxonomy, blocks, sample_ids -- the table, as returned by
+                    make_taxa_blocks
+    """
+    block_fps = []
+    try:
+        for (start, end, block) in blocks:
+            (block_fd, block_fp) = mkstemp(dir = dirname(taxa_table_fp), \
+                prefix = '.block_')
+            block_fps.append(block_fp)
+            block_file = fdopen(block_fd, 'w')
+            for frequencies in block:
+                block_file.write('%s\n' % '\t'.join(['%.10g' % value \
+                    for value in frequencies]))
+            block_file.close()
+
+        block_files = [open(block_fp) for block_fp in block_fps]
+        taxa_file = open(taxa_table_fp, 'w')
+        taxa_file.write('#OTU ID\t%s\n' % '\t'.join(sample_ids))
+        for taxon, block_lines in izip(taxonomy, izip(*block_files)):
+            taxa_file.write('%s\t%s\n' % (taxon, \
+                '\t'.join([line.rstrip('\n') for line in block_lines])))
+        taxa_file.close()
+        for block_file in block_files:
+            block_file.close()
+    finally:
+        for block_fp in block_fps:
+            remove(block_fp)
+
+def make_otu_table(num_otus, num_samples, seed = 0):
+    """Creates a seeded synthetic biom OTU table with greengenes taxonomy
+
+    INPUTS:
+        num_otus -- the number of OTUs (observations) in the table
+
+        num_samples -- the number of samples in the table
+
+        seed -- the seed for the random number generator
+
+    OUTPUT:
+        otu_table -- a sparse biom table of counts. The OTUs are assigned
+                    to the common human phyla and a set of rarer phyla.
+    """
+    # Sets the number of rare phyla assigned in addition to the common phyla
+    NUM_RARE_PHYLA = 10
+    BLOCK_SIZE = 100
+
+    generator = random.RandomState(seed)
+
+    phyla = [taxon[1] for taxon in most_common_taxa_gg_13_5(2)[:-1]]
+    phyla.extend([' p__Rare%i' % idx for idx in xrange(NUM_RARE_PHYLA)])
+
+    observation_ids = ['%i' % idx for idx in xrange(num_otus)]
+    observation_metadata = []
+    for idx in xrange(num_otus):
+        phylum = phyla[generator.randint(len(phyla))]
+        observation_metadata.append({'taxonomy': ['k__Bacteria', phylum, \
+            ' c__', ' o__', ' f__', ' g__']})
+
+    # Draws the counts a block of OTUs at a time and keeps only the nonzero
+    # counts, so no dense table is built
+    counts = {}
+    for start in xrange(0, num_otus, BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, num_otus)
+        block = generator.poisson(2, (end - start, num_samples)) * \
+            (generator.uniform(size = (end - start, num_samples)) < 0.2)
+        if start == 0:
+            block[0] = block[0] + 1
+        (rows, cols) = block.nonzero()
+        counts.update(zip(zip(rows + start, cols), \
+            block[rows, cols].astype(float)))
+
+    sample_ids = ['%09i.%i' % (idx, seed) for idx in xrange(num_samples)]
+
+    return table_factory(counts, sample_ids, observation_ids, \
+        observation_metadata = observation_metadata)
+
+def time_calls(function, calls, repeats):
+    """Times a set of calls to a function
+
+    INPUTS:
+        function -- the function to time
+
+        calls -- a list of argument tuples, or a function returning an
+                    iterable of argument tuples. The function is called once
+                    with each tuple in each repeat. A function is called again
+                    for each repeat, so large arguments can be built one call
+                    at a time; only the time spent in the timed function is
+                    counted.
+
+        repeats -- the number of times the calls are repeated
+
+    OUTPUT:
+        times -- a list of the wall time in seconds for each repeat
+    """
+    times = []
+    for repeat in xrange(repeats):
+        if callable(calls):
+            repeat_calls = calls()
+        else:
+            repeat_calls = calls
+        repeat_time = 0.0
+        for arguments in repeat_calls:
+            start = default_timer()
+            function(*arguments)
+            repeat_time = repeat_time + default_timer() - start
+        times.append(repeat_time)
+
+    return times
+
+def benchmark_scale(scale, stages, repeats, calls_per_repeat, seed, \
+    scratch_dir):
+    """Runs the benchmarks for a single table scale
+
+    INPUTS:
+        scale -- a tuple of the number of samples and number of taxa
+
+        stages -- a list of the stages to benchmark
+
+        repeats -- the number of times each stage is timed
+
+        calls_per_repeat -- the number of samples (or figures) handled in
+                    each repeat by the per-sample stages
+
+        seed -- the seed for the random number generator
+
+        scratch_dir -- a directory for temporary files
+
+    OUTPUT:
+        results -- a list of dictionaries describing the timing of each stage
+    """
+    # Sets constants for the figure benchmarks
+    NUM_PHYLA = 9
+    NUM_BARS = 6
+    # Sets the number of taxa found by top_taxa_batch
+    NUM_TOP_TAXA = 5
+
+    (num_samples, num_taxa) = scale
+    num_calls = min(calls_per_repeat, num_samples)
+
+    timings = {}
+
+    # The table file is written without building the whole table, and is
+    # removed once it has been timed
+    if 'taxa_importer' in stages:
+        (taxonomy, blocks, sample_ids) = make_taxa_blocks(num_taxa, \
+            num_samples, seed)
+        taxa_table_fp = join(scratch_dir, 'taxa_%i_%i.txt' % scale)
+        write_taxa_table(taxa_table_fp, taxonomy, blocks, sample_ids)
+        timings['taxa_importer'] = (time_calls(taxa_importer, \
+            [(taxa_table_fp,)], repeats), 1)
+        remove(taxa_table_fp)
+
+    if [stage for stage in stages if stage != 'taxa_importer']:
+        (taxonomy, tax_table, sample_ids) = make_taxa_table(num_taxa, \
+            num_samples, seed)
+
+    if 'calculate_tax_rank_1' in stages:
+        # Each leave-one-out population is only built for its own call
+        def leave_one_out_calls():
+            for idx in xrange(num_calls):
+                yield tax_table[:, idx], delete(tax_table, idx, 1), taxonomy
+
+        timings['calculate_tax_rank_1'] = (time_calls(calculate_tax_rank_1, \
+            leave_one_out_calls, repeats), num_calls)
+
+    if 'calculate_tax_rank_batch' in stages or 'taxa_to_table' in stages \
+        or 'taxa_to_list' in stages or 'top_taxa_batch' in stages:
+        population_summary = summarize_population(tax_table)
+
+    if 'calculate_tax_rank_batch' in stages:
+        calls = [(tax_table, population_summary, range(num_calls))]
+        timings['calculate_tax_rank_batch'] = (time_calls( \
+            calculate_tax_rank_batch, calls, repeats), num_calls)
+
+    if 'top_taxa_batch' in stages:
+        # Times the batch as it is, and with the first sample left with
+        # fewer significant taxa than are found, as for a sparse sample
+        tax_rank = calculate_tax_rank_batch(tax_table, population_summary, \
+            range(num_calls))
+        sparse_rank = dict(tax_rank)
+        sparse_rank['HIGH'] = tax_rank['HIGH'].copy()
+        sparse_rank['HIGH'][NUM_TOP_TAXA - 1:, 0] = False
+        timings['top_taxa_batch'] = (time_calls(top_taxa_batch, \
+            [(tax_rank, NUM_TOP_TAXA), (sparse_rank, NUM_TOP_TAXA)], \
+            repeats), 2*num_calls)
+        del tax_rank, sparse_rank
+
+    if 'taxa_to_table' in stages or 'taxa_to_list' in stages:
+        # Uses the enriched and rare taxa of real comparisons as the rows.
+        # The comparisons are batched so the table is not copied per sample.
+        tax_rank = calculate_tax_rank_batch(tax_table, population_summary, \
+            range(num_calls))
+        table_calls = []
+        list_calls = []
+        for idx in xrange(num_calls):
+            (unique, rare, low, high) = tax_rank_from_batch(tax_rank, idx, \
+                taxonomy)
+            table_calls.append((high[:4],))
+            rare_combined = list(unique) + list(rare)
+            rare_format = ['BOLD']*len(unique) + ['REG']*len(rare)
+            list_calls.append((rare_combined[:4], rare_format, 'LATEX'))
+        del tax_rank
+
+        def render_table(high):
+            formatted = convert_taxa(high, 'LATEX', \
+                ["100_PER", "100_PER", "VAL_INT", "SKIP"])
+            return taxa_to_table(formatted, ['Taxonomy', 'Sample', \
+                'Population', 'Fold Difference'], 'LATEX')
+
+        if 'taxa_to_table' in stages:
+            timings['taxa_to_table'] = (time_calls(render_table, \
+                table_calls, repeats), num_calls)
+        if 'taxa_to_list' in stages:
+            timings['taxa_to_list'] = (time_calls(taxa_to_list, list_calls, \
+                repeats), num_calls)
+
+    if 'summarize_human_taxa' in stages:
+        otu_table = make_otu_table(num_taxa, num_samples, seed)
+        timings['summarize_human_taxa'] = (time_calls(summarize_human_taxa, \
+            [(otu_table, 2)], repeats), 1)
+        del otu_table
+
+    if 'plot_stacked_phyla' in stages:
+        generator = random.RandomState(seed)
+        headers = [taxon[1].strip(' p__') for taxon in \
+            most_common_taxa_gg_13_5(2)]
+        labels = ['Sample %i' % idx for idx in xrange(NUM_BARS)]
+        calls = []
+        for idx in xrange(num_calls):
+            tax_array = generator.uniform(size = (NUM_PHYLA, NUM_BARS))
+            tax_array = tax_array / tax_array.sum(0)
+            calls.append((tax_array, headers, labels, \
+                join(scratch_dir, 'Figure_%i.pdf' % idx)))
+        timings['plot_stacked_phyla'] = (time_calls(plot_stacked_phyla, \
+            calls, repeats), num_calls)
+
+    results = []
+    for stage in stages:
+        (times, calls) = timings[stage]
+        results.append({'stage': stage,
+                        'num_samples': num_samples,
+                        'num_taxa': num_taxa,
+                        'repeats': repeats,
+                        'calls': calls,
+                        'times': times,
+                        'min': min(times),
+                        'median': float(median(times)),
+                        'per_call': min(times) / calls})
+
+    return results
+
+def current_commit():
+    """Finds the git commit of the working copy, if there is one
+
+    OUTPUT:
+        commit -- the commit hash as a string, or None
+    """
+    try:
+        git = Popen(['git', 'rev-parse', 'HEAD'], stdout = PIPE, \
+            stderr = PIPE)
+        (commit, error) = git.communicate()
+    except OSError:
+        return None
+
+    if git.returncode != 0:
+        return None
+    return commit.strip()
+
+def run_benchmarks(scales, stages = STAGES, repeats = 3, \
+    calls_per_repeat = 10, seed = 0):
+    """Benchmarks the significance and plotting pipelines
+
+    INPUTS:
+        scales -- a list of scale names (keys of SCALES) or tuples of the
+                    number of samples and number of taxa
+
+        stages -- a list of the stages to benchmark
+
+        repeats -- the number of times each stage is timed
+
+        calls_per_repeat -- the number of samples (or figures) handled in
+                    each repeat by the per-sample stages
+
+        seed -- the seed for the random number generator
+
+    OUTPUT:
+        benchmark -- a dictionary describing the environment and holding a
+                    list of results, one for each stage and scale
+    """
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError, "%s is not a known stage." % stage
+
+    scratch_dir = mkdtemp()
+    results = []
+    try:
+        for scale in scales:
+            if scale in SCALES:
+                scale = SCALES[scale]
+            results.extend(benchmark_scale(tuple(scale), stages, repeats, \
+                calls_per_repeat, seed, scratch_dir))
+    finally:
+        rmtree(scratch_dir)
+
+    return {'version': RESULTS_VERSION,
+            'commit': current_commit(),
+            'date': strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': python_version(),
+            'numpy': numpy_version,
+            'seed': seed,
+            'results': results}
+
+def compare_benchmarks(baseline, current):
+    """Compares two sets of benchmark results
+
+    INPUTS:
+        baseline -- a dictionary of benchmark results, as returned by
+                    run_benchmarks
+
+        current -- a dictionary of benchmark results to compare against the
+                    baseline
+
+    OUTPUT:
+        comparison -- a raw text table giving the per call time for each
+                    stage and scale in both runs, and the speed up.
+    """
+    def result_key(result):
+        return (result['stage'], result['num_samples'], result['num_taxa'])
+
+    baseline_results = dict([(result_key(result), result) for result in \
+        baseline['results']])
+
+    comparison = ['%-26s %9s %6s %12s %12s %8s' % ('Stage', 'Samples', \
+        'Taxa', 'Baseline (s)', 'Current (s)', 'Speed up')]
+    for result in current['results']:
+        key = result_key(result)
+        if key not in baseline_results:
+            continue
+        old_time = baseline_results[key]['per_call']
+        new_time = result['per_call']
+        comparison.append('%-26s %9i %6i %12.6f %12.6f %7.2fx' % (key[0], \
+            key[1], key[2], old_time, new_time, old_time / new_time))
+
+    return '\n'.join(comparison)
+
+# Sets up command line parsing
+parser = ArgumentParser(description = 'Benchmarks the significance table and'\
+                        ' phyla plot pipelines on synthetic data.')
+parser.add_argument('-o', '--output', default = None, \
+                    help = 'Path to save the JSON results. If no value is '\
+                    'specified, the results are printed.')
+parser.add_argument('-s', '--scales', default = 'small', \
+                    help = 'Comma separated scales to run. Each scale is '\
+                    'small (100x100), medium (10000x1000), large '\
+                    '(100000x5000) or SAMPLESxTAXA, for example '\
+                    '"small,2000x500". The table is held in memory at 8 '\
+                    'bytes per value, and some stages hold two copies. The '\
+                    'taxa_importer stage writes the table as text at about '\
+                    '9 bytes per value, and needs as much again in scratch '\
+                    'space while the file is written. The large scale '\
+                    'needs about 8 GB of memory and 9 GB of '\
+                    'temporary disk space. [default: %(default)s]')
+parser.add_argument('--stages', default = ','.join(STAGES), \
+                    help = 'Comma separated stages to benchmark. '\
+                    '[default: all stages]')
+parser.add_argument('-r', '--repeats', type = int, default = 3, \
+                    help = 'Number of times each stage is timed. '\
+                    '[default: %(default)s]')
+parser.add_argument('-n', '--calls', type = int, default = 10, \
+                    help = 'Number of samples or figures handled in each '\
+                    'repeat of the per-sample stages. [default: %(default)s]')
+parser.add_argument('--seed', type = int, default = 0, \
+                    help = 'Seed for the synthetic tables. '\
+                    '[default: %(default)s]')
+parser.add_argument('-c', '--compare', default = None, \
+                    help = 'Path to earlier JSON results to compare against.')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    scales = []
+    for scale in args.scales.split(','):
+        if scale in SCALES:
+            scales.append(scale)
+        else:
+            try:
+                (num_samples, num_taxa) = [int(value) for value in \
+                    scale.lower().split('x')]
+            except ValueError:
+                parser.error('%s is not a valid scale.' % scale)
+            scales.append((num_samples, num_taxa))
+
+    benchmark = run_benchmarks(scales, args.stages.split(','), \
+        args.repeats, args.calls, args.seed)
+
+    if args.output:
+        results_file = open(args.output, 'w')
+        dump_json(benchmark, results_file, indent = 2)
+        results_file.close()
+    else:
+        dump_json(benchmark, stdout, indent = 2)
+        print
+
+    if args.compare:
+        baseline_file = open(args.compare)
+        baseline = load_json(baseline_file)
+        baseline_file.close()
+        print compare_benchmarks(baseline, benchmark)
@@ -1,10 +1,31 @@
 #!/usr/bin/env python
 
-from os import mkdir
-from os.path import isfile, exists
-from numpy import (loadtxt, array, delete, mean, shape, argsort, sort)
-from scipy.stats import ttest_1samp
+from os import mkdir, remove, rename, stat, close
+from os.path import isfile, exists, join
+from gzip import open as gzip_open
+from hashlib import sha1
+from json import dump as dump_json, load as load_json
+from multiprocessing import Pool
+from tempfile import mkstemp
+from zipfile import ZipFile, ZIP_DEFLATED
+from threading import Thread
+from Queue import Queue
+from sys import exc_info
+from timeit import default_timer
+from numpy import (array, empty, load, save, delete, mean, var, shape,
+                   argsort, partition, lexsort, arange, where, isinf, inf,
+                   newaxis, errstate, nan, memmap, isfinite, char, column_stack,
+                   concatenate, ones, asarray, savez, zeros, bincount, \
+                   cumsum)
+from numpy.lib.format import open_memmap
+from scipy.sparse import issparse, csr_matrix, csc_matrix
 from argparse import ArgumentParser
+from significance_stats import (CORRECTION_METHODS, summarize_population,
+                                reference_stats, ttest_1samp_stats,
+                                correct_pvalues, dense_columns,
+                                population_stats)
+from pipeline_profile import (start_profile, profile_stage, record_sample_time,
+                              take_profile, merge_profile)
 
 __author__ = "Justine Debelius"
 __copyright__ = "Copyright 2013, The American Gut Project"
@@ -14,36 +35,718 @@ __version__ = "unversioned"
 __maintainer__ = "Justine Debelius"
 __email__ = "j.debelius@gmail.com"
 
-def taxa_importer(taxa_table_fp):
-    """Loads text taxonomy files as numpy arrays.
+# Number of taxa shown is an indexing value, it is one less than what is 
+# actually shown.
+NUMBER_OF_TAXA_SHOWN = 4
+
+# Sets up the constant string designations, describing the phylogentic levels
+TAX_DES = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+
+# Holds the parsed form and rendered text of each distinct greengenes
+# taxonomy string. The records are dropped once the limit is reached.
+TAXONOMY_RECORDS = {}
+TAXONOMY_RECORDS_LIMIT = 100000
+
+# Sets up the padding used in raw text tables
+RAW_HEADER_BAR = "--------------------------------------------------------"\
+                 "-------------------"
+RAW_SPACER = '                                    '
+RAW_TAX_SPACE = 27
+
+# Sets up the layout of the sample reports
+REPORT_RENDERING = "LATEX"
+REPORT_FORMAT_KEYS = ["100_PER", "100_PER", "VAL_INT", "SKIP"]
+REPORT_TABLE_HEADER = ['Taxonomy', 'Sample', 'Population', 'Fold Difference']
+
+# Holds the compiled report templates for each report layout
+REPORT_TEMPLATES = {}
+
+# Sets up the ways reports can be stored. "files" saves a table and list file
+# for each sample; "zip" bundles them into a single archive.
+REPORT_STORE_FORMATS = ('files', 'zip')
+REPORT_ARCHIVE = 'reports.zip'
+
+# Records the samples reported by previous runs, for incremental runs
+REPORT_MANIFEST = 'report_manifest.json'
+
+# Sets the version of the report calculations recorded in the manifest.
+# Reports recorded under another version are regenerated. Version 2 scales
+# the bonferroni correction by the number of tested taxa rather than the
+# number of population samples.
+REPORT_VERSION = 2
+
+def open_taxa_file(taxa_table_fp):
+    """Opens a taxonomy file for reading, decompressing it if it is gzipped
 
     INPUT:
         taxa_table_fp -- a string describing the location of the taxonomy file
 
+    OUTPUT:
+        taxa_file -- an open file object which returns the lines of the file
+    """
+    # Gzipped files are identified by their magic number rather than the file
+    # extension
+    GZIP_MAGIC = '\x1f\x8b'
+
+    check_file = open(taxa_table_fp, 'rb')
+    magic = check_file.read(2)
+    check_file.close()
+
+    if magic == GZIP_MAGIC:
+        return gzip_open(taxa_table_fp, 'rb')
+    else:
+        return open(taxa_table_fp, 'U')
+
+def taxa_importer(taxa_table_fp, dtype = 'float64', table_fp = None, \
+    sparse = False):
+    """Loads text taxonomy files as numpy arrays.
+
+    The file is read one line at a time, and the frequencies are written
+    directly into a numeric array, so the table is never held as strings.
+    Dense tables are read twice: once to count the rows, and once to fill
+    the table.
+
+    INPUT:
+        taxa_table_fp -- a string describing the location of the taxonomy file.
+                    The file may be gzip compressed.
+
+        dtype -- the numpy data type used for the frequency table. Use
+                    "float32" to halve the memory used by large tables.
+
+        table_fp -- a string describing the location of a .npy file. If this
+                    is passed, the table is written straight to a memory map
+                    at this location instead of being held in memory.
+
+        sparse -- loads the table as a scipy sparse (CSR) matrix, keeping
+                    only the nonzero frequencies. This cannot be combined
+                    with table_fp.
+
     OUTPUTS:
         taxonomy -- a numpy vector with greengenes taxonomy strings
 
         tax_table -- a numpy array with the relative frequencies of taxonomies
-            (rows) for each give sample (column)
+            (rows) for each give sample (column), or a sparse matrix
 
         sample_ids -- a numpy vector of sample ids associated with the 
             tax_table values
     """
-    # Loads the file as strings to determine the shape, then pulls of 
-    # taxonomic designations and Sample IDs.
-    tax_table = loadtxt(taxa_table_fp, dtype = "string", \
-        comments = "'", delimiter = "\t")
-    (num_rows, num_cols) = tax_table.shape
-
-    # The sample Ids are taken as the first row
-    sample_ids = tax_table[0,1:]    
-    taxonomy = tax_table[1:,0]        
-    tax_table = delete(tax_table, 0, 0)
-    tax_table = delete(tax_table, 0, 1)
-    tax_table = tax_table.astype('float')
+    if sparse and table_fp is not None:
+        raise ValueError, "A sparse table cannot be written to a memory map."
+
+    # Counts the rows first, so the dense table is allocated once at its
+    # final size rather than grown (and copied) as rows are read
+    if not sparse:
+        num_taxa = -1
+        taxa_file = open_taxa_file(taxa_table_fp)
+        for line in taxa_file:
+            if line.split("'", 1)[0].strip('\r\n'):
+                num_taxa = num_taxa + 1
+        taxa_file.close()
+
+    taxa_file = open_taxa_file(taxa_table_fp)
+
+    taxonomy = []
+    sample_ids = None
+    tax_table = None
+    num_rows = 0
+
+    for line_number, line in enumerate(taxa_file):
+        # Text following a single quote is treated as a comment
+        line = line.split("'", 1)[0].strip('\r\n')
+        if not line:
+            continue
+        fields = line.split('\t')
+
+        # The sample Ids are taken as the first row
+        if sample_ids is None:
+            sample_ids = fields[1:]
+            num_cols = len(sample_ids)
+            if sparse:
+                # Each row is parsed into a buffer and only the nonzero
+                # values are kept
+                tax_table = empty((1, num_cols), dtype = dtype)
+                sparse_data = []
+                sparse_indices = []
+                sparse_indptr = [0]
+            elif table_fp is None:
+                tax_table = empty((num_taxa, num_cols), dtype = dtype)
+            else:
+                tax_table = open_memmap(table_fp, mode = 'w+', dtype = dtype, \
+                    shape = (num_taxa, num_cols))
+            continue
+
+        if len(fields) != num_cols + 1:
+            taxa_file.close()
+            raise ValueError, "Line %i of the taxonomy file has %i columns; "\
+                "%i were expected." \
+                % (line_number + 1, len(fields), num_cols + 1)
+
+        taxonomy.append(fields[0])
+
+        if sparse:
+            tax_table[0] = fields[1:]
+            nonzero = tax_table[0].nonzero()[0]
+            sparse_data.append(tax_table[0, nonzero])
+            sparse_indices.append(nonzero)
+            sparse_indptr.append(sparse_indptr[-1] + len(nonzero))
+            num_rows = num_rows + 1
+            continue
+
+        tax_table[num_rows] = fields[1:]
+        num_rows = num_rows + 1
+
+    taxa_file.close()
+
+    if sample_ids is None:
+        raise ValueError, "The taxonomy file is empty."
+
+    # Parses the taxonomy strings once for the renderers
+    intern_taxonomy(taxonomy)
+
+    # Builds the sparse matrix from the nonzero values
+    if sparse:
+        tax_table = csr_matrix((concatenate([empty(0, dtype)] + sparse_data), \
+            concatenate([empty(0, int)] + sparse_indices), sparse_indptr), \
+            shape = (num_rows, num_cols))
+    elif table_fp is not None:
+        tax_table.flush()
+
     # Returns the result
+    return array(taxonomy), tax_table, array(sample_ids)
+
+def taxa_cache_key(taxa_table_fp, dtype = 'float64'):
+    """Describes the taxonomy file a cache was built from
+
+    INPUTS:
+        taxa_table_fp -- a string describing the location of the taxonomy file
+
+        dtype -- the numpy data type used for the frequency table
+
+    OUTPUT:
+        cache_key -- a dictionary keyed to the file size ("SIZE"),
+                    modification time ("MTIME") and the table data type
+                    ("DTYPE"). The contents are not read; see
+                    taxa_file_hash.
+    """
+    file_stat = stat(taxa_table_fp)
+
+    return {'SIZE': file_stat.st_size, 'MTIME': file_stat.st_mtime,
+            'DTYPE': dtype}
+
+def taxa_file_hash(taxa_table_fp):
+    """Hashes the contents of a taxonomy file
+
+    INPUT:
+        taxa_table_fp -- a string describing the location of the taxonomy file
+
+    OUTPUT:
+        file_hash -- the sha1 hash of the file, as a hex string
+    """
+    # Sets the number of bytes hashed at a time
+    HASH_BLOCK = 1048576
+
+    file_hash = sha1()
+    taxa_file = open(taxa_table_fp, 'rb')
+    block = taxa_file.read(HASH_BLOCK)
+    while block:
+        file_hash.update(block)
+        block = taxa_file.read(HASH_BLOCK)
+    taxa_file.close()
+
+    return file_hash.hexdigest()
+
+def cache_scratch_fp(cache_dir, name):
+    """Creates a scratch file for writing a cache file before it is moved
+    into place
+
+    Cache files are written under a scratch name and renamed over the old
+    file, so a process already reading the cache keeps the old contents.
+
+    INPUTS:
+        cache_dir -- a string describing the location of the cache directory
+
+        name -- the name of the cache file
+
+    OUTPUT:
+        scratch_fp -- the location of the empty scratch file, which has the
+                    same extension as the cache file
+    """
+    (base, dot, extension) = name.rpartition('.')
+    (scratch_handle, scratch_fp) = mkstemp(prefix = '.%s.' % base, \
+        suffix = '.%s' % extension, dir = cache_dir)
+    close(scratch_handle)
+
+    return scratch_fp
+
+def save_taxa_cache_key(cache_dir, cache_key):
+    """Saves the key of a taxonomy cache, marking the cache as complete
+
+    INPUTS:
+        cache_dir -- a string describing the location of the cache directory
+
+        cache_key -- a dictionary describing the source taxonomy file, as
+                    returned by taxa_cache_key, with the sha1 hash of the
+                    file ("SHA1")
+    """
+    scratch_fp = cache_scratch_fp(cache_dir, 'key.json')
+    key_file = open(scratch_fp, 'w')
+    dump_json(cache_key, key_file)
+    key_file.close()
+    rename(scratch_fp, join(cache_dir, 'key.json'))
+
+def load_taxa_cache(cache_dir, cache_key, taxa_table_fp = None):
+    """Memory maps a cached taxonomy table
+
+    The file contents are only hashed when the size and data type match the
+    cache but the modification time does not, for example after the file is
+    copied. If the contents match, the cache is kept and its modification
+    time updated.
+
+    INPUTS:
+        cache_dir -- a string describing the location of the cache directory
+
+        cache_key -- a dictionary describing the source taxonomy file, as
+                    returned by taxa_cache_key
+
+        taxa_table_fp -- the location of the taxonomy file, which is hashed
+                    if its modification time has changed. If no value is
+                    passed, a changed modification time does not match.
+
+    OUTPUTS:
+        The taxonomy, tax_table and sample_ids, as described for
+        taxa_importer, or None if there is no cache matching the key. The
+        tax_table is a read-only memory map.
+    """
+    key_fp = join(cache_dir, 'key.json')
+    if not isfile(key_fp):
+        return None
+
+    key_file = open(key_fp)
+    saved_key = load_json(key_file)
+    key_file.close()
+
+    if saved_key['SIZE'] != cache_key['SIZE'] or \
+        saved_key['DTYPE'] != cache_key['DTYPE']:
+        return None
+    elif saved_key['MTIME'] != cache_key['MTIME']:
+        if taxa_table_fp is None or \
+            saved_key.get('SHA1') != taxa_file_hash(taxa_table_fp):
+            return None
+        saved_key['MTIME'] = cache_key['MTIME']
+        save_taxa_cache_key(cache_dir, saved_key)
+
+    taxonomy = load(join(cache_dir, 'taxonomy.npy'))
+    tax_table = load(join(cache_dir, 'tax_table.npy'), mmap_mode = 'r')
+    sample_ids = load(join(cache_dir, 'sample_ids.npy'))
+
+    intern_taxonomy(taxonomy)
+
     return taxonomy, tax_table, sample_ids
 
+def clear_taxa_cache(cache_dir):
+    """Marks a taxonomy cache as invalid before it is rewritten
+
+    INPUT:
+        cache_dir -- a string describing the location of the cache directory.
+                    The directory is created if it does not exist.
+    """
+    key_fp = join(cache_dir, 'key.json')
+
+    if not exists(cache_dir):
+        mkdir(cache_dir)
+    elif isfile(key_fp):
+        remove(key_fp)
+
+def save_taxa_cache(cache_dir, cache_key, taxonomy, tax_table, sample_ids, \
+    table_fp = None):
+    """Saves a parsed taxonomy table as numpy binary files
+
+    Each file is written under a scratch name and renamed into place, so a
+    process reading the old cache is not disturbed.
+
+    INPUTS:
+        cache_dir -- a string describing the location of the cache directory.
+                    The directory is created if it does not exist.
+
+        cache_key -- a dictionary describing the source taxonomy file, as
+                    returned by taxa_cache_key, with the sha1 hash of the
+                    file ("SHA1")
+
+        taxonomy, tax_table, sample_ids -- the parsed table, as returned by
+                    taxa_importer. If tax_table is None, the table must
+                    already have been written to a .npy file in the cache
+                    directory at table_fp, which is moved into place.
+
+        table_fp -- the location of the table written by taxa_importer
+
+    OUTPUT:
+        The table, taxonomy and sample ids are saved as .npy files in the
+        cache directory, along with the key in key.json.
+    """
+    # The key is written last, so a partially written cache is never loaded
+    clear_taxa_cache(cache_dir)
+
+    if tax_table is not None:
+        table_fp = cache_scratch_fp(cache_dir, 'tax_table.npy')
+        save(table_fp, tax_table)
+    rename(table_fp, join(cache_dir, 'tax_table.npy'))
+
+    for (name, values) in (('taxonomy.npy', taxonomy), \
+        ('sample_ids.npy', sample_ids)):
+        scratch_fp = cache_scratch_fp(cache_dir, name)
+        save(scratch_fp, values)
+        rename(scratch_fp, join(cache_dir, name))
+
+    save_taxa_cache_key(cache_dir, cache_key)
+
+def cached_taxa_importer(taxa_table_fp, dtype = 'float64', cache_dir = None):
+    """Loads a taxonomy file through a binary cache
+
+    The first time a file is loaded, it is parsed with taxa_importer and saved
+    to the cache. Later loads memory map the cache, as long as the file size
+    and modification time are unchanged. A file with a new modification time
+    is hashed, and the cache is kept if the contents are unchanged.
+
+    INPUTS:
+        taxa_table_fp -- a string describing the location of the taxonomy file
+
+        dtype -- the numpy data type used for the frequency table
+
+        cache_dir -- a string describing the location of the cache directory.
+                    If no value is passed, the cache is kept next to the
+                    taxonomy file in <taxa_table_fp>.cache
+
+    OUTPUTS:
+        The taxonomy, tax_table and sample_ids, as described for
+        taxa_importer.
+    """
+    if cache_dir is None:
+        cache_dir = '%s.cache' % taxa_table_fp
+
+    cache_key = taxa_cache_key(taxa_table_fp, dtype)
+    cached = load_taxa_cache(cache_dir, cache_key, taxa_table_fp)
+    if cached is not None:
+        return cached
+
+    # Parses the table straight into a scratch file in the cache, so the
+    # full table is never held in memory
+    clear_taxa_cache(cache_dir)
+    cache_key['SHA1'] = taxa_file_hash(taxa_table_fp)
+    table_fp = cache_scratch_fp(cache_dir, 'tax_table.npy')
+    try:
+        (taxonomy, tax_table, sample_ids) = taxa_importer(taxa_table_fp, \
+            dtype, table_fp)
+        del tax_table
+        save_taxa_cache(cache_dir, cache_key, taxonomy, None, sample_ids, \
+            table_fp)
+    finally:
+        if isfile(table_fp):
+            remove(table_fp)
+
+    return load_taxa_cache(cache_dir, cache_key)
+
+def is_biom_file(table_fp):
+    """Checks whether a file is a BIOM table
+
+    INPUT:
+        table_fp -- a string describing the location of the file
+
+    OUTPUT:
+        True if the file is a JSON or HDF5 BIOM table.
+    """
+    # HDF5 files are identified by their signature; JSON tables start with
+    # an object
+    HDF5_MAGIC = '\x89HDF\r\n\x1a\n'
+
+    check_file = open(table_fp, 'rb')
+    start = check_file.read(len(HDF5_MAGIC))
+    check_file.close()
+
+    return start == HDF5_MAGIC or start.lstrip().startswith('{')
+
+def read_biom_table(biom_fp):
+    """Reads the OTU counts and taxonomy from a BIOM table
+
+    Tables are read with load_table from biom-format 2.0 or later, which
+    handles both the JSON and HDF5 formats. Older versions of biom-format
+    can only read JSON tables.
+
+    INPUT:
+        biom_fp -- a string describing the location of the BIOM table
+
+    OUTPUTS:
+        otu_matrix -- a scipy sparse (CSR) matrix of the counts of each OTU
+                    (rows) in each sample (column)
+
+        otu_taxonomy -- a list of the taxonomy of each OTU, as a list of
+                    levels
+
+        sample_ids -- a list of sample ids for the matrix columns
+    """
+    try:
+        from biom import load_table
+    except ImportError:
+        load_table = None
+
+    if load_table is not None:
+        otu_table = load_table(biom_fp)
+        otu_matrix = otu_table.matrix_data.tocsr()
+        sample_ids = list(otu_table.ids(axis = 'sample'))
+        otu_metadata = otu_table.metadata(axis = 'observation')
+        if otu_metadata is None:
+            otu_metadata = [None]*otu_matrix.shape[0]
+
+    else:
+        from biom.parse import parse_biom_table
+        biom_file = open(biom_fp, 'U')
+        otu_table = parse_biom_table(biom_file)
+        biom_file.close()
+
+        # Keeps only the nonzero counts of each OTU
+        otu_data = []
+        otu_indices = []
+        otu_indptr = [0]
+        otu_metadata = []
+        for (values, otu_id, metadata) in otu_table.iterObservations():
+            nonzero = values.nonzero()[0]
+            otu_data.append(values[nonzero])
+            otu_indices.append(nonzero)
+            otu_indptr.append(otu_indptr[-1] + len(nonzero))
+            otu_metadata.append(metadata)
+
+        sample_ids = list(otu_table.SampleIds)
+        otu_matrix = csr_matrix((concatenate([empty(0)] + otu_data), \
+            concatenate([empty(0, int)] + otu_indices), otu_indptr), \
+            shape = (len(otu_metadata), len(sample_ids)))
+
+    otu_taxonomy = []
+    for metadata in otu_metadata:
+        if metadata is None or 'taxonomy' not in metadata:
+            raise ValueError, "The BIOM table does not have taxonomy for "\
+                "every OTU."
+        levels = metadata['taxonomy']
+        if isinstance(levels, basestring):
+            levels = levels.split(';')
+        otu_taxonomy.append([level.strip() for level in levels])
+
+    return otu_matrix, otu_taxonomy, sample_ids
+
+def biom_importer(biom_fp, level = 6, dtype = 'float64', sparse = True):
+    """Loads a BIOM table as relative frequencies at a taxonomic level
+
+    The OTUs are summed into the taxa at the level and each sample is
+    divided by its total, giving the same table as a summarized taxonomy
+    text file, without the counts ever being made dense.
+
+    INPUTS:
+        biom_fp -- a string describing the location of the BIOM table. JSON
+                    and HDF5 tables can be read, as described for
+                    read_biom_table.
+
+        level -- the taxonomic level to collapse to, with 1 for kingdom and
+                    7 for species. OTUs with a shorter taxonomy are kept at
+                    their deepest level.
+
+        dtype -- the numpy data type used for the frequency table
+
+        sparse -- keeps the table as a scipy sparse (CSR) matrix. If this is
+                    false, a dense numpy array is returned.
+
+    OUTPUTS:
+        taxonomy, tax_table, sample_ids -- as described for taxa_importer
+    """
+    if level < 1 or level > len(TAX_DES):
+        raise ValueError, "The taxonomic level must be between 1 and %i." \
+            % len(TAX_DES)
+
+    (otu_matrix, otu_taxonomy, sample_ids) = read_biom_table(biom_fp)
+
+    # Finds the taxon at the level for each OTU
+    otu_taxa = ['; '.join(levels[:level]) for levels in otu_taxonomy]
+    taxonomy = sorted(set(otu_taxa))
+    taxon_index = dict([(taxon, idx) for idx, taxon in enumerate(taxonomy)])
+    otu_rows = array([taxon_index[taxon] for taxon in otu_taxa], dtype = int)
+
+    # Sums the OTUs into their taxa with a sparse indicator matrix
+    num_otus = len(otu_taxa)
+    collapse = csr_matrix((ones(num_otus), (otu_rows, arange(num_otus))), \
+        shape = (len(taxonomy), num_otus))
+    tax_table = collapse.dot(otu_matrix).tocsr().astype(dtype)
+
+    # Converts the counts to relative frequencies
+    sample_totals = asarray(tax_table.sum(0), dtype = 'float64').ravel()
+    with errstate(divide = 'ignore'):
+        scale = where(sample_totals > 0, 1.0 / sample_totals, 0)
+    tax_table.data *= scale[tax_table.indices]
+    tax_table.eliminate_zeros()
+
+    # Parses the taxonomy strings once for the renderers
+    intern_taxonomy(taxonomy)
+
+    if not sparse:
+        tax_table = tax_table.toarray()
+
+    return array(taxonomy), tax_table, array(sample_ids)
+
+def save_reference_profile(profile_fp, taxa, population_summary):
+    """Saves the statistics of a population so samples can be compared to it
+    without loading the population table
+
+    INPUTS:
+        profile_fp -- the location of the profile, saved as a numpy .npz file
+
+        taxa -- a numpy vector with greengenes taxonomy strings for the
+                    summary rows
+
+        population_summary -- a dictionary of table-wide statistics, as
+                    returned by summarize_population
+    """
+    profile_file = open(profile_fp, 'wb')
+    savez(profile_file, TAXA = array(taxa), \
+        NUM_SAMPLES = population_summary['NUM_SAMPLES'], \
+        CENTER = population_summary['CENTER'], \
+        SUM = population_summary['SUM'], \
+        SUM_SQ = population_summary['SUM_SQ'], \
+        COUNT = population_summary['COUNT'])
+    profile_file.close()
+
+def load_reference_profile(profile_fp):
+    """Loads a population profile saved by save_reference_profile
+
+    INPUT:
+        profile_fp -- the location of the profile
+
+    OUTPUTS:
+        taxa -- a numpy vector with greengenes taxonomy strings for the
+                    profile rows
+
+        population_summary -- a dictionary of population statistics, as
+                    described for summarize_population, marked as a
+                    reference ("REFERENCE") so samples are compared to the
+                    whole population.
+    """
+    profile = load(profile_fp)
+    taxa = profile['TAXA']
+    population_summary = {'NUM_SAMPLES': int(profile['NUM_SAMPLES']),
+                          'CENTER': profile['CENTER'],
+                          'SUM': profile['SUM'],
+                          'SUM_SQ': profile['SUM_SQ'],
+                          'COUNT': profile['COUNT'],
+                          'REFERENCE': True}
+    profile.close()
+
+    # Parses the taxonomy strings once for the renderers
+    intern_taxonomy(taxa)
+
+    return taxa, population_summary
+
+def align_to_reference(taxa, table, reference_taxa, population_summary):
+    """Lines the rows of a table up with the rows of a reference profile
+
+    Taxa which are not in the reference are added after the reference taxa,
+    with no population samples. Reference taxa which are not in the table
+    have a frequency of zero.
+
+    INPUTS:
+        taxa -- a numpy vector with greengenes taxonomy strings for the
+                    table rows
+
+        table -- a numpy array or scipy sparse matrix with the relative
+                    frequencies of taxonomies (rows) for each sample (column)
+
+        reference_taxa, population_summary -- the reference profile, as
+                    returned by load_reference_profile
+
+    OUTPUTS:
+        taxa, table, population_summary -- the taxa, table and profile with
+                    matching rows
+    """
+    if list(taxa) == list(reference_taxa):
+        return taxa, table, population_summary
+
+    if len(set(taxa)) < len(taxa) or \
+        len(set(reference_taxa)) < len(reference_taxa):
+        raise ValueError, "The taxonomy strings must be unique to line the "\
+            "table up with the reference profile."
+
+    # Finds the reference row for each taxon in the table
+    reference_index = dict([(taxon, idx) for idx, taxon in \
+        enumerate(reference_taxa)])
+    new_taxa = []
+    rows = []
+    for taxon in taxa:
+        row = reference_index.get(taxon)
+        if row is None:
+            row = len(reference_taxa) + len(new_taxa)
+            new_taxa.append(taxon)
+        rows.append(row)
+    num_rows = len(reference_taxa) + len(new_taxa)
+
+    if issparse(table):
+        move_rows = csr_matrix((ones(len(rows)), (rows, arange(len(rows)))), \
+            shape = (num_rows, len(rows)))
+        aligned_table = move_rows.dot(table)
+    else:
+        aligned_table = zeros((num_rows, table.shape[1]), dtype = table.dtype)
+        aligned_table[rows] = table
+
+    # The new taxa were not seen in the population
+    aligned_summary = dict(population_summary)
+    for key in ('CENTER', 'SUM', 'SUM_SQ', 'COUNT'):
+        aligned_summary[key] = concatenate([population_summary[key], \
+            zeros(len(new_taxa), dtype = population_summary[key].dtype)])
+
+    intern_taxonomy(new_taxa)
+
+    return array(list(reference_taxa) + new_taxa), aligned_table, \
+        aligned_summary
+
+def build_sample_index(sample_ids):
+    """Maps each sample id to its column in the taxonomy table
+
+    INPUT:
+        sample_ids -- a numpy vector of sample ids associated with the
+                    table columns
+
+    OUTPUT:
+        sample_index -- a dictionary keying each sample id to its column. If
+                    a sample id is repeated, the first column is used.
+    """
+    sample_index = {}
+    for column, sample_id in enumerate(sample_ids):
+        if sample_id not in sample_index:
+            sample_index[sample_id] = column
+
+    return sample_index
+
+def find_sample_columns(sample_ids, sample_index):
+    """Looks up the table columns for a list of sample ids
+
+    INPUTS:
+        sample_ids -- a list of the sample ids to look up
+
+        sample_index -- a dictionary keying sample ids to table columns, as
+                    returned by build_sample_index
+
+    OUTPUT:
+        columns -- a list of the table columns for the sample ids
+
+    Raises a ValueError listing every sample id which is not in the table.
+    """
+    columns = []
+    missing = []
+    for sample_id in sample_ids:
+        if sample_id in sample_index:
+            columns.append(sample_index[sample_id])
+        else:
+            missing.append(sample_id)
+
+    if missing:
+        raise ValueError, "%i sample ids are not in the taxonomy table: %s" \
+            % (len(missing), ', '.join(missing))
+
+    return columns
+
 def calculate_tax_rank_1(sample, population, taxa):
     """Identifies unique and rare samples in the population and preforms a 
     case 1 t-test on common samples.
@@ -53,7 +756,8 @@ def calculate_tax_rank_1(sample, population, taxa):
                     frequency values for a single sample
 
         population -- a numpy array containing containing taxonomic frequency
-                    values. Samples are columns, taxa are rows.
+                    values. Samples are columns, taxa are rows. This may be a
+                    scipy sparse matrix.
 
         taxa -- an array of greengenes ids associated the sample and 
                     population frequencies
@@ -73,21 +777,94 @@ def calculate_tax_rank_1(sample, population, taxa):
                     frequency, average population frequency, the ratio of 
                     values, and the p-value
     """
+    (num_taxa, num_samples) = shape(population)
+
+    # Summarizes the population
+    if issparse(population):
+        population_summary = summarize_population(population)
+        population_mean = population_summary['CENTER']
+        population_var = population_summary['SUM_SQ'] / (num_samples - 1)
+        population_count = population_summary['COUNT']
+        sample = dense_columns(sample).ravel()
+    else:
+        population_mean = mean(population, 1)
+        population_var = var(population, 1, ddof = 1)
+        population_count = (population > 0).sum(1)
+
+    return calculate_tax_rank_stats(sample, population_mean, population_var,
+        population_count, num_samples, taxa)
+
+def score_reference_sample(sample, sample_taxa, reference_taxa, \
+    population_summary, correction = 'bonferroni'):
+    """Identifies unique, rare, enriched and depleted taxa in a new sample
+    using a reference profile instead of the population table.
+
+    INPUTS:
+        sample -- a one dimensional numpy array containing the taxonomic
+                    frequency values for a single sample
+
+        sample_taxa -- an array of greengenes ids associated with the sample
+                    frequencies
+
+        reference_taxa, population_summary -- the reference profile, as
+                    returned by load_reference_profile
+
+        correction -- the multiple comparison correction, as described for
+                    calculate_tax_rank_stats
+
+    OUTPUTS:
+        The unique, rare, low and high taxa, as described for
+        calculate_tax_rank_1.
+    """
+    (taxa, sample, population_summary) = align_to_reference(sample_taxa, \
+        sample[:, newaxis], reference_taxa, population_summary)
+    sample = dense_columns(sample)[:, 0]
+
+    (population_mean, population_var, population_count, num_samples) = \
+        reference_stats(sample, population_summary)
+
+    return calculate_tax_rank_stats(sample, population_mean, population_var, \
+        population_count, num_samples, taxa, correction)
+
+def calculate_tax_rank_stats(sample, population_mean, population_var, \
+    population_count, num_samples, taxa, correction = 'bonferroni'):
+    """Identifies unique, rare, enriched and depleted taxa from summarized
+    population statistics.
+
+    INPUTS:
+        sample -- a one dimensional numpy array containing the taxonomic
+                    frequency values for a single sample
+
+        population_mean -- a numpy vector of the average population frequency
+                    of each taxon
+
+        population_var -- a numpy vector of the population sample variance
+                    for each taxon
+
+        population_count -- a numpy vector counting the population samples
+                    where each taxon is present
+
+        num_samples -- the number of samples in the population
+
+        taxa -- an array of greengenes ids associated the sample and 
+                    population frequencies
+
+        correction -- the multiple comparison correction, as described for
+                    calculate_tax_rank_batch
+
+    OUTPUTS:
+        The unique, rare, low and high taxa, as described for
+        calculate_tax_rank_1.
+    """
     # Rare taxa are defined as appearing in less than 10% of the samples
     RARE_THRESHHOLD = 0.1
 
-    (num_taxa, num_samples) = shape(population)
-    sample_shape = sample.shape
-
-    # Calculates binary and count matrices
+    # Calculates binary matrices
     sample_bin = sample > 0
-    population_bin = population > 0
-    population_count = population_bin.sum(1)
    
     # Identifies unique taxa and removes them from the table    
     unique = []
     rare = []
-    new_taxa = []
     remove_index = []    
 
     # Identifies rare and unique taxa
@@ -103,25 +880,24 @@ def calculate_tax_rank_1(sample, population, taxa):
 
     # Removes taxa identified as unique from the available set
     taxa = delete(taxa, remove_index)
-    sample_bin = delete(sample_bin, remove_index)
     sample = delete(sample, remove_index)
-    population_count = delete(population_count, remove_index)
-    population = delete(population, remove_index, 0)
+    population_mean = delete(population_mean, remove_index)
+    population_var = delete(population_var, remove_index)
 
     # Identifies taxa that are significantly enriched or depleted in the 
     # population
     high = []
     low = []
     # Determines the ratio 
-    population_mean = mean(population,1)
     ratio = sample / population_mean
     # preforms a case 1 t-test comparing the sample and population
-    (t_stat, p_stat) = ttest_1samp(population, sample, 1)
-    # Preforms a bonferroni correction on the p values
-    p_stat = p_stat*num_samples
+    (t_stat, p_stat) = ttest_1samp_stats(sample, population_mean, \
+        population_var, num_samples)
+    # Corrects the p values for multiple comparisons
+    p_stat = correct_pvalues(p_stat, correction, \
+        bonferroni_tests(correction, num_samples))
     
     # Determines list position based on the smallest p values.
-    p_sort = sort(p_stat)
     p_order = argsort(p_stat)
 
     # Goes through the p values and determines if they are enriched or depleted
@@ -136,492 +912,1923 @@ def calculate_tax_rank_1(sample, population, taxa):
    
     return unique, rare, low, high
 
-def convert_taxa(rough_taxa, render_mode, formatting_keys):
-    """Takes a dictionary of taxonomy and corresponding values and formats
-    for inclusion in an output table.
+def bonferroni_tests(correction, num_samples):
+    """Sets the number of comparisons used by the p value correction
+
+    Every correction is scaled by the number of tested taxa, except
+    "bonferroni_samples", which keeps the scaling by the number of
+    population samples used by earlier reports.
 
     INPUTS:
+        correction -- the multiple comparison correction method
 
-        rough_taxa -- a dictionary of greengenes taxonomy strings keyed to a
-                    list of numeric values.
+        num_samples -- the number of samples in the population
 
-        render_mode -- a string describing the format for the table: "RAW",
-                    "HTML" or "LATEX".
+    OUTPUT:
+        num_tests -- the number of comparisons passed to correct_pvalues
+    """
+    if correction == 'bonferroni_samples':
+        return num_samples
+    else:
+        return None
 
-        formatting_keys -- a string for converting values to strings. "VAL_INT"
-                    converts the value to a string with an integer, "VAL_FLOAT" 
-                    gives a truncated floating value as a string, "VAL_PER" adds
-                    a percent symbol to the end of the string, and "100_PER" 
-                    multiplies the value by 100 percent and adds a percent 
-                    symbol at the end.
+def calculate_tax_rank_batch(table, population_summary = None, \
+    columns = None, correction = 'bonferroni'):
+    """Identifies unique, rare, enriched and depleted taxa for many samples
+
+    Each sample is compared to the rest of the table, as in the leave-one-out
+    comparison used by generate_otu_signifigance_tables_AGP. All samples are
+    handled in a single vectorized pass.
+
+    INPUTS:
+        table -- a numpy array with the relative frequencies of taxonomies
+                    (rows) for each sample (column), or a scipy sparse matrix.
+                    Only the tested columns are made dense.
+
+        population_summary -- a dictionary of table-wide statistics, as
+                    returned by summarize_population, or a reference profile,
+                    as returned by load_reference_profile. If no value is
+                    passed, it is calculated from the table.
+
+        columns -- a list of the table columns which should be tested. If no
+                    value is passed, all columns in the table are tested.
+
+        correction -- the method used to correct the p values for multiple
+                    comparisons: "bonferroni", "holm", "fdr_bh" or
+                    "bonferroni_samples". Each uses the number of tested
+                    taxa in each sample, except "bonferroni_samples", which
+                    multiplies by the number of population samples.
+
+    OUTPUTS:
+        tax_rank -- a dictionary of two dimensional numpy arrays with taxa as
+                    rows and the tested samples as columns. "UNIQUE", "RARE",
+                    "HIGH" and "LOW" are boolean masks; "SAMPLE" holds the
+                    sample frequencies, "POPULATION" the average population
+                    frequencies, "RATIO" the fold difference and "P_VALUE" the
+                    corrected p values. Taxa which are unique or
+                    rare are not tested and have a p value of nan.
+    """
+    # Rare taxa are defined as appearing in less than 10% of the samples
+    RARE_THRESHHOLD = 0.1
+
+    if population_summary is None:
+        population_summary = summarize_population(table)
+
+    sample = dense_columns(table, columns)
+
+    # Removes each sample from the population summary, unless the summary is
+    # a reference profile the samples are not part of
+    (population_mean, population_var, population_count, num_samples) = \
+        population_stats(sample, population_summary)
+    sample_bin = sample > 0
+    absent = population_count == 0
+
+    # Identifies rare and unique taxa
+    unique = sample_bin & absent
+    rare = sample_bin & ~absent & \
+        (population_count < num_samples*RARE_THRESHHOLD)
+    tested = ~(unique | rare)
+
+    # Determines the ratio and preforms a case 1 t-test, corrected for 
+    # multiple comparisons
+    with errstate(divide = 'ignore', invalid = 'ignore'):
+        ratio = sample / population_mean
+    (t_stat, p_stat) = ttest_1samp_stats(sample, population_mean, \
+        population_var, num_samples)
+    p_stat[~tested] = nan
+    p_stat = correct_pvalues(p_stat, correction, \
+        bonferroni_tests(correction, num_samples))
+
+    # Identifies taxa which are enriched or depleted. Untested taxa have nan
+    # p values, and taxa missing from the population nan ratios.
+    with errstate(invalid = 'ignore'):
+        significant = tested & (p_stat < 0.05)
+        high = significant & (ratio > 1)
+        low = significant & (ratio > 0) & (ratio < 1)
+
+    return {'UNIQUE': unique, 'RARE': rare, 'HIGH': high, 'LOW': low,
+            'SAMPLE': sample, 'POPULATION': population_mean, 'RATIO': ratio,
+            'P_VALUE': p_stat}
+
+def rare_taxa_from_batch(tax_rank, position, taxa):
+    """Pulls the unique and rare taxa for a single sample from the batched
+    results.
+
+    INPUTS:
+        tax_rank -- a dictionary of batched results, as returned by
+                    calculate_tax_rank_batch
+
+        position -- the column of the sample in the batched results
+
+        taxa -- an array of greengenes ids associated with the table rows
+
+    OUTPUTS:
+        The unique and rare taxa, as described for calculate_tax_rank_1.
+    """
+    unique = [taxa[idx] for idx in \
+        tax_rank['UNIQUE'][:, position].nonzero()[0]]
+    rare = [taxa[idx] for idx in tax_rank['RARE'][:, position].nonzero()[0]]
+
+    return unique, rare
+
+def taxa_rows_from_batch(tax_rank, position, rows, taxa):
+    """Builds the table entries for selected taxa in a single sample
+
+    INPUTS:
+        tax_rank -- a dictionary of batched results, as returned by
+                    calculate_tax_rank_batch
+
+        position -- the column of the sample in the batched results
+
+        rows -- a list of the table rows to include. Rows of -1 are skipped.
+
+        taxa -- an array of greengenes ids associated with the table rows
+
+    OUTPUT:
+        taxa_values -- a list of lists containing the greengenes string,
+                    sample frequency, average population frequency, the ratio
+                    of values, and the p-value for each row
+    """
+    taxa_values = []
+    for index in rows:
+        if index < 0:
+            continue
+        taxa_values.append([taxa[index], tax_rank['SAMPLE'][index, position], \
+            tax_rank['POPULATION'][index, position], \
+            tax_rank['RATIO'][index, position], \
+            tax_rank['P_VALUE'][index, position]])
+
+    return taxa_values
+
+def top_taxa_batch(tax_rank, num_taxa, category = 'HIGH'):
+    """Finds the most significant taxa in every sample of the batched results
+
+    Only the taxa with one of the num_taxa smallest p values in each sample
+    are sorted, rather than every taxon. Taxa tied with the last of these p
+    values are all kept until the ties are broken by table row, so the
+    results match tax_rank_from_batch.
+
+    INPUTS:
+        tax_rank -- a dictionary of batched results, as returned by
+                    calculate_tax_rank_batch
+
+        num_taxa -- the number of taxa to find in each sample
+
+        category -- the taxa to search: "HIGH" for enriched taxa or "LOW" for
+                    depleted taxa
+
+    OUTPUT:
+        top_rows -- a numpy array of table rows with num_taxa rows and a
+                    column for each sample in the batch. The rows are ordered
+                    by p value, with ties ordered by table row. Samples with
+                    fewer than num_taxa significant taxa are padded with -1.
+    """
+    p_stat = where(tax_rank[category], tax_rank['P_VALUE'], inf)
+    (num_rows, num_samples) = p_stat.shape
+    num_taxa = min(num_taxa, num_rows)
+    sample_pos = arange(num_samples)
+
+    # Finds the significant rows with a p value no larger than the num_taxa
+    # smallest p value in each sample. Samples with fewer than num_taxa
+    # significant taxa only keep those taxa. The rows for each sample are
+    # packed into a column in row order, and the columns are padded with
+    # infinite p values.
+    if num_taxa < num_rows and num_samples > 0:
+        last_p = partition(p_stat, num_taxa - 1, 0)[num_taxa - 1]
+        (candidate_samples, candidate_rows) = ((p_stat <= \
+            last_p[newaxis, :]) & isfinite(p_stat)).T.nonzero()
+        counts = bincount(candidate_samples, minlength = num_samples)
+        rank = arange(len(candidate_rows)) - \
+            (cumsum(counts) - counts)[candidate_samples]
+        candidates = zeros((max(counts.max(), num_taxa), num_samples), \
+            dtype = int)
+        candidates[rank, candidate_samples] = candidate_rows
+        candidate_p = empty(candidates.shape)
+        candidate_p.fill(inf)
+        candidate_p[rank, candidate_samples] = \
+            p_stat[candidate_rows, candidate_samples]
+    else:
+        candidates = arange(num_rows)[:, newaxis].repeat(num_samples, 1)
+        candidate_p = p_stat[candidates, sample_pos]
+
+    # Orders the candidates by p value, then by row
+    order = lexsort((candidates, candidate_p), 0)[:num_taxa]
+    top_rows = candidates[order, sample_pos]
+    top_rows[isinf(candidate_p[order, sample_pos])] = -1
+
+    return top_rows
+
+def tax_rank_from_batch(tax_rank, position, taxa):
+    """Pulls the unique, rare, low and high taxa for a single sample from the
+    batched results.
+
+    This returns every significant taxon. Use top_taxa_batch when only the
+    most significant taxa are needed.
+
+    INPUTS:
+        tax_rank -- a dictionary of batched results, as returned by
+                    calculate_tax_rank_batch
+
+        position -- the column of the sample in the batched results
+
+        taxa -- an array of greengenes ids associated with the table rows
+
+    OUTPUTS:
+        The unique, rare, low and high taxa, as described for
+        calculate_tax_rank_1. Taxa with the same p value are ordered by
+        table row.
+    """
+    (unique, rare) = rare_taxa_from_batch(tax_rank, position, taxa)
+
+    # Orders the tested taxa by p value
+    tested = (~(tax_rank['UNIQUE'][:, position] | \
+        tax_rank['RARE'][:, position])).nonzero()[0]
+    p_stat = tax_rank['P_VALUE'][tested, position]
+    p_order = tested[argsort(p_stat, kind = 'mergesort')]
+
+    # Splits the significant taxa into enriched and depleted taxa
+    high_rows = p_order[tax_rank['HIGH'][p_order, position]]
+    low_rows = p_order[tax_rank['LOW'][p_order, position]]
+
+    high = taxa_rows_from_batch(tax_rank, position, high_rows, taxa)
+    low = taxa_rows_from_batch(tax_rank, position, low_rows, taxa)
+
+    return unique, rare, low, high
+
+def taxonomy_record(taxon):
+    """Looks up the parsed form of a greengenes taxonomy string
+
+    Each distinct string is parsed and labelled once, and the record is
+    shared by all the table and list renderers. Records are held in
+    TAXONOMY_RECORDS, which is emptied when it reaches
+    TAXONOMY_RECORDS_LIMIT strings.
+
+    INPUT:
+        taxon -- a greengenes taxonomy string, for example
+                    "k__Bacteria; p__Firmicutes; c__Clostridia; o__; f__; g__"
+
+    OUTPUT:
+        record -- a dictionary keyed to the list of level names with the rank
+                    prefixes removed ("LEVELS"), the position of the deepest
+                    named level ("DEEPEST", None if no level is named), and
+                    the text of the taxon in each renderer, as described for
+                    taxonomy_labels.
+    """
+    record = TAXONOMY_RECORDS.get(taxon)
+    if record is not None:
+        return record
+
+    levels = [level.split('__', 1)[-1] for level in taxon.strip().split('; ')]
+
+    deepest = None
+    for idx, level in enumerate(levels):
+        if level != '':
+            deepest = idx
+
+    record = {'LEVELS': levels, 'DEEPEST': deepest}
+    record.update(taxonomy_labels(taxon, levels, deepest))
+
+    if len(TAXONOMY_RECORDS) >= TAXONOMY_RECORDS_LIMIT:
+        TAXONOMY_RECORDS.clear()
+    TAXONOMY_RECORDS[taxon] = record
+
+    return record
+
+def taxonomy_labels(taxon, levels, deepest):
+    """Builds the text used for a taxon in each table and list renderer
+
+    INPUTS:
+        taxon -- a greengenes taxonomy string
+
+        levels -- the level names of the taxon, with the rank prefixes
+                    removed
+
+        deepest -- the position of the deepest named level, or None if no
+                    level is named
+
+    OUTPUT:
+        labels -- a dictionary keyed to the raw ("RAW_TABLE") and LaTeX
+                    ("LATEX_TABLE") table labels, and the regular and bolded
+                    raw ("RAW_ITEM", "RAW_BOLD_ITEM") and LaTeX ("LATEX_ITEM",
+                    "LATEX_BOLD_ITEM") list items. Taxa with no named level
+                    are listed as "Unclassified" in the LaTeX table and the
+                    lists.
+    """
+    # Raw tables name the last level, whether or not it is empty
+    split_tax = [level.split('__', 1)[-1] for level in taxon.split('; ')]
+    no_levels = len(split_tax)
+    if no_levels < 7:
+        raw_table = "%s %s" % (TAX_DES[no_levels - 1], \
+            split_tax[no_levels - 1])
+    elif no_levels == 7:
+        raw_table = "%s %s" % (split_tax[no_levels - 2], \
+            split_tax[no_levels - 1])
+    else:
+        raw_table = "kingdom %s phylum Other" % split_tax
+
+    if deepest is None:
+        return {'RAW_TABLE': raw_table,
+                'LATEX_TABLE': 'Unclassified',
+                'LATEX_ITEM': '\n\\item Unclassified',
+                'LATEX_BOLD_ITEM': '\n\\item \\textbf{Unclassified}',
+                'RAW_ITEM': '\n     o  Unclassified',
+                'RAW_BOLD_ITEM': '\n     o  *Unclassified*'}
+
+    # LaTeX tables and raw lists name the level above the deepest named level
+    no_levels = deepest
+    if no_levels < 6:
+        latex_table = "%s %s" % (TAX_DES[no_levels - 1], \
+            levels[no_levels - 1])
+    elif no_levels == 6:
+        latex_table = "%s \\textit{%s}" % (TAX_DES[no_levels - 1], \
+            levels[no_levels - 1])
+    elif no_levels == 7:
+        latex_table = "\\textit{%s %s}" % (levels[no_levels - 2], \
+            levels[no_levels - 1])
+    else:
+        latex_table = "kingdom \\textit{%s} phylum Other" % levels
+
+    if no_levels < 7:
+        raw_item = "%s %s" % (TAX_DES[no_levels - 1], levels[no_levels - 1])
+    elif no_levels == 7:
+        raw_item = "%s %s" % (levels[no_levels - 2], levels[no_levels - 1])
+    else:
+        raw_item = "kingdom %s" % levels
+
+    # LaTeX lists name the deepest named level
+    if no_levels < 6:
+        latex_item = "%s %s" % (TAX_DES[no_levels], levels[no_levels])
+    elif no_levels == 6:
+        latex_item = "%s \\textit{%s}" % (TAX_DES[no_levels], \
+            levels[no_levels])
+    elif no_levels == 7:
+        latex_item = "\\textit{%s %s}" % (levels[no_levels - 1], \
+            levels[no_levels])
+    else:
+        latex_item = "kingdom %s" % levels
+
+    return {'RAW_TABLE': raw_table,
+            'LATEX_TABLE': latex_table,
+            'LATEX_ITEM': ('\n\\item %s' % latex_item).strip('[').strip(']'),
+            'LATEX_BOLD_ITEM': '\n\\item \\textbf{%s}' % latex_item,
+            'RAW_ITEM': '\n     o  %s' % raw_item,
+            'RAW_BOLD_ITEM': '\n     o  *%s*' % raw_item}
+
+def intern_taxonomy(taxonomy):
+    """Parses every taxonomy string in a table ahead of rendering
+
+    INPUT:
+        taxonomy -- a numpy vector with greengenes taxonomy strings
+
+    OUTPUT:
+        The parsed strings are held in TAXONOMY_RECORDS, as described for
+        taxonomy_record.
+    """
+    for taxon in taxonomy:
+        taxonomy_record(taxon)
+
+def convert_taxa(rough_taxa, render_mode, formatting_keys):
+    """Takes a dictionary of taxonomy and corresponding values and formats
+    for inclusion in an output table.
+
+    INPUTS:
+
+        rough_taxa -- a dictionary of greengenes taxonomy strings keyed to a
+                    list of numeric values. The values are not modified.
+
+        render_mode -- a string describing the format for the table: "RAW",
+                    "HTML" or "LATEX".
+
+        formatting_keys -- a string for converting values to strings. "VAL_INT"
+                    converts the value to a string with an integer, "VAL_FLOAT" 
+                    gives a truncated floating value as a string, "VAL_PER" adds
+                    a percent symbol to the end of the string, and "100_PER" 
+                    multiplies the value by 100 percent and adds a percent 
+                    symbol at the end.
+
+    OUTPUTS:
+
+        formatted_taxa -- a string of strings with formatting for the final 
+                    table. 
+    """
+    if len(rough_taxa) == 0:
+        return []
+
+    # Formats all the values a column at a time
+    value_strings = format_value_columns( \
+        array([element[1:] for element in rough_taxa]), \
+        compile_value_formats(formatting_keys, render_mode))
+
+    formatted_taxa = []
+    for element, strings in zip(rough_taxa, value_strings.tolist()):
+        formatted_taxa.append([element[0]] + strings)
+
+    return formatted_taxa
+
+def taxa_to_table(corr_taxa, header, render_mode="RAW", numbering = 1):
+    """taxa_to_table takes a set of greengenes strings and corresponding 
+    numeric values and converts them into a string or formatted table.
+
+    INPUTS:
+        corr_taxa -- a python dictonary that relates the green genes taxonomy 
+                    string to the list of corresponding taxonomy values. 
+                    Ideally, these should be strings already formatted for use
+                    in the table.
+
+        table_header -- a python list of strings that describe the volumns in 
+                    the table. For raw text tables, the width of the columns is
+                    set by the number of entries in the header. RAW tables can
+                    have no more than 5 columns (corresponding to 15 characters
+                    in each column).
+
+        render_mode -- a string ("LATEX" or "RAW") which describes 
+                    the way the table will be formatted. LATEX or HTML gives a
+                    string containing formatting code. 
+    
+        numbering -- a binary value that will add numbers along the side of the
+                    table if true. Automatically FALSE for TSV rendering.
+
+    OUTPUTS:
+        format_table -- a python string formatted to give a table of taxa when
+                    rendered in the program specified by render_mode."""
+
+    if render_mode == "LATEX":
+        format_table = format_latex_table(corr_taxa, header, numbering)
+    else:
+        format_table = format_raw_table(corr_taxa, header, numbering)
+
+    # Returns the formatted table string
+    return format_table
+
+def raw_table_frame(header, numbering):
+    """Builds the opening and closing lines of a raw text table
+
+    INPUTS:
+        header -- a python list of strings that describe the columns in the
+                    table. RAW tables can have no more than 5 columns.
+
+        numbering -- a binary value that will add numbers along the side of
+                    the table if true.
+
+    OUTPUTS:
+        table_open -- the header bar and column headings of the table
+
+        table_close -- the bar terminating the table
+
+        category_len -- the width of each value column
+    """
+    # Category lengths are set up for an 80 character table
+    CATEGORY_LEN_2 = 47
+    CATEGORY_LEN_3 = 23
+    CATEGORY_LEN_4 = 15
+    CATEGORY_LEN_5 = 11
+
+    # Initializes the table
+    header_len = len(header)
+
+    # Sets up the category length based on the number of header categories
+    if header_len == 2:
+        category_len = CATEGORY_LEN_2
+    elif header_len == 3:
+        category_len = CATEGORY_LEN_3
+    elif header_len == 4:
+        category_len = CATEGORY_LEN_4
+    elif header_len == 5:
+        category_len = CATEGORY_LEN_5
+    else:
+        raise ValueError, "There cannot be more than 5 header categories"
+
+    # Creates initial table row
+    if numbering == 1:
+        header_element = ['-----%s\n      ' % RAW_HEADER_BAR]
+    else:
+        header_element = ['%s\n' % RAW_HEADER_BAR]
+
+    # Adds the header description
+    for counter, category in enumerate(header):
+        clean_cat = "%s%s" % (category, RAW_SPACER)
+        if counter == 0:
+            header_element.append('%s' % clean_cat[0:RAW_TAX_SPACE])
+        else:
+            header_element.append(clean_cat[0:category_len])
+
+    # Terminates the table header
+    if numbering == 1:
+        header_element.append('\n-----%s' % RAW_HEADER_BAR)
+        table_close = '\n-----%s' % RAW_HEADER_BAR
+    else:
+        header_element.append('\n%s' % RAW_HEADER_BAR)
+        table_close = '\n%s' % RAW_HEADER_BAR
+
+    return ''.join(header_element), table_close, category_len
+
+def raw_table_label(otu):
+    """Cleans up a greengenes string for the first column of a raw table
+
+    INPUTS:
+        otu -- a greengenes taxonomy string
+
+    OUTPUTS:
+        clean_otu -- the taxonomy label, padded or truncated to the width
+                    of the taxonomy column
+    """
+    clean_otu = "%s%s" % (taxonomy_record(otu)['RAW_TABLE'], RAW_SPACER)
+
+    return clean_otu[0:RAW_TAX_SPACE]
+
+def raw_table_row(count, clean_otu, otu_values, numbering, category_len):
+    """Builds a single row of a raw text table
+
+    INPUTS:
+        count -- the position of the row in the table, starting at 1
+
+        clean_otu -- the taxonomy label, as returned by raw_table_label
+
+        otu_values -- a list of strings formatted for use in the table
+
+        numbering -- a binary value that will add numbers along the side of
+                    the table if true.
+
+        category_len -- the width of each value column
+
+    OUTPUTS:
+        table_row -- the row as a string, starting with a line break
+    """
+    # Sets up the first column
+    if numbering == 1 and count < 10:
+        table_row = ['\n ( %d) %s' % (count, clean_otu)]
+    elif numbering == 1:
+        table_row = ['\n (%d) %s' % (count, clean_otu)]
+    else:
+        table_row = ['\n%s' % clean_otu]
+
+    # Adds row information to the table
+    for value in otu_values:
+        val_expand = "%s%s" % (value, RAW_SPACER)
+        table_row.append("\t%s" % (val_expand[0:(category_len)]))
+
+    return ''.join(table_row)
+
+def format_raw_table(corr_taxa, header, numbering):
+    """converts a greengenes ids and frequency to a raw text formatted table
+
+    INPUTS:
+        corr_taxa -- a list of lists that relates the green genes 
+                    taxonomy string to the list of corresponding taxonomy 
+                    values. Ideally, these should be strings already formatted 
+                    for use in the table.
+
+        table_header -- a python list of strings that describe the volumns 
+                    in the table. For raw text tables, the width of the columns 
+                    is set by the number of entries in the header. RAW tables 
+                    can have no more than 5 columns (corresponding to 15 
+                    characters in each column).
+
+        render_mode -- a string ("LATEX", "HTML",  or "RAW") which describes 
+                    the way the table will be formatted. LATEX or HTML gives
+                     a string containing formatting code. 
+    
+        numbering -- a binary value that will add numbers along the side of 
+                        the table if true. Automatically FALSE for TSV 
+                        rendering.
+
+    OUTPUTS:
+        format_table -- a python string formatted to give a table of taxa 
+                    when rendered in the program specified by render_mode.
+        """
+    (table_open, table_close, category_len) = raw_table_frame(header, \
+        numbering)
+
+    format_table = [table_open]
+
+    for idx, element in enumerate(corr_taxa):
+        clean_otu = raw_table_label(element[0])
+        format_table.append(raw_table_row(idx + 1, clean_otu, element[1:], \
+            numbering, category_len))
+
+    # Terminates the table
+    format_table.append(table_close)
+
+    format_table = ''.join(format_table)
+
+    return format_table
+
+def latex_table_frame(header, numbering):
+    """Builds the opening and closing code of a LaTeX table
+
+    INPUTS:
+        header -- a python list of strings that describe the columns in the
+                    table.
+
+        numbering -- a binary value that will add numbers along the side of
+                    the table if true.
+
+    OUTPUTS:
+        table_open -- the tabular preamble and header row of the table
+
+        table_close -- the code terminating the table
+    """
+    # Initializes the table
+    if numbering == 1:
+        format_elements = ["{r"]
+        header_elements = [" & "]
+    else:
+        format_elements = ["{"]
+        header_elements = [""]
+
+    # Creates formatting designation and the header
+    for category in header: 
+        format_elements.append(" c")
+        header_elements.append("%s & " % category)
+
+    format_elements.append("}")        
+    format_code = ''.join(format_elements)
+    header_code = ''.join(header_elements)
+    header_code = header_code[0:(len(header_code)-3)]
+    # Sets up the intialization code
+    table_open = "\\begin{tabular}%s\n\\hline\n%s \\\\ \n\\hline\n" \
+        %(format_code, header_code)
+
+    return table_open, '\\hline\n\\end{tabular}'
+
+def latex_table_label(otu):
+    """Cleans up a greengenes string for the first column of a LaTeX table
+
+    INPUTS:
+        otu -- a greengenes taxonomy string
+
+    OUTPUTS:
+        clean_otu -- the LaTeX encoded taxonomy label
+    """
+    return taxonomy_record(otu)['LATEX_TABLE']
+
+def latex_table_row(count, clean_otu, otu_values, numbering):
+    """Builds a single row of a LaTeX table
+
+    INPUTS:
+        count -- the position of the row in the table, starting at 1
+
+        clean_otu -- the taxonomy label, as returned by latex_table_label
+
+        otu_values -- a list of strings formatted for use in the table
+
+        numbering -- a binary value that will add numbers along the side of
+                    the table if true.
+
+    OUTPUTS:
+        table_row -- the row as a string, ending with a line break
+    """
+    # Sets up the table entry
+    table_row = []
+    if numbering == 1 and count < 10:
+        table_row.append("( %d) & %s" % (count, clean_otu))
+        
+    elif numbering == 1:
+        table_row.append("(%d) & %s" % (count, clean_otu))
+        
+    else:
+        table_row.append("%s" % clean_otu)
+        
+    # Adds numeric data to the table
+    for value in otu_values:table_row.append(" & %s" % value)
+            
+    # Appends to create a line break
+    table_row.append("\\\\\n")
+
+    return ''.join(table_row)
+
+def format_latex_table(corr_taxa, header, numbering):
+    """converts a greengenes ids and frequency to a raw text formatted table
+    
+    INPUTS:
+        corr_taxa -- a python dictonary that relates the green genes 
+                    taxonomy string to the list of corresponding taxonomy 
+                    values. Ideally, these should be strings already formatted 
+                    for use in the table.
+
+        table_header -- a python list of strings that describe the volumns 
+                    in the table. For raw text tables, the width of the columns 
+                    is set by the number of entries in the header. RAW tables 
+                    can have no more than 5 columns (corresponding to 15 
+                    characters in each column).
+
+        render_mode -- a string ("LATEX", "HTML",  or "RAW") which describes 
+                    the way the table will be formatted. LATEX or HTML gives
+                    a string containing formatting code. 
+    
+        numbering -- a binary value that will add numbers along the side of 
+                    the table if true. Automatically FALSE for TSV 
+                    rendering.
+
+
+    OUTPUTS:
+        format_table -- a python string formatted to give a table of taxa 
+                        when rendered in the program specified by render_mode.
+        """
+    (table_open, table_close) = latex_table_frame(header, numbering)
+
+    format_table = [table_open]
+
+    for idx, element in enumerate(corr_taxa):
+        clean_otu = latex_table_label(element[0])
+        format_table.append(latex_table_row(idx + 1, clean_otu, \
+            element[1:], numbering))
+
+    # Terminate the table
+    format_table.append(table_close)
+
+    format_table = ''.join(format_table)
+
+    return format_table
+
+def latex_list_item(element, item_format):
+    """Creates a single item for a LaTeX encoded list
+
+    INPUTS:
+        element -- a greengenes taxonomy string
+
+        item_format -- "BOLD" if the item should be bolded, otherwise "REG"
+
+    OUTPUTS:
+        list_item -- the LaTeX encoded list item
+    """
+    if item_format == 'BOLD':
+        return taxonomy_record(element)['LATEX_BOLD_ITEM']
+    else:
+        return taxonomy_record(element)['LATEX_ITEM']
+
+def render_latex_list(raw_taxa, tax_format):
+    """Creates a series of items for a LaTex encoded list
+    INPUTS:
+        raw_taxa -- a python list object containing taxonomy strings from 
+                        greengenes to be included in the final, formated output.
+
+        tax_format -- a list specifiying if an argument should be bolded 
+                    (denoted by "BOLD") or left alone ("REG")
+
+    OUTPUTS:
+        format_list_items -- Latex encoded list items"""
+    
+    format_list_items = []
+
+    for (idx, element) in enumerate(raw_taxa):
+        format_list_items.append(latex_list_item(element, tax_format[idx]))
+
+    format_list_items = ''.join(format_list_items)
+
+    return format_list_items
+
+def raw_list_item(element, item_format):
+    """Creates a single item for a raw text list
+
+    INPUTS:
+        element -- a greengenes taxonomy string
+
+        item_format -- "BOLD" if the item should be bolded, otherwise "REG"
+
+    OUTPUTS:
+        list_item -- the raw text list item
+    """
+    if item_format == 'BOLD':
+        return taxonomy_record(element)['RAW_BOLD_ITEM']
+    else:
+        return taxonomy_record(element)['RAW_ITEM']
+
+def render_raw_list(raw_taxa, tax_format):
+    """Creates a series of items for a raw text list
+    INPUTS:
+        raw_taxa -- a python list object containing taxonomy strings from 
+                    greengenes to be included in the final, formated output.
+
+        tax_format -- a list specifiying if an argument should be bolded 
+                    (denoted by "BOLD") or left alone ("REG")
+
+    OUTPUTS:
+        format_list_items -- raw text encoded list items"""
+
+    format_list_items = []
+
+    for idx, element in enumerate(raw_taxa):
+        format_list_items.append(raw_list_item(element, tax_format[idx]))
+
+    format_list_items = ''.join(format_list_items)
+
+    return format_list_items
+
+def taxa_to_list(raw_taxa, tax_format, render_mode="RAW"):
+    """taxa_to_list takes a list of greengenes taxonomy strings and converts
+    it to a text string that can be printed to a document.
+
+    INPUTS:
+        raw_taxa -- a python list object containing taxonomy strings from 
+                    greengenes to be included in the final, formated output.
+
+        tax_format -- a list specifiying if an argument should be bolded 
+                        (denoted by "BOLD") or left alone ("REG")
+
+        render_mode -- a python string describing the way the out should be 
+                    formatted. Options are LATEX, corresponding to LaTex code,
+                    HTML, or RAW. LaTEX or HTML will give a string of code for
+                    inclusion in the corresponding document. RAW will give a 
+                    text file suitable for viewing, although RAW formats do not
+                    include italics.
+    
+    OUTPUTS:
+        format_list -- a python string formatted to give a list of taxa 
+                    according to the supplied formatting mode."""
+
+    # Sets up precurser formatting text
+    if render_mode == "LATEX":
+        format_list = ["\\begin{itemize}"]
+        format_list.append(render_latex_list(raw_taxa, tax_format))
+        format_list.append('\n\\end{itemize}')
+
+    else:
+        format_list = []
+        format_list.append(render_raw_list(raw_taxa, tax_format))
+        format_list.append('\n')
+
+    format_list = ''.join(format_list)
+
+    # Returns formatted string
+    return format_list
+
+def compile_value_formats(formatting_keys, render_mode):
+    """Converts formatting keys into format strings and scale factors
+
+    INPUTS:
+        formatting_keys -- a list of the formatting keys described for
+                    convert_taxa, one for each value column
+
+        render_mode -- a string describing the format for the table: "RAW",
+                    "HTML" or "LATEX".
+
+    OUTPUTS:
+        value_formats -- a list with a (format string, scale factor) tuple
+                    for each column, or None for columns which are skipped.
+    """
+    if render_mode == "LATEX":
+        percent = "%1.2f\\%%"
+    else:
+        percent = "%1.2f%%"
+
+    value_formats = []
+    for key in formatting_keys:
+        if key == "VAL_INT":
+            value_formats.append(("%i", None))
+        elif key == "VAL_FLOAT":
+            value_formats.append(("%1.2f", None))
+        elif key == "VAL_PER":
+            value_formats.append((percent, None))
+        elif key == "100_PER":
+            value_formats.append((percent, 100))
+        else:
+            value_formats.append(None)
+
+    return value_formats
+
+def format_value_columns(values, value_formats):
+    """Formats a table of numeric values a column at a time
+
+    INPUTS:
+        values -- a 2D numpy array of numeric values, with a column for each
+                    entry in value_formats. The array is not modified.
+
+        value_formats -- a list of the format for each column, as returned
+                    by compile_value_formats
+
+    OUTPUTS:
+        value_strings -- a 2D numpy array of formatted strings with a row for
+                    each row in values. Skipped columns are left out.
+    """
+    formatted_columns = []
+    for idx, value_format in enumerate(value_formats[:values.shape[1]]):
+        if value_format is None:
+            continue
+        (value_string, scale) = value_format
+        column = values[:, idx]
+        if scale is not None:
+            column = column*scale
+        formatted_columns.append(char.mod(value_string, column))
+
+    if len(formatted_columns) == 0:
+        return empty((values.shape[0], 0), dtype = str)
+
+    return column_stack(formatted_columns)
+
+def compile_table_template(header, formatting_keys, render_mode = "RAW", \
+    numbering = 1):
+    """Compiles the parts of a taxa table which are shared between samples
+
+    INPUTS:
+        header -- a python list of strings that describe the columns in the
+                    table, as described for taxa_to_table.
+
+        formatting_keys -- a list of the formatting keys described for
+                    convert_taxa, one for each value column
+
+        render_mode -- a string ("LATEX" or "RAW") which describes the way
+                    the table will be formatted.
+
+        numbering -- a binary value that will add numbers along the side of
+                    the table if true.
+
+    OUTPUTS:
+        template -- a dictionary holding the render mode ("RENDER_MODE"),
+                    numbering ("NUMBERING"), the opening ("OPEN") and closing
+                    ("CLOSE") text of the table, the value column width
+                    ("CATEGORY_LEN", RAW only) and the value formats
+                    ("VALUE_FORMATS", as returned by compile_value_formats).
+    """
+    if render_mode == "LATEX":
+        (table_open, table_close) = latex_table_frame(header, numbering)
+        category_len = None
+    else:
+        (table_open, table_close, category_len) = raw_table_frame(header, \
+            numbering)
+
+    return {'RENDER_MODE': render_mode,
+            'NUMBERING': numbering,
+            'OPEN': table_open,
+            'CLOSE': table_close,
+            'CATEGORY_LEN': category_len,
+            'VALUE_FORMATS': compile_value_formats(formatting_keys, \
+                render_mode)}
+
+def render_table_template(template, rough_taxa):
+    """Fills a compiled table template with the values for a sample
+
+    INPUTS:
+        template -- a compiled table, as returned by compile_table_template
+
+        rough_taxa -- a list of lists giving a greengenes taxonomy string
+                    followed by the numeric values for the taxon. The list is
+                    not modified.
+
+    OUTPUTS:
+        format_table -- a python string formatted to give a table of taxa,
+                    identical to the output of convert_taxa and
+                    taxa_to_table.
+    """
+    if len(rough_taxa) == 0:
+        return fill_table_template(template, [], [])
+
+    value_strings = format_value_columns( \
+        array([element[1:] for element in rough_taxa]), \
+        template['VALUE_FORMATS'])
+
+    return fill_table_template(template, \
+        [element[0] for element in rough_taxa], value_strings.tolist())
+
+def fill_table_template(template, taxa, value_strings):
+    """Fills a compiled table template with values which are already formatted
+
+    INPUTS:
+        template -- a compiled table, as returned by compile_table_template
+
+        taxa -- a list of the greengenes taxonomy strings for the table rows
+
+        value_strings -- a list with the formatted values for each row, as
+                    produced by format_value_columns
+
+    OUTPUTS:
+        format_table -- a python string formatted to give a table of taxa
+    """
+    render_mode = template['RENDER_MODE']
+    numbering = template['NUMBERING']
+    category_len = template['CATEGORY_LEN']
+
+    format_table = [template['OPEN']]
+
+    for idx, otu in enumerate(taxa):
+        if render_mode == "LATEX":
+            format_table.append(latex_table_row(idx + 1, \
+                latex_table_label(otu), value_strings[idx], numbering))
+        else:
+            format_table.append(raw_table_row(idx + 1, \
+                raw_table_label(otu), value_strings[idx], numbering, \
+                category_len))
+
+    format_table.append(template['CLOSE'])
+
+    return ''.join(format_table)
+
+def compile_list_template(render_mode = "RAW"):
+    """Compiles the parts of a taxa list which are shared between samples
+
+    INPUTS:
+        render_mode -- a string ("LATEX" or "RAW") which describes the way
+                    the list will be formatted.
+
+    OUTPUTS:
+        template -- a dictionary holding the render mode ("RENDER_MODE")
+                    and the opening ("OPEN") and closing ("CLOSE") text of
+                    the list.
+    """
+    if render_mode == "LATEX":
+        (list_open, list_close) = ("\\begin{itemize}", '\n\\end{itemize}')
+    else:
+        (list_open, list_close) = ('', '\n')
+
+    return {'RENDER_MODE': render_mode,
+            'OPEN': list_open,
+            'CLOSE': list_close}
+
+def render_list_template(template, raw_taxa, tax_format):
+    """Fills a compiled list template with the taxa for a sample
+
+    INPUTS:
+        template -- a compiled list, as returned by compile_list_template
+
+        raw_taxa -- a python list object containing greengenes taxonomy
+                    strings
+
+        tax_format -- a list specifiying if an argument should be bolded
+                    (denoted by "BOLD") or left alone ("REG")
+
+    OUTPUTS:
+        format_list -- a python string formatted to give a list of taxa,
+                    identical to the output of taxa_to_list.
+    """
+    if template['RENDER_MODE'] == "LATEX":
+        render_item = latex_list_item
+    else:
+        render_item = raw_list_item
+
+    format_list = [template['OPEN']]
+
+    for idx, element in enumerate(raw_taxa):
+        format_list.append(render_item(element, tax_format[idx]))
+
+    format_list.append(template['CLOSE'])
+
+    return ''.join(format_list)
+
+def report_templates(render_mode, header, formatting_keys, numbering = 1):
+    """Returns the compiled table and list templates for a report layout
+
+    INPUTS:
+        render_mode, header, formatting_keys, numbering -- the report layout,
+                    as described for compile_table_template
+
+    OUTPUTS:
+        templates -- a dictionary with the compiled table ("TABLE") and list
+                    ("LIST") templates. Templates are compiled the first time
+                    a layout is requested and held in REPORT_TEMPLATES.
+    """
+    key = (render_mode, tuple(header), tuple(formatting_keys), numbering)
+    templates = REPORT_TEMPLATES.get(key)
+    if templates is not None:
+        return templates
+
+    templates = {'TABLE': compile_table_template(header, formatting_keys, \
+                    render_mode, numbering),
+                 'LIST': compile_list_template(render_mode)}
+    REPORT_TEMPLATES[key] = templates
+
+    return templates
+
+def format_batch_values(tax_rank, rows, formatting_keys, render_mode):
+    """Formats the table values of the selected taxa for a batch of samples
+
+    INPUTS:
+        tax_rank -- a dictionary of batched results, as returned by
+                    calculate_tax_rank_batch
+
+        rows -- a numpy array of table rows for each sample (column), as
+                    returned by top_taxa_batch. Rows of -1 are skipped.
+
+        formatting_keys, render_mode -- the value formats, as described for
+                    convert_taxa
+
+    OUTPUT:
+        batch_strings -- a numpy array of formatted strings, giving the
+                    sample frequency, average population frequency, ratio
+                    and p-value (less skipped columns) for each entry in rows.
+    """
+    (ranks, positions) = where(rows >= 0)
+    taxa_rows = rows[ranks, positions]
+
+    values = column_stack([tax_rank[key][taxa_rows, positions] for key in \
+        ('SAMPLE', 'POPULATION', 'RATIO', 'P_VALUE')])
+    value_strings = format_value_columns(values, \
+        compile_value_formats(formatting_keys, render_mode))
+
+    batch_strings = empty(rows.shape + (value_strings.shape[1],), \
+        dtype = value_strings.dtype)
+    batch_strings[ranks, positions] = value_strings
+
+    return batch_strings
+
+def format_sample_reports(unique, rare, high, high_values = None):
+    """Formats the enriched taxa table and rare taxa list for a sample
+
+    INPUTS:
+        unique, rare, high -- the unique, rare and high taxa for the sample,
+                    as returned by calculate_tax_rank_1
+
+        high_values -- the formatted values for the high taxa, as returned
+                    by format_value_columns. When given, high is a list of
+                    the taxonomy strings alone.
+
+    OUTPUTS:
+        high_formatted -- a LaTeX encoded table of the enriched taxa
+
+        rare_formatted -- a LaTeX encoded list of the rare and unique taxa
+    """
+    templates = report_templates(REPORT_RENDERING, REPORT_TABLE_HEADER, \
+        REPORT_FORMAT_KEYS)
+
+    # Generates formatted table
+    if high_values is None:
+        high_formatted = render_table_template(templates['TABLE'], \
+            high[0:NUMBER_OF_TAXA_SHOWN])
+    else:
+        high_formatted = fill_table_template(templates['TABLE'], \
+            high[0:NUMBER_OF_TAXA_SHOWN], high_values[0:NUMBER_OF_TAXA_SHOWN])
+
+    # Generates formatted list
+    rare_format = []
+    rare_combined = []
+    for taxon in unique:
+        rare_combined.append(taxon)
+        rare_format.append('BOLD')
+    for taxon in rare:
+        rare_combined.append(taxon)
+        rare_format.append('REG')
+
+    number_rare_tax = len(rare_combined)
+
+    if number_rare_tax > NUMBER_OF_TAXA_SHOWN + 1:
+        rare_formatted = ["This sample contained %i rare or unique taxa,"\
+                          " including the following.\\\n" % number_rare_tax]
+        rare_formatted.append(render_list_template(templates['LIST'], \
+            rare_combined[:NUMBER_OF_TAXA_SHOWN ], rare_format))
+        rare_formatted = ''.join(rare_formatted)
+
+    elif number_rare_tax > 0:
+        rare_formatted = render_list_template(templates['LIST'], \
+            rare_combined, rare_format)
+
+    else:
+        rare_formatted = "There were no rare or unique samples found"\
+                     " in this sample."
+
+    return high_formatted, rare_formatted
+
+def report_names(sample_id):
+    """Names the table and list files for a sample
+
+    INPUT:
+        sample_id -- the sample id used to name the files
+
+    OUTPUT:
+        table_name, list_name -- the names of the table (Table_<SAMPLE_ID>.txt)
+                    and list (List_<SAMPLE_ID>.txt) files
+    """
+    return "Table_%s.txt" % sample_id, "List_%s.txt" % sample_id
+
+def write_sample_reports(output_dir, sample_id, high_formatted, \
+    rare_formatted):
+    """Saves the formatted table and list for a sample
+
+    INPUTS:
+        output_dir -- a directory where the final files should be saved.
+
+        sample_id -- the sample id used to name the files
+
+        high_formatted, rare_formatted -- the formatted table and list, as
+                    returned by format_sample_reports
+
+    OUTPUTS:
+        The table is saved as Table_<SAMPLE_ID>.txt and the list as
+        List_<SAMPLE_ID>.txt in the output directory.
+    """
+    (table_name, list_name) = report_names(sample_id)
+
+    # Saves the file
+    file_table_name = "%s/%s" % (output_dir, table_name)
+    file_list_name = "%s/%s" % (output_dir, list_name)
+
+    file_table = open(file_table_name, 'w')
+    file_table.write(high_formatted)
+    file_table.close()
+
+    file_list = open(file_list_name, 'w')
+    file_list.write(rare_formatted)
+    file_list.close()
+
+def open_report_store(output_dir, store_format = 'files', mode = 'w', \
+    keep_samples = None, replace_samples = None):
+    """Opens the location where the sample reports are kept
+
+    INPUTS:
+        output_dir -- the directory holding the reports
+
+        store_format -- "files" for a table and list file per sample, "zip"
+                    for a single archive (reports.zip) holding the same files,
+                    or "memory" to hold the reports in a list.
+
+        mode -- "w" to write reports or "r" to read them. A "zip" store opened
+                    for writing replaces any existing archive, carrying over
+                    the reports described by keep_samples or
+                    replace_samples.
+
+        keep_samples -- a list of sample ids whose reports are copied from
+                    the existing archive when a "zip" store is opened for
+                    writing. Files in a "files" store are always kept.
+
+        replace_samples -- a list of sample ids whose reports are about to
+                    be written. If keep_samples is not passed, the reports of
+                    every other sample are copied from the existing archive,
+                    as the other files of a "files" store are left in place.
+
+    OUTPUT:
+        store -- a dictionary holding the store format ("FORMAT"), the output
+                    directory ("OUTPUT_DIR"), the open archive ("ARCHIVE",
+                    "zip" only), the reports held in memory ("REPORTS",
+                    "memory" only) and the queue ("QUEUE"), threads
+                    ("WRITERS") and errors ("ERRORS") of any background
+                    writers, as described for start_report_writers.
+    """
+    if store_format not in REPORT_STORE_FORMATS + ('memory',):
+        raise ValueError, "%s is not a supported report store." \
+            % store_format
+
+    store = {'FORMAT': store_format,
+             'OUTPUT_DIR': output_dir,
+             'ARCHIVE': None,
+             'REPORTS': [],
+             'QUEUE': None,
+             'WRITERS': [],
+             'ERRORS': []}
+
+    if store_format != 'zip':
+        return store
+
+    archive_fp = join(output_dir, REPORT_ARCHIVE)
+    previous_fp = None
+    if mode == 'w' and (keep_samples or replace_samples is not None) and \
+        isfile(archive_fp):
+        previous_fp = "%s.previous" % archive_fp
+        rename(archive_fp, previous_fp)
+
+    store['ARCHIVE'] = ZipFile(archive_fp, mode, ZIP_DEFLATED, \
+        allowZip64 = True)
+
+    # Carries the kept reports over from the previous archive
+    if previous_fp is not None:
+        previous = ZipFile(previous_fp, 'r')
+        if keep_samples:
+            kept_names = set()
+            for sample_id in keep_samples:
+                kept_names.update(report_names(sample_id))
+            kept_names.intersection_update(previous.namelist())
+        else:
+            replaced_names = set()
+            for sample_id in replace_samples:
+                replaced_names.update(report_names(sample_id))
+            kept_names = set(previous.namelist()) - replaced_names
+        for info in previous.infolist():
+            if info.filename in kept_names:
+                store['ARCHIVE'].writestr(info, previous.read(info))
+        previous.close()
+        remove(previous_fp)
+
+    return store
+
+def write_report_store(store, sample_id, high_formatted, rare_formatted):
+    """Saves the formatted table and list for a sample in a report store
+
+    When the store has background writers, the reports are queued and this
+    only waits if the queue is full.
+
+    INPUTS:
+        store -- a report store opened for writing, as returned by
+                    open_report_store
+
+        sample_id -- the sample id used to name the reports
+
+        high_formatted, rare_formatted -- the formatted table and list, as
+                    returned by format_sample_reports
+    """
+    if store['QUEUE'] is None:
+        save_report_store(store, sample_id, high_formatted, rare_formatted)
+    else:
+        check_report_writers(store)
+        store['QUEUE'].put((sample_id, high_formatted, rare_formatted))
+
+def save_report_store(store, sample_id, high_formatted, rare_formatted):
+    """Saves the formatted table and list for a sample straight away
+
+    INPUTS:
+        store, sample_id, high_formatted, rare_formatted -- as described for
+                    write_report_store
+    """
+    if store['FORMAT'] == 'zip':
+        (table_name, list_name) = report_names(sample_id)
+        store['ARCHIVE'].writestr(table_name, high_formatted)
+        store['ARCHIVE'].writestr(list_name, rare_formatted)
+    elif store['FORMAT'] == 'memory':
+        store['REPORTS'].append((sample_id, high_formatted, rare_formatted))
+    else:
+        write_sample_reports(store['OUTPUT_DIR'], sample_id, \
+            high_formatted, rare_formatted)
+
+def read_report_store(store, sample_id):
+    """Fetches the formatted table and list for a sample from a report store
+
+    INPUTS:
+        store -- a "files" or "zip" report store opened for reading, as
+                    returned by open_report_store
+
+        sample_id -- the sample id of the reports
+
+    OUTPUTS:
+        high_formatted, rare_formatted -- the formatted table and list, as
+                    returned by format_sample_reports
+    """
+    (table_name, list_name) = report_names(sample_id)
+
+    reports = []
+    for name in (table_name, list_name):
+        if store['FORMAT'] == 'zip':
+            try:
+                reports.append(store['ARCHIVE'].read(name))
+            except KeyError:
+                raise ValueError, "There are no reports for sample %s." \
+                    % sample_id
+        else:
+            report_fp = join(store['OUTPUT_DIR'], name)
+            if not isfile(report_fp):
+                raise ValueError, "There are no reports for sample %s." \
+                    % sample_id
+            report_file = open(report_fp)
+            reports.append(report_file.read())
+            report_file.close()
+
+    return tuple(reports)
+
+def start_report_writers(store, num_writers, queue_size = 100):
+    """Starts background threads which save the reports written to a store
+
+    The reports are saved while the next samples are being calculated. Once
+    queue_size reports are waiting, write_report_store blocks until a writer
+    catches up. An archive is not safe to share between threads, so a "zip"
+    store only ever has a single writer.
+
+    INPUTS:
+        store -- a "files" or "zip" report store opened for writing, as
+                    returned by open_report_store
+
+        num_writers -- the number of writer threads
+
+        queue_size -- the most reports which can be waiting to be saved
+    """
+    if store['FORMAT'] == 'zip':
+        num_writers = min(num_writers, 1)
+
+    store['QUEUE'] = Queue(queue_size)
+    for idx in range(num_writers):
+        writer = Thread(target = run_report_writer, args = (store,))
+        writer.daemon = True
+        writer.start()
+        store['WRITERS'].append(writer)
+
+def run_report_writer(store):
+    """Saves queued reports until the end of the queue is reached
+
+    INPUT:
+        store -- a report store, as described for start_report_writers.
+                    Errors are recorded in the store; once one is recorded
+                    the remaining reports are discarded.
+    """
+    while True:
+        report = store['QUEUE'].get()
+        try:
+            if report is None:
+                break
+            if len(store['ERRORS']) == 0:
+                save_report_store(store, *report)
+        except:
+            store['ERRORS'].append(exc_info())
+        finally:
+            store['QUEUE'].task_done()
+
+def check_report_writers(store):
+    """Raises the first error recorded by the background writers of a store
+
+    INPUT:
+        store -- a report store, as returned by open_report_store
+    """
+    if len(store['ERRORS']) > 0:
+        (error_type, error, traceback) = store['ERRORS'][0]
+        raise error_type, error, traceback
+
+def flush_report_store(store):
+    """Waits until all the queued reports of a store have been saved
+
+    INPUT:
+        store -- a report store, as returned by open_report_store
+    """
+    if store['QUEUE'] is not None:
+        store['QUEUE'].join()
+    check_report_writers(store)
+
+def close_report_store(store, raise_errors = True):
+    """Closes a report store, finishing the archive of a "zip" store
+
+    Any queued reports are saved first. Errors from the background writers
+    are raised once the store is closed.
+
+    INPUTS:
+        store -- a report store, as returned by open_report_store
+
+        raise_errors -- raises the first error from the background writers.
+                    This is turned off when the store is closed while
+                    another error is being raised, so that error is not
+                    hidden.
+    """
+    if store['QUEUE'] is not None:
+        for writer in store['WRITERS']:
+            store['QUEUE'].put(None)
+        for writer in store['WRITERS']:
+            writer.join()
+        store['QUEUE'] = None
+        store['WRITERS'] = []
+
+    if store['ARCHIVE'] is not None:
+        store['ARCHIVE'].close()
+        store['ARCHIVE'] = None
+
+    if raise_errors:
+        check_report_writers(store)
+
+def generate_block_reports(taxa, table, population_summary, columns, \
+    sample_ids, store, correction = 'bonferroni'):
+    """Creates the significant OTU tables and lists for a block of samples
+
+    INPUTS:
+        taxa -- a numpy vector with greengenes taxonomy strings
+
+        table -- a numpy array with the relative frequencies of taxonomies
+                    (rows) for each sample (column)
+
+        population_summary -- a dictionary of table-wide statistics, as
+                    returned by summarize_population.
+
+        columns -- a list of the table columns in the block
+
+        sample_ids -- a list of the sample ids for the columns
+
+        store -- the report store the reports are saved in, as returned by
+                    open_report_store
 
-    OUTPUTS:
+        correction -- the multiple comparison correction, as described for
+                    calculate_tax_rank_batch
 
-        formatted_taxa -- a string of strings with formatting for the final 
-                    table. 
+    OUTPUTS:
+        A table and list are saved for each sample in the block, as described
+        for write_report_store.
     """
-    formatted_taxa = []
+    block_start = default_timer()
+
+    with profile_stage('calculate_tax_rank_batch'):
+        tax_rank = calculate_tax_rank_batch(table, population_summary, \
+            columns, correction)
+
+        # Only the enriched taxa which are shown in the table are pulled out
+        # and their values are formatted for the whole block at once
+        top_high = top_taxa_batch(tax_rank, NUMBER_OF_TAXA_SHOWN, 'HIGH')
+        high_strings = format_batch_values(tax_rank, top_high, \
+            REPORT_FORMAT_KEYS, REPORT_RENDERING)
+
+    # Each sample is charged an even share of the block statistics
+    block_share = (default_timer() - block_start) / max(len(sample_ids), 1)
+
+    for batch_pos, sample_id in enumerate(sample_ids):
+        sample_start = default_timer()
+        with profile_stage('format_sample_reports'):
+            (unique, rare) = rare_taxa_from_batch(tax_rank, batch_pos, taxa)
+            shown = top_high[:, batch_pos] >= 0
+            high = [taxa[row] for row in top_high[shown, batch_pos]]
+            high_values = high_strings[shown, batch_pos].tolist()
+            (high_formatted, rare_formatted) = format_sample_reports(unique, \
+                rare, high, high_values)
+        with profile_stage('write_report_store'):
+            write_report_store(store, sample_id, high_formatted, \
+                rare_formatted)
+        record_sample_time(block_share + default_timer() - sample_start)
+
+# Holds the read-only data shared by the report worker processes
+WORKER_STATE = {}
+
+def init_report_worker(taxa, table_fp, population_summary, output_dir, \
+    correction, store_format, writers):
+    """Sets up a report worker process
 
-    for element in rough_taxa:
-        taxon = element[0]
-        element.pop(0)
-        new_element = [taxon]
-        for idx, item in enumerate(element):
-            if formatting_keys[idx] == "VAL_INT":
-                new_element.append("%i" % item)
-            elif formatting_keys[idx] == "VAL_FLOAT":
-                new_element.append("%1.2f" % item)
+    INPUTS:
+        taxa -- a numpy vector with greengenes taxonomy strings
 
-            elif formatting_keys[idx] == "VAL_PER" and render_mode == "LATEX":
-                new_element.append("%1.2f\\%%" % item)
+        table_fp -- the location of the table saved as a .npy file, which
+                    is memory mapped by the worker, or the files of a sparse
+                    table, as returned by save_sparse_table.
 
-            elif formatting_keys[idx] == "100_PER" and render_mode == "LATEX":
-                new_element.append("%1.2f\\%%" % (item*100))
+        population_summary -- a dictionary of table-wide statistics, as
+                    returned by summarize_population.
 
-            elif formatting_keys[idx] == "VAL_PER":
-                new_element.append("%1.2f%%" % item)
+        output_dir -- a directory where the final files should be saved.
 
-            elif formatting_keys[idx] == "100_PER":
-                new_element.append("%1.2f%%" % (item*100))
+        correction -- the multiple comparison correction, as described for
+                    calculate_tax_rank_batch
 
-        formatted_taxa.append(new_element)
+        store_format -- the format of the report store, as described for
+                    open_report_store. Only "files" stores are written by the
+                    workers; reports for other stores are held in memory and
+                    returned to the parent process.
 
-    return formatted_taxa
+        writers -- the number of background writer threads for a "files"
+                    store, as described for start_report_writers
+    """
+    # Drops any profile measurements copied from the parent process, so only
+    # the worker's own are sent back
+    take_profile()
+
+    WORKER_STATE['TAXA'] = taxa
+    intern_taxonomy(taxa)
+    if isinstance(table_fp, dict):
+        WORKER_STATE['TABLE'] = load_sparse_table(table_fp)
+    else:
+        WORKER_STATE['TABLE'] = load(table_fp, mmap_mode = 'r')
+    WORKER_STATE['SUMMARY'] = population_summary
+    WORKER_STATE['CORRECTION'] = correction
+    if store_format == 'files':
+        WORKER_STATE['STORE'] = open_report_store(output_dir, 'files')
+        if writers > 0:
+            start_report_writers(WORKER_STATE['STORE'], writers)
+    else:
+        WORKER_STATE['STORE'] = open_report_store(output_dir, 'memory')
 
-def taxa_to_table(corr_taxa, header, render_mode="RAW", numbering = 1):
-    """taxa_to_table takes a set of greengenes strings and corresponding 
-    numeric values and converts them into a string or formatted table.
+def run_report_worker(block):
+    """Creates the reports for a block of samples in a worker process
 
-    INPUTS:
-        corr_taxa -- a python dictonary that relates the green genes taxonomy 
-                    string to the list of corresponding taxonomy values. 
-                    Ideally, these should be strings already formatted for use
-                    in the table.
+    INPUT:
+        block -- a tuple of the table columns and sample ids in the block
 
-        table_header -- a python list of strings that describe the volumns in 
-                    the table. For raw text tables, the width of the columns is
-                    set by the number of entries in the header. RAW tables can
-                    have no more than 5 columns (corresponding to 15 characters
-                    in each column).
+    OUTPUTS:
+        reports -- a list of (sample id, table, list) tuples for the reports
+                    held in memory. The list is empty when the worker saves
+                    the reports itself.
 
-        render_mode -- a string ("LATEX" or "RAW") which describes 
-                    the way the table will be formatted. LATEX or HTML gives a
-                    string containing formatting code. 
-    
-        numbering -- a binary value that will add numbers along the side of the
-                    table if true. Automatically FALSE for TSV rendering.
+        measurements -- the profile measurements for the block, as returned
+                    by take_profile
+    """
+    (columns, sample_ids) = block
+    store = WORKER_STATE['STORE']
+    generate_block_reports(WORKER_STATE['TAXA'], WORKER_STATE['TABLE'], \
+        WORKER_STATE['SUMMARY'], columns, sample_ids, store, \
+        WORKER_STATE['CORRECTION'])
 
-    OUTPUTS:
-        format_table -- a python string formatted to give a table of taxa when
-                    rendered in the program specified by render_mode."""
+    # The worker may be stopped once the block is returned, so its reports
+    # are saved first
+    with profile_stage('write_report_store'):
+        flush_report_store(store)
 
-    # Sets up the constant string designations, describing the phylogentic 
-    # levels 
-    TAX_DES = ['kingdom', 'phylum', 'class', 'order', 'family', \
-    'genus', 'species']
-    
-    if render_mode == "LATEX":
-        format_table = format_latex_table(corr_taxa, header, numbering, TAX_DES)
-    else:
-        format_table = format_raw_table(corr_taxa, header, numbering, TAX_DES)
+    reports = store['REPORTS']
+    store['REPORTS'] = []
 
-    # Returns the formatted table string
-    return format_table
+    return reports, take_profile()
 
-def format_raw_table(corr_taxa, header, numbering, tax_des):
-    """converts a greengenes ids and frequency to a raw text formatted table
+def same_npy_layout(table, saved_table):
+    """Checks whether a memory mapped table covers a whole .npy file
 
     INPUTS:
-        corr_taxa -- a list of lists that relates the green genes 
-                    taxonomy string to the list of corresponding taxonomy 
-                    values. Ideally, these should be strings already formatted 
-                    for use in the table.
+        table -- a numpy memory map, or a view of one
 
-        table_header -- a python list of strings that describe the volumns 
-                    in the table. For raw text tables, the width of the columns 
-                    is set by the number of entries in the header. RAW tables 
-                    can have no more than 5 columns (corresponding to 15 
-                    characters in each column).
+        saved_table -- the .npy file the memory map was opened from, memory
+                    mapped again
 
-        render_mode -- a string ("LATEX", "HTML",  or "RAW") which describes 
-                    the way the table will be formatted. LATEX or HTML gives
-                     a string containing formatting code. 
-    
-        numbering -- a binary value that will add numbers along the side of 
-                        the table if true. Automatically FALSE for TSV 
-                        rendering.
+    OUTPUT:
+        True if the table has the shape, data type and layout of the whole
+        file, so the workers can map the file in its place.
+    """
+    return table.shape == saved_table.shape and \
+        table.dtype == saved_table.dtype and \
+        table.strides == saved_table.strides and \
+        table.offset == saved_table.offset
 
-        tax_des -- a list encoding phylogenetic levels
+def save_sparse_table(table, scratch_dir):
+    """Saves the arrays of a sparse table to scratch files, so worker
+    processes can memory map them
 
-    OUTPUTS:
-        format_table -- a python string formatted to give a table of taxa 
-                    when rendered in the program specified by render_mode.
-        """
+    INPUTS:
+        table -- a scipy sparse matrix in CSC or CSR format
 
+        scratch_dir -- the directory where the scratch files are saved
 
-    # Sets constants
-    HEADER_BAR = "--------------------------------------------------------"\
-                 "-------------------"
-    SPACER = '                                    ' 
-    TAX_SPACE = 27
-    # Category lengths are set up for an 80 character table
-    CATEGORY_LEN_2 = 47
-    CATEGORY_LEN_3 = 23
-    CATEGORY_LEN_4 = 15
-    CATEGORY_LEN_5 = 11
+    OUTPUT:
+        table_files -- a dictionary keyed to the sparse format ("FORMAT"),
+                    the table shape ("SHAPE") and the locations of the .npy
+                    files holding the values ("DATA"), row or column indices
+                    ("INDICES") and index pointers ("INDPTR"). The caller
+                    removes the files.
+    """
+    table_files = {'FORMAT': table.format, 'SHAPE': table.shape}
+    for (key, values) in (('DATA', table.data), ('INDICES', table.indices), \
+        ('INDPTR', table.indptr)):
+        (temp_handle, temp_fp) = mkstemp(prefix = '.table_', \
+            suffix = '.npy', dir = scratch_dir)
+        close(temp_handle)
+        table_files[key] = temp_fp
+        save(temp_fp, values)
 
-    # Initializes the table
-    header_len = len(header)
+    return table_files
 
-    # Sets up the category length based on the number of header categories
-    if header_len == 2:
-        category_len = CATEGORY_LEN_2
-    elif header_len == 3:
-        category_len = CATEGORY_LEN_3
-    elif header_len == 4:
-        category_len = CATEGORY_LEN_4
-    elif header_len == 5:
-        category_len = CATEGORY_LEN_5
-    else:
-        raise ValueError, "There cannot be more than 5 header categories"
+def load_sparse_table(table_files):
+    """Memory maps a sparse table saved by save_sparse_table
 
-    # Creates initial table row
-    if numbering == 1:
-        header_element = ['-----%s\n      ' % HEADER_BAR]
-    else:
-        header_element = ['%s\n' % HEADER_BAR]
+    INPUT:
+        table_files -- a dictionary describing the saved table, as returned
+                    by save_sparse_table
 
-    # Adds the header description
-    for counter, category in enumerate(header):
-        clean_cat = "%s%s" % (category, spacer)
-        if counter == 0:
-            header_element.append('%s' % clean_cat[0:TAX_SPACE])
-        else:
-            header_element.append(clean_cat[0:category_len])
+    OUTPUT:
+        table -- a scipy sparse matrix over the memory mapped arrays
+    """
+    arrays = (load(table_files['DATA'], mmap_mode = 'r'), \
+        load(table_files['INDICES'], mmap_mode = 'r'), \
+        load(table_files['INDPTR'], mmap_mode = 'r'))
 
-    # Terminates the table header
-    if numbering == 1:
-        header_element.append('\n-----%s' % HEADER_BAR)
+    if table_files['FORMAT'] == 'csc':
+        return csc_matrix(arrays, shape = table_files['SHAPE'])
     else:
-        header_element.append('\n%s' % HEADER_BAR)
+        return csr_matrix(arrays, shape = table_files['SHAPE'])
 
-    format_table = [''.join(header_element)]
+def generate_parallel_reports(taxa, table, population_summary, blocks, \
+    store, jobs, correction = 'bonferroni', writers = 0):
+    """Creates the reports for blocks of samples with a pool of processes
 
-    for idx, element in enumerate(corr_taxa):
-        otu = element[0]            
-        otu_values = element[1:]
-        
-        # Cleans up otus for use in the table
-        split_tax = [i.split('__',1)[-1] for i in otu.split('; ')]
-        no_levels = len(split_tax)
-        if no_levels < 7:
-            clean_otu = "%s %s%s" \
-            % (tax_des[no_levels - 1], \
-                split_tax[no_levels - 1], SPACER)
-        elif no_levels == 7:
-            clean_otu = "%s %s%s" \
-            % (split_tax[no_levels - 2], \
-                split_tax[no_levels - 1], SPACER)
-        else:
-            clean_otu = "kingdom %s phylum Other%s" \
-                % (split_tax, SPACER)
-        
-        # Sets up the first column
-        if numbering == 1 and count < 10:
-            table_row = ['\n ( %d) %s' % (count, clean_otu[0:27])]
-        elif numbering == 1:
-            table_row = ['\n (%d) %s' % (count, clean_otu[0:TAX_SPACE])]
-        else:
-            table_row = ['\n%s' % (clean_otu[0:TAX_SPACE])]
-        
-        # Adds row information to the table
-        for value in otu_values:
-            val_expand = "%s%s" % (value, SPACER)
-            table_row.append("\t%s" % (val_expand[0:(category_len)]))
-        
-        table_row = ''.join(table_row)   
-        format_table.append(table_row)
+    INPUTS:
+        taxa, table, population_summary, store, correction -- as
+                    described for generate_block_reports
 
-    # Terminates the table
-    if numbering == 1:
-        format_table.append('\n-----%s' % HEADER_BAR)
-    else:
-        format_table.append('\n%s' % HEADER_BAR)
+        blocks -- a list of tuples of the table columns and sample ids in
+                    each block
 
-    format_table = ''.join(format_table)
+        jobs -- the number of worker processes
 
-    return format_table
+        writers -- the number of background writer threads in each worker,
+                    as described for start_report_writers
+
+    OUTPUTS:
+        A table and list are saved for each sample, as described for
+        write_report_store.
+    """
+    # Workers memory map the table. A table which is already memory mapped
+    # from a whole .npy file, such as the taxonomy cache, is used in place;
+    # otherwise it is saved to scratch files in the output directory. The
+    # arrays of a sparse table are saved separately.
+    table_fp = getattr(table, 'filename', None)
+    temp_fps = []
+    if issparse(table):
+        if table.format not in ('csc', 'csr'):
+            table = table.tocsc()
+        table_fp = save_sparse_table(table, store['OUTPUT_DIR'])
+        temp_fps = [table_fp['DATA'], table_fp['INDICES'], table_fp['INDPTR']]
+    elif not isinstance(table, memmap) or table_fp is None or \
+        not table_fp.endswith('.npy') or \
+        not same_npy_layout(table, load(table_fp, mmap_mode = 'r')):
+        (temp_handle, table_fp) = mkstemp(prefix = '.table_', \
+            suffix = '.npy', dir = store['OUTPUT_DIR'])
+        close(temp_handle)
+        temp_fps = [table_fp]
+        save(table_fp, table)
+
+    pool = Pool(jobs, init_report_worker, (taxa, table_fp, \
+        population_summary, store['OUTPUT_DIR'], correction, store['FORMAT'], \
+        writers))
+    try:
+        # Reports the workers cannot save themselves are saved in order
+        for (reports, measurements) in pool.imap(run_report_worker, blocks, 1):
+            merge_profile(measurements)
+            for (sample_id, high_formatted, rare_formatted) in reports:
+                write_report_store(store, sample_id, high_formatted, \
+                    rare_formatted)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for temp_fp in temp_fps:
+            remove(temp_fp)
+
+def population_fingerprint(taxa, population_summary):
+    """Summarizes the population the sample reports are compared against
 
-def format_latex_table(corr_taxa, header, numbering, tax_des):
-    """converts a greengenes ids and frequency to a raw text formatted table
-    
     INPUTS:
-        corr_taxa -- a python dictonary that relates the green genes 
-                    taxonomy string to the list of corresponding taxonomy 
-                    values. Ideally, these should be strings already formatted 
-                    for use in the table.
+        taxa -- a numpy vector with greengenes taxonomy strings
 
-        table_header -- a python list of strings that describe the volumns 
-                    in the table. For raw text tables, the width of the columns 
-                    is set by the number of entries in the header. RAW tables 
-                    can have no more than 5 columns (corresponding to 15 
-                    characters in each column).
+        population_summary -- a dictionary of table-wide statistics, as
+                    returned by summarize_population.
 
-        render_mode -- a string ("LATEX", "HTML",  or "RAW") which describes 
-                    the way the table will be formatted. LATEX or HTML gives
-                    a string containing formatting code. 
-    
-        numbering -- a binary value that will add numbers along the side of 
-                    the table if true. Automatically FALSE for TSV 
-                    rendering.
+    OUTPUT:
+        fingerprint -- a dictionary keyed to a sha1 hash of the taxonomy
+                    strings ("TAXA"), and lists of the mean frequency ("MEAN")
+                    and fraction of samples containing ("PREVALENCE") each
+                    taxon.
+    """
+    num_samples = float(population_summary['NUM_SAMPLES'])
 
-        tax_des -- a list encoding phylogenetic levels
+    return {'TAXA': sha1('\n'.join(taxa)).hexdigest(),
+            'MEAN': population_summary['CENTER'].tolist(),
+            'PREVALENCE': (population_summary['COUNT']/num_samples).tolist()}
 
-    OUTPUTS:
-        format_table -- a python string formatted to give a table of taxa 
-                        when rendered in the program specified by render_mode.
-        """
+def population_drift(fingerprint, previous):
+    """Measures how far the population has moved from a previous fingerprint
 
+    INPUTS:
+        fingerprint, previous -- population fingerprints, as returned by
+                    population_fingerprint
 
-    # Initializes the table
-    if numbering == 1:
-        format_elements = ["{r"]
-        header_elements = [" & "]
-    else:
-        format_elements = ["{"]
-        header_elements = [""]
+    OUTPUT:
+        drift -- the largest change in the mean frequency or prevalence of
+                    any taxon. If the taxa differ, the drift is infinite.
+    """
+    if fingerprint['TAXA'] != previous['TAXA']:
+        return inf
 
-    # Creates formatting designation and the header
-    for category in header: 
-        format_elements.append(" c")
-        header_elements.append("%s & " % category)
+    drift = 0.0
+    for key in ('MEAN', 'PREVALENCE'):
+        difference = abs(array(fingerprint[key]) - array(previous[key]))
+        if len(difference) > 0:
+            drift = max(drift, difference.max())
 
-    format_elements.append("}")        
-    format_code = ''.join(format_elements)
-    header_code = ''.join(header_elements)
-    header_code = header_code[0:(len(header_code)-3)]
-    # Sets up the intialization code
-    format_table = ["\\begin{tabular}%s\n\\hline\n%s \\\\ \n\\hline\n" \
-        %(format_code, header_code)]
+    return drift
 
-    for idx, element in enumerate(corr_taxa):
-        count = idx + 1
-        otu = element[0]
-        otu_values = element[1:]            
-            
-        # Cleans up the otu for use in the table
-        split_tax = [i.split('__',1)[-1] for i in otu.strip().split('; ')]
-        for id_, level in enumerate(split_tax):
-            if level != '':                
-                no_levels = id_
-
-        if no_levels < 6:
-            clean_otu = "%s %s" % (tax_des[no_levels - 1],  \
-                split_tax[no_levels - 1])
-
-        elif no_levels == 6:
-            clean_otu = "%s \\textit{%s}" % (tax_des[no_levels - 1], \
-                split_tax[no_levels - 1])
-            
-        elif no_levels == 7:
-            clean_otu = "\\textit{%s %s}" \
-            % (split_tax[no_levels - 2], \
-               split_tax[no_levels - 1])
-            
-        else:
-            clean_otu = "kingdom \\textit{%s} phylum Other" \
-            % split_tax
+def sample_column_hashes(table, columns, block_size = 500):
+    """Hashes the table values of each sample
 
-        # Sets up the table entry
-        table_row = []
-        if numbering == 1 and count < 10:
-            table_row.append("( %d) & %s" % (count, clean_otu))
-            
-        elif numbering == 1:
-            table_row.append("(%d) & %s" % (count, clean_otu))
-            
-        else:
-            table_row.append("%s" % clean_otu)
-            
-        # Adds numeric data to the table
-        for value in otu_values:table_row.append(" & %s" % value)
-                
-        # Appends to create a line break
-        table_row.append("\\\\\n")
+    INPUTS:
+        table -- a numpy array with the relative frequencies of taxonomies
+                    (rows) for each sample (column). This may be a memory
+                    mapped array.
 
-        format_table.append(''.join(table_row))
+        columns -- a list of the table columns to hash
 
-    # Terminate the table
-    format_table.append('\\hline\n\\end{tabular}')
+        block_size -- the number of columns read from the table at a time
 
-    format_table = ''.join(format_table)
+    OUTPUT:
+        column_hashes -- a list of the sha1 hash of each column
+    """
+    column_hashes = []
+    for start in range(0, len(columns), block_size):
+        block = array(dense_columns(table, \
+            columns[start:(start + block_size)]).T, order = 'C')
+        for column in block:
+            column_hashes.append(sha1(column).hexdigest())
 
-    return format_table
+    return column_hashes
 
-def render_latex_list(raw_taxa, tax_format, tax_des):
-    """Creates a series of items for a LaTex encoded list
-    INPUTS:
-        raw_taxa -- a python list object containing taxonomy strings from 
-                        greengenes to be included in the final, formated output.
+def load_report_manifest(output_dir):
+    """Loads the manifest left in the output directory by a previous run
 
-        tax_format -- a list specifiying if an argument should be bolded 
-                    (denoted by "BOLD") or left alone ("REG")
+    INPUT:
+        output_dir -- the directory holding the reports
 
-    OUTPUTS:
-        format_list_items -- Latex encoded list items"""
-    
-    format_list_items = []       
+    OUTPUT:
+        manifest -- the manifest, as described for find_stale_samples, or
+                    None if there is no manifest.
+    """
+    manifest_fp = join(output_dir, REPORT_MANIFEST)
+    if not isfile(manifest_fp):
+        return None
 
-    format_list_items = []
+    manifest_file = open(manifest_fp)
+    manifest = load_json(manifest_file)
+    manifest_file.close()
 
-    for (idx, element) in enumerate(raw_taxa):
-        split_tax = [i.split('__',1)[-1] for i in element.strip().split('; ')]
-        for id_, level in enumerate(split_tax):
-            if level != '':                
-                no_levels = id_
-        list_item = ['\n\\item ']           
-        if tax_format[idx] == 'BOLD':
-            if no_levels < 6:
-                list_item.append("\\textbf{%s %s}" % (tax_des[no_levels], \
-                    split_tax[no_levels]))
-            elif no_levels == 6:
-                list_item.append("\\textbf{%s \\textit{%s}}" \
-                    % (tax_des[no_levels], \
-                    split_tax[no_levels]))
-            elif no_levels == 7:
-                list_item.append("\\textbf{\\textit{%s %s}}" \
-                    % (split_tax[no_levels - 1], \
-                    split_tax[no_levels]))
-            elif no_levels > 7:
-                list_item.append("\\textbf{kingdom %s}" \
-                    % split_tax)
+    return manifest
 
-        else:
-            if no_levels < 6:
-                list_item.append("%s %s" % (tax_des[no_levels], \
-                    split_tax[no_levels]))
-            elif no_levels == 6:
-                list_item.append("%s \\textit{%s}" \
-                    % (tax_des[no_levels], \
-                    split_tax[no_levels]))
-            elif no_levels == 7:
-                list_item.append("\\textit{%s %s}" \
-                    % (split_tax[no_levels - 1], \
-                    split_tax[no_levels]))
-            elif no_levels > 7:
-                list_item.append("kingdom %s" % split_tax)
-        
-        list_item = ''.join(list_item)
-        list_item = list_item.strip('[').strip(']')
-        format_list_items.append(list_item)
+def save_report_manifest(output_dir, manifest):
+    """Saves the manifest of the reports in the output directory
 
-    format_list_items = ''.join(format_list_items)
+    INPUTS:
+        output_dir -- the directory holding the reports
+
+        manifest -- the manifest, as described for find_stale_samples
+    """
+    manifest_file = open(join(output_dir, REPORT_MANIFEST), 'w')
+    dump_json(manifest, manifest_file)
+    manifest_file.close()
+
+def find_stale_samples(manifest, fingerprint, correction, store_format, \
+    sample_ids, column_hashes, drift_tolerance):
+    """Works out which sample reports need to be regenerated
+
+    Every report is regenerated when there is no manifest, the report
+    version, correction, store format or taxa have changed, or the
+    population has drifted further than the tolerance from the population
+    of the last full run. This includes the reports of samples recorded by
+    earlier runs which are not in sample_ids, which are returned with the
+    previous manifest. Otherwise, only samples which are new or whose
+    values have changed are regenerated.
 
-    return format_list_items
-   
-def render_raw_list(raw_taxa, tax_format, tax_des):
-    """Creates a series of items for a raw text list
     INPUTS:
-        raw_taxa -- a python list object containing taxonomy strings from 
-                    greengenes to be included in the final, formated output.
+        manifest -- the manifest from the previous run, as returned by
+                    load_report_manifest. This is a dictionary keyed to the
+                    REPORT_VERSION of the reports ("VERSION", missing from
+                    manifests written before it was recorded), the
+                    population fingerprint of the last full run
+                    ("POPULATION"), the correction ("CORRECTION"), the store
+                    format ("STORE") and a dictionary relating each reported
+                    sample id to its column hash ("SAMPLES").
 
-        tax_format -- a list specifiying if an argument should be bolded 
-                    (denoted by "BOLD") or left alone ("REG")
+        fingerprint -- the current population fingerprint, as returned by
+                    population_fingerprint
 
-    OUTPUTS:
-        format_list_items -- raw text encoded list items"""
+        correction, store_format -- the correction and store format for this
+                    run
 
-    format_list_items = []
+        sample_ids -- a list of the sample ids being reported
 
-    for idx, element in enumerate(raw_taxa):
-        split_tax = [i.split('__',1)[-1] for i in element.strip().split('; ')]
-        for id_, level in enumerate(split_tax):
-            if level != '':                
-                no_levels = id_
-
-        list_item = ['\n     o  ']
-        if tax_format(idx) == 'BOLD':
-            if no_levels < 7:
-                list_item.append("*%s %s*" \
-                    % (tax_des[no_levels - 1], \
-                    split_tax[no_levels - 1]))
-            elif no_levels == 7:
-                list_item.append("*%s %s*" \
-                    % (split_tax[no_levels - 2], \
-                        split_tax[no_levels - 1]))
-            else:
-                list_item.append("*kingdom %s*" \
-                    % split_tax)
-        else:
-            if no_levels < 7:
-                list_item.append("%s %s" % (tax_des[no_levels - 1], \
-                        split_tax[no_levels - 1]))
-            elif no_levels == 7:
-                list_item.append("%s %s" \
-                    % (split_tax[no_levels - 2], \
-                    split_tax[no_levels - 1]))
-            else:
-                list_item.append("kingdom %s" \
-                    % split_tax)
-            
-        list_item = ''.join(list_item)    
-        format_list_items.append(list_item)
+        column_hashes -- a list of the column hash for each sample, as
+                    returned by sample_column_hashes
 
-    format_list_items = ''.join(format_list_items)
+        drift_tolerance -- the largest population drift, as measured by
+                    population_drift, allowed before every report is
+                    regenerated
 
-    return format_list_items
+    OUTPUTS:
+        stale -- a list of the positions in sample_ids to regenerate
 
-def taxa_to_list(raw_taxa, tax_format, render_mode="RAW"):
-    """taxa_to_list takes a list of greengenes taxonomy strings and converts
-    it to a text string that can be printed to a document.
+        manifest -- the manifest to update with the regenerated samples
 
-    INPUTS:
-        raw_taxa -- a python list object containing taxonomy strings from 
-                    greengenes to be included in the final, formated output.
+        reset -- the previous manifest when every report is out of date, so
+                    the reports it records can be regenerated or removed, or
+                    None.
+    """
+    if manifest is None:
+        reset = None
+    elif manifest.get('VERSION') != REPORT_VERSION or \
+        manifest['CORRECTION'] != correction or \
+        manifest['STORE'] != store_format or \
+        population_drift(fingerprint, manifest['POPULATION']) > \
+        drift_tolerance:
+        reset = manifest
+    else:
+        previous_hashes = manifest['SAMPLES']
+        stale = []
+        for idx, sample_id in enumerate(sample_ids):
+            if previous_hashes.get(sample_id) != column_hashes[idx]:
+                stale.append(idx)
 
-        tax_format -- a list specifiying if an argument should be bolded 
-                        (denoted by "BOLD") or left alone ("REG")
+        return stale, manifest, None
 
-        render_mode -- a python string describing the way the out should be 
-                    formatted. Options are LATEX, corresponding to LaTex code,
-                    HTML, or RAW. LaTEX or HTML will give a string of code for
-                    inclusion in the corresponding document. RAW will give a 
-                    text file suitable for viewing, although RAW formats do not
-                    include italics.
-    
-    OUTPUTS:
-        format_list -- a python string formatted to give a list of taxa 
-                    according to the supplied formatting mode."""
+    manifest = {'VERSION': REPORT_VERSION,
+                'POPULATION': fingerprint,
+                'CORRECTION': correction,
+                'STORE': store_format,
+                'SAMPLES': {}}
 
-    # Sets up the constant string designations, describing the phylogentic levels 
-    TAX_DES = ['kingdom', 'phylum', 'class', 'order', 'family',\
-    'genus', 'species']
+    return range(len(sample_ids)), manifest, reset
 
-    # Sets up precurser formatting text
-    if render_mode == "LATEX":
-        format_list = ["\\begin{itemize}"]
-        format_list.append(render_latex_list(raw_taxa, tax_format, TAX_DES))
-        format_list.append('\n\\end{itemize}')
+def remove_sample_reports(output_dir, store_format, sample_ids):
+    """Deletes the reports of samples which are no longer current
 
-    else:
-        format_list = []
-        format_list.append(render_raw_list(raw_taxa, tax_format, TAX_DES))
-        format_list.append('\n')
+    INPUTS:
+        output_dir -- the directory holding the reports
 
-    format_list = ''.join(format_list)
+        store_format -- the format of the store holding the reports, as
+                    described for open_report_store. A "zip" archive is
+                    removed as a whole.
 
-    # Returns formatted string
-    return format_list
+        sample_ids -- a list of the sample ids whose reports are deleted
+    """
+    if store_format == 'zip':
+        archive_fp = join(output_dir, REPORT_ARCHIVE)
+        if isfile(archive_fp):
+            remove(archive_fp)
+        return
+
+    for sample_id in sample_ids:
+        for name in report_names(sample_id):
+            report_fp = join(output_dir, name)
+            if isfile(report_fp):
+                remove(report_fp)
 
 def generate_otu_signifigance_tables_AGP(taxa, table, samples, output_dir, \
-    sample_ids = None):
+    sample_ids = None, block_size = 500, jobs = 1, sample_index = None, \
+    correction = 'bonferroni', store_format = 'files', incremental = False, \
+    drift_tolerance = 0.001, writers = 0, population_summary = None):
     """Creates LaTeX formatted significant OTU lists
 
     INPUTS:
         taxa -- a numpy vector with greengenes taxonomy strings
 
         tax_table -- a numpy array with the relative frequencies of taxonomies
-            (rows) for each give sample (column)
+            (rows) for each give sample (column). This may be a scipy sparse
+            matrix, in which case only one block of samples at a time is
+            made dense.
 
         sample_ids -- a numpy vector of sample ids associated with the 
             tax_table values
@@ -632,6 +2839,47 @@ def generate_otu_signifigance_tables_AGP(taxa, table, samples, output_dir, \
                     data. If this is left empty, all the samples in the table 
                     will be used.
 
+        block_size -- the number of samples whose statistics are calculated
+                    together. Memory use grows with the block size, not the
+                    number of samples, so a memory mapped table larger than
+                    the available memory can be used.
+
+        jobs -- the number of processes used to generate the reports. The
+                    processes read the table from a memory map rather than
+                    each receiving a copy.
+
+        sample_index -- a dictionary keying sample ids to table columns, as
+                    returned by build_sample_index. If no value is passed,
+                    the index is built from samples.
+
+        correction -- the method used to correct p values for multiple
+                    comparisons, as described for calculate_tax_rank_batch.
+
+        store_format -- "files" to save a table and list file for each
+                    sample, or "zip" to bundle the same files into a single
+                    archive (reports.zip) in the output directory. Reports
+                    can be fetched with read_report_store.
+
+        incremental -- only regenerates the reports of samples which are new
+                    or have changed since the last incremental run into the
+                    output directory, as described for find_stale_samples.
+                    The runs are recorded in report_manifest.json.
+
+        drift_tolerance -- the largest change in the mean frequency or
+                    prevalence of any taxon allowed in an incremental run
+                    before every report is regenerated.
+
+        writers -- the number of background threads saving the reports
+                    while the next samples are calculated, as described for
+                    start_report_writers. If no writers are used, each
+                    report is saved before the next sample is calculated.
+
+        population_summary -- the statistics of the population the samples
+                    are compared to. This may be a reference profile, as
+                    returned by load_reference_profile and lined up with the
+                    table by align_to_reference. If no value is passed, each
+                    sample is compared to the rest of the table.
+
     OUTPUTS:
         Generates text files containing LaTex encoded strings which creates a 
         formatted table of taxa enriched in a single sample 
@@ -639,76 +2887,118 @@ def generate_otu_signifigance_tables_AGP(taxa, table, samples, output_dir, \
         (List_<SAMPLE_ID>). Rare defined as present in less than 10% of the 
         total population. The unique taxa are bolded in the lists. 
     """
-    # Sets table constants
-    RENDERING = "LATEX"
-    FORMAT_KEYS = ["100_PER", "100_PER", "VAL_INT", "SKIP"]
-    TABLE_HEADER = ['Taxonomy', 'Sample', 'Population', 'Fold Difference']
-    # Number of taxa shown is an indexing value, it is one less than what is 
-    # actually shown.
-    NUMBER_OF_TAXA_SHOWN = 4
-
-    # Checks the output directory is sane
-
     # Sets up samples for which tables are being generated
     if sample_ids == None:
         samples_to_test = samples
     else:
         samples_to_test = sample_ids
 
-    for idx, sample_id in enumerate(samples_to_test):
-        # Sets up the sample and population sets
-        population = delete(table, idx, 1)
-        sample = table[:,idx]
-
-
-        # Calculates tax rank tables
-        (unique, rare, low, high) = calculate_tax_rank_1(sample, population, \
-            taxa)
-
-        # Generates formatted table
-        formatted_high = convert_taxa(high[0:NUMBER_OF_TAXA_SHOWN], \
-            render_mode = RENDERING, formatting_keys = FORMAT_KEYS)
-        high_formatted = taxa_to_table(formatted_high, TABLE_HEADER, \
-            render_mode = RENDERING)
-
-        # Generates formatted list
-        rare_format = []
-        rare_combined = []
-        for taxon in unique:
-            rare_combined.append(taxon)
-            rare_format.append('BOLD')
-        for taxon in rare:
-            rare_combined.append(taxon)
-            rare_format.append('REG')
-
-        number_rare_tax = len(rare_combined)
-
-        if number_rare_tax > NUMBER_OF_TAXA_SHOWN + 1:
-            rare_formatted = ["This sample contained %i rare or unique taxa,"\
-                              " including the following.\\\n" % number_rare_tax]
-            rare_formatted.append(taxa_to_list(\
-                rare_combined[:NUMBER_OF_TAXA_SHOWN ], rare_format, RENDERING))
-            rare_formatted = ''.join(rare_formatted)
-    
-        elif number_rare_tax > 0:
-            rare_formatted = taxa_to_list(rare_combined, rare_format, \
-                RENDERING)
-
+    # Finds the table column for each sample
+    if sample_index is None:
+        sample_index = build_sample_index(samples)
+    columns_to_test = find_sample_columns(samples_to_test, sample_index)
+
+    # Sparse tables are read a block of columns at a time, which is fastest
+    # in column order
+    if issparse(table):
+        table = table.tocsc()
+
+    # Summarizes the whole table once. Each sample is then compared to the
+    # population with its own column removed from the summary.
+    if population_summary is None:
+        with profile_stage('summarize_population'):
+            population_summary = summarize_population(table, block_size)
+
+    # Skips the samples whose reports are still current
+    keep_samples = None
+    if incremental:
+        with profile_stage('find_stale_samples'):
+            column_hashes = sample_column_hashes(table, columns_to_test, \
+                block_size)
+            (stale, manifest, reset) = find_stale_samples( \
+                load_report_manifest(output_dir), \
+                population_fingerprint(taxa, population_summary), \
+                correction, store_format, samples_to_test, column_hashes, \
+                drift_tolerance)
+
+        # Reports from earlier runs are out of date as well. Samples still in
+        # the table are regenerated; the reports of the others are deleted.
+        if reset is not None:
+            requested = set(samples_to_test)
+            previous_ids = [sample_id for sample_id in reset['SAMPLES'] \
+                if sample_id not in requested]
+            regenerate_ids = [sample_id for sample_id in previous_ids \
+                if sample_id in sample_index]
+            dropped_ids = [sample_id for sample_id in previous_ids \
+                if sample_id not in sample_index]
+
+            if reset['STORE'] != store_format:
+                remove_sample_reports(output_dir, reset['STORE'], \
+                    reset['SAMPLES'].keys())
+            elif store_format == 'files':
+                remove_sample_reports(output_dir, store_format, dropped_ids)
+
+            regenerate_columns = find_sample_columns(regenerate_ids, \
+                sample_index)
+            stale.extend(range(len(samples_to_test), \
+                len(samples_to_test) + len(regenerate_ids)))
+            samples_to_test = list(samples_to_test) + regenerate_ids
+            columns_to_test = list(columns_to_test) + regenerate_columns
+            column_hashes.extend(sample_column_hashes(table, \
+                regenerate_columns, block_size))
+
+        for idx in stale:
+            manifest['SAMPLES'][samples_to_test[idx]] = column_hashes[idx]
+        stale_ids = set([samples_to_test[idx] for idx in stale])
+        keep_samples = [sample_id for sample_id in manifest['SAMPLES'] \
+            if sample_id not in stale_ids]
+
+        samples_to_test = [samples_to_test[idx] for idx in stale]
+        columns_to_test = [columns_to_test[idx] for idx in stale]
+
+    num_to_test = len(samples_to_test)
+
+    # Splits the samples into blocks, using smaller blocks if they are needed
+    # to keep every process busy
+    if jobs > 1:
+        block_size = min(block_size, max(1, -(-num_to_test // jobs)))
+
+    blocks = []
+    for start in range(0, num_to_test, block_size):
+        end = min(start + block_size, num_to_test)
+        blocks.append((columns_to_test[start:end], \
+            samples_to_test[start:end]))
+
+    # Outside incremental runs, the reports of other samples are left in
+    # place, whichever store is used
+    if incremental:
+        replace_samples = None
+    else:
+        replace_samples = samples_to_test
+    store = open_report_store(output_dir, store_format, \
+        keep_samples = keep_samples, replace_samples = replace_samples)
+    try:
+        # The workers save the files of a "files" store themselves, so the
+        # writers are only needed here for the reports they send back
+        if writers > 0 and (jobs <= 1 or store_format != 'files'):
+            start_report_writers(store, writers)
+        if jobs > 1:
+            generate_parallel_reports(taxa, table, population_summary, \
+                blocks, store, jobs, correction, writers)
         else:
-            rare_formatted = "There were no rare or unique samples found"\
-                         " in this sample."
-
-        # Saves the file
-        file_table_name = "%s/Table_%s.txt" % (output_dir, sample_id)
-        file_list_name = "%s/List_%s.txt" % (output_dir, sample_id)
-
-        file_table = open(file_table_name, 'w')
-        file_table.write(high_formatted)
-        file_table.close()
+            for (columns, block_ids) in blocks:
+                generate_block_reports(taxa, table, population_summary, \
+                    columns, block_ids, store, correction)
+    except:
+        with profile_stage('close_report_store'):
+            close_report_store(store, raise_errors = False)
+        raise
+    else:
+        with profile_stage('close_report_store'):
+            close_report_store(store)
 
-        file_list = open(file_list_name, 'w')
-        file_list.write(rare_formatted)
-        file_list.close()
+    if incremental:
+        save_report_manifest(output_dir, manifest)
 
 #american_gut_fp = "/Users/jwdebelius/Desktop/FecesSplit/L6.txt"
 #output_dir = "/Users/jwdebelius/Desktop/TestOut/"
@@ -720,32 +3010,129 @@ def generate_otu_signifigance_tables_AGP(taxa, table, samples, output_dir, \
 parser = ArgumentParser(description = "Creates LaTeX formatted significant '\
                         'OTU lists and tables")
 
-parser.add_argument('-i', '--input', help = 'Path to taxonomy table [REQUIRED]')
+parser.add_argument('-i', '--input', help = 'Path to taxonomy table. This may '\
+                    'be a tab delimited text file or a JSON or HDF5 BIOM '\
+                    'table. [REQUIRED]')
+parser.add_argument('-l', '--level', type = int, default = 6, \
+                    help = 'Taxonomic level a BIOM table is collapsed to, '\
+                    'from 1 (kingdom) to 7 (species). [default: '\
+                    '%(default)s]')
 parser.add_argument('-o', '--output', \
                     help = 'Path to the output directory [REQUIRED]')
 parser.add_argument('-s', '--samples', default = None, \
                     help = 'Sample IDs to be analyzed. If no value is '\
                     'specified, all samples in the taxonomy file will be'\
                     ' analyzed.')
+parser.add_argument('--cache', action = 'store_true', default = False, \
+                    help = 'Keeps a binary copy of the parsed taxonomy table '\
+                    'next to the input, which is reused while the input is '\
+                    'unchanged.')
+parser.add_argument('--sparse', action = 'store_true', default = False, \
+                    help = 'Holds the taxonomy table as a sparse matrix, '\
+                    'keeping only the nonzero frequencies. This cannot be '\
+                    'combined with --cache. BIOM tables are always held as '\
+                    'sparse matrices.')
+parser.add_argument('-b', '--block_size', type = int, default = 500, \
+                    help = 'Number of samples whose statistics are '\
+                    'calculated at a time. Smaller blocks use less memory; '\
+                    'combined with --cache, the table is read from a memory '\
+                    'map one block at a time. [default: %(default)s]')
+parser.add_argument('-j', '--jobs', type = int, default = 1, \
+                    help = 'Number of processes used to generate the '\
+                    'reports. [default: %(default)s]')
+parser.add_argument('--correction', default = 'bonferroni', \
+                    choices = CORRECTION_METHODS, \
+                    help = 'Multiple comparison correction applied to the '\
+                    'p values. Each is scaled by the number of tested taxa; '\
+                    'bonferroni_samples scales by the number of population '\
+                    'samples, as in earlier reports. [default: %(default)s]')
+parser.add_argument('--incremental', action = 'store_true', \
+                    default = False, \
+                    help = 'Only regenerates the reports of samples which '\
+                    'are new or have changed since the last incremental run '\
+                    'into the output directory.')
+parser.add_argument('--drift_tolerance', type = float, default = 0.001, \
+                    help = 'Largest change in the mean frequency or '\
+                    'prevalence of any taxon allowed in an incremental run '\
+                    'before every report is regenerated. '\
+                    '[default: %(default)s]')
+parser.add_argument('--writers', type = int, default = 0, \
+                    help = 'Number of background threads saving the reports '\
+                    'while the next samples are calculated. With 0, each '\
+                    'report is saved before moving on. [default: '\
+                    '%(default)s]')
+parser.add_argument('--profile', default = None, \
+                    help = 'Path to a JSON file where the wall time, calls '\
+                    'and peak memory of each stage and the per-sample '\
+                    'latencies are saved when the run finishes.')
+parser.add_argument('--build_reference', default = None, \
+                    help = 'Saves the statistics of the input table as a '\
+                    'reference profile (.npz) at this path. If no output '\
+                    'directory is given, no reports are generated.')
+parser.add_argument('--reference', default = None, \
+                    help = 'Path to a reference profile built with '\
+                    '--build_reference. Samples are compared to the '\
+                    'reference population instead of the rest of the '\
+                    'input table.')
+parser.add_argument('--store', default = 'files', \
+                    choices = REPORT_STORE_FORMATS, \
+                    help = 'Saves a table and list file for each sample '\
+                    '(files) or bundles them into a single reports.zip '\
+                    'archive (zip). [default: %(default)s]')
 
 if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.profile:
+        start_profile(args.profile)
+
     # Checks the tax table file path is sane and loads it.
     if not args.input:
         parser.error('An input taxonomy table is required')
     elif not isfile(args.input):
         raise ValueError, "The supplied taxonomy file does not exist in the path."
+    elif is_biom_file(args.input):
+        if args.cache:
+            parser.error('--cache can only be used with text taxonomy tables')
+        with profile_stage('load_table'):
+            (taxa, table, sample_ids) = biom_importer(args.input, args.level)
+    elif args.cache and args.sparse:
+        parser.error('--sparse cannot be combined with --cache')
+    elif args.cache:
+        with profile_stage('load_table'):
+            (taxa, table, sample_ids) = cached_taxa_importer(args.input)
     else:
-        (taxa, table, sample_ids) = taxa_importer(args.input)
+        with profile_stage('load_table'):
+            (taxa, table, sample_ids) = taxa_importer(args.input, \
+                sparse = args.sparse)
+
+    sample_index = build_sample_index(sample_ids)
+
+    # Saves or loads the reference profile. A profile built from this table
+    # is also the summary the reports are compared to, so it is only
+    # calculated once.
+    population_summary = None
+    if args.build_reference:
+        with profile_stage('summarize_population'):
+            population_summary = summarize_population(table, args.block_size)
+        save_reference_profile(args.build_reference, taxa, population_summary)
+        if not args.output:
+            parser.exit()
+
+    if args.reference:
+        with profile_stage('load_reference_profile'):
+            (reference_taxa, population_summary) = \
+                load_reference_profile(args.reference)
+            (taxa, table, population_summary) = align_to_reference(taxa, \
+                table, reference_taxa, population_summary)
 
     # Checks the output directory is sane.
     if not args.output:
         parser.error('An output directory must be supplied.')
     elif not exists(args.output):
         mkdir(args.output)
-        output_dir = args.output
+    output_dir = args.output
 
     if output_dir[-1] != "/":
         temp_dir_name = [output_dir]
@@ -762,4 +3149,9 @@ if __name__ == '__main__':
 
     generate_otu_signifigance_tables_AGP(taxa = taxa, table = table, \
         samples = sample_ids, output_dir = output_dir, \
-        sample_ids = samples_to_analyze)
+        sample_ids = samples_to_analyze, block_size = args.block_size, \
+        jobs = args.jobs, sample_index = sample_index, \
+        correction = args.correction, store_format = args.store, \
+        incremental = args.incremental, \
+        drift_tolerance = args.drift_tolerance, writers = args.writers, \
+        population_summary = population_summary)
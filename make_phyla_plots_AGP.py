@@ -1,15 +1,16 @@
 #!/usr/bin/env python
 
-from matplotlib import use
-use('agg')
 from os.path import isfile, exists
 from os import mkdir
-from biom.parse import parse_biom_table, table_factory
-from os.path import (exists, isfile)
-from numpy import array, zeros, mean, arange, shape, ones
-import matplotlib.pyplot as plt
-from matplotlib.transforms import Bbox
+from sys import modules
+from multiprocessing import Pool
+from xml.sax.saxutils import escape
+from biom.parse import parse_biom_table
+from numpy import array, zeros, mean, arange, cumsum
 from argparse import ArgumentParser
+from timeit import default_timer
+from pipeline_profile import (start_profile, profile_stage, \
+                              record_sample_time, take_profile, merge_profile)
 
 __author__ = "Justine Debelius"
 __copyright__ = "Copyright 2013, The American Gut Project"
@@ -19,6 +20,58 @@ __version__ = "unversioned"
 __maintainer__ = "Justine Debelius"
 __email__ = "Justine.Debelius@colorado.edu"
 
+# Sets the layout of the stacked taxonomy plots
+# Colormap is taken from the colorbrewer    
+COLORMAP = array([[0.8353, 0.2421, 0.3098],
+                  [0.9569, 0.4275, 0.2627],
+                  [0.9922, 0.6824, 0.3804],
+                  [0.9961, 0.8784, 0.5351],
+                  [0.9020, 0.9608, 0.5961],
+                  [0.6706, 0.8667, 0.6431],
+                  [0.4000, 0.7608, 0.6471],
+                  [0.1961, 0.5333, 0.7412],
+                  [0.3333, 0.3333, 0.3333]])
+FIGURE_SIZE = (8, 5)
+
+X_TICK_OFFSET = 0.6
+
+BAR_WIDTH = 0.8
+
+AXIS_DIMENSIONS = array([[0.1538, 0.4000],
+                         [0.6923, 0.9000]])
+
+X_MIN = -0.5
+X_TICK_INTERVAL = 1.0
+
+Y_MIN = 0
+Y_MAX = 1.0
+Y_TICK_INTERVAL = 0.2
+
+TICK_FONT_SIZE = 15
+LABEL_FONT_SIZE = 20
+
+# Sets the shape of the plotting arrays: a row for each phylum in the
+# colormap, and a bar for the sample, the average sample, up to three
+# metadata groups and the Michael Pollan sample. The plotting workers
+# build their figures to the same shape.
+NUM_TAXA = 9
+NUM_CATS_TO_PLOT = 6
+
+# Holds the figure drawn for the last plot layout, so it can be reused for
+# the next sample
+PHYLA_FIGURE = {}
+
+# Holds the legend labels and output settings in a plotting worker process
+PLOT_WORKER = {}
+
+# Sets the output file names and the formats the figures can be saved in
+FILEPREFIX = 'Figure_4_'
+PLOT_FORMATS = ('pdf', 'png', 'svg')
+
+# Sets the libraries which can draw the figures. The svg renderer writes
+# the figure without matplotlib.
+PLOT_RENDERERS = ('matplotlib', 'svg')
+
 def map_to_2D_dict(mapping_data):
     """ Converts mapping file to 2D dictionary
 
@@ -245,76 +298,63 @@ def summarize_human_taxa(otu_table, level):
 
     return common_taxa, sample_ids, tax_summary
 
-def plot_stacked_phyla(taxonomy_table, taxonomy_headers, sample_labels, \
-  file_out, sample_ids=None):
-    """Creates a stacked taxonomy plot at the phylum level
-
-    INPUTS:
-        taxonomy_table -- a numpy array with sample information in the columns 
-                        and phylum frequency information in the rows
-
-        taxonomy_headers -- a  of the phyla which to the rows in the 
-                        taxonomy_table
-
-        sample_labels -- a list of the sample labels which correspond to the 
-                        rows in the taxonomy_table
+def import_pyplot():
+    """Imports pyplot with the Agg backend
 
-        file_out -- a string describing the filename for the output filename
+    matplotlib is only imported once a figure is drawn with it, so figures
+    drawn with the svg renderer do not need it.
 
     OUTPUT:
-        The rendered figure is saved as a pdf in the at the file_out location.
+        plt -- the matplotlib.pyplot module
     """
-    # Colormap is taken from the colorbrewer    
-    COLORMAP = array([[0.8353, 0.2421, 0.3098],
-                      [0.9569, 0.4275, 0.2627],
-                      [0.9922, 0.6824, 0.3804],
-                      [0.9961, 0.8784, 0.5351],
-                      [0.9020, 0.9608, 0.5961],
-                      [0.6706, 0.8667, 0.6431],
-                      [0.4000, 0.7608, 0.6471],
-                      [0.1961, 0.5333, 0.7412],
-                      [0.3333, 0.3333, 0.3333]])
-    X_TICK_OFFSET = 0.6
+    if 'matplotlib.pyplot' not in modules:
+        from matplotlib import use
+        use('agg')
+    import matplotlib.pyplot as plt
 
-    BAR_WIDTH = 0.8
+    return plt
 
-    AXIS_DIMENSIONS = Bbox(array([[0.1538, 0.4000],
-                                  [0.6923, 0.9000]]))
+def build_phyla_figure(no_phyla, no_samples, taxonomy_headers):
+    """Draws the parts of a stacked taxonomy plot which are the same for
+    every sample
 
-    X_MIN = -0.5
-    X_TICK_INTERVAL = 1.0
+    INPUTS:
+        no_phyla -- the number of phyla stacked in each bar
 
-    Y_MIN = 0
-    Y_MAX = 1.0
-    Y_TICK_INTERVAL = 0.2
+        no_samples -- the number of bars in the plot
 
-    TICK_FONT_SIZE = 15
-    LABEL_FONT_SIZE = 20
+        taxonomy_headers -- a list of the phyla shown in the legend
 
-    [no_phyla, no_samples] = taxonomy_table.shape
+    OUTPUT:
+        renderer -- a dictionary holding the figure ("FIGURE"), the axes
+                    ("AXES") and the bars for each phylum ("BARS"), which
+                    are updated for each sample by update_phyla_figure.
+    """
+    from matplotlib.transforms import Bbox
+    plt = import_pyplot()
 
     x_tick = arange(0,no_samples)
     x_max = X_MIN+no_samples
 
-    sample_figure = plt.figure(1, (8,5))
+    sample_figure = plt.figure(figsize = FIGURE_SIZE)
+    ax1 = sample_figure.add_subplot(111)
 
+    bars = []
     patches_watch = []
 
-    # Plots the data
-    for plot_count, phyla in enumerate(taxonomy_table):
-        already_added_index = arange(plot_count)
-        bottom_bar = sum(taxonomy_table[already_added_index,:])
-        faces = plt.bar(x_tick-BAR_WIDTH/2, phyla, BAR_WIDTH, \
-                        bottom = bottom_bar, color = COLORMAP[plot_count,:])
+    # Draws empty bars, which are resized for each sample
+    for plot_count in xrange(no_phyla):
+        faces = ax1.bar(x_tick-BAR_WIDTH/2, zeros(no_samples), BAR_WIDTH, \
+                        color = COLORMAP[plot_count,:])
+        bars.append(faces)
         patches_watch.append(faces[1])
 
     # Sets up axis dimensiosn and limits
-    ax1 = plt.gca()
-    ax1.set_position(AXIS_DIMENSIONS)
-    
+    ax1.set_position(Bbox(AXIS_DIMENSIONS))
+
     # The y-direction is reversed so the labels are in the same order as the 
     # colors in the legend
-    plt.axis([X_MIN, x_max, Y_MAX, Y_MIN])
+    ax1.axis([X_MIN, x_max, Y_MAX, Y_MIN])
 
     # Sets y axis labels
     y_tick_labels = (arange(Y_MAX + Y_TICK_INTERVAL, Y_MIN, \
@@ -324,20 +364,265 @@ def plot_stacked_phyla(taxonomy_table, taxonomy_headers, sample_labels, \
     # Converts y label to text
     y_text_labels = [str(e) for e in y_tick_labels]
 
-    y_tick_labels = ax1.set_yticklabels(y_text_labels, size = TICK_FONT_SIZE)
-    y_axis_label = ax1.set_ylabel('Frequency (%)', size = LABEL_FONT_SIZE)
+    ax1.set_yticklabels(y_text_labels, size = TICK_FONT_SIZE)
+    ax1.set_ylabel('Frequency (%)', size = LABEL_FONT_SIZE)
+
+    # Adds the legend
+    sample_figure.legend(patches_watch, taxonomy_headers, 'right')
+
+    return {'FIGURE': sample_figure,
+            'AXES': ax1,
+            'BARS': bars}
+
+def get_phyla_figure(no_phyla, no_samples, taxonomy_headers):
+    """Returns the figure for the plot layout, building it the first time
+    the layout is used
+
+    The figure for the last layout is kept between calls, so a run which
+    plots the same layout for every sample only draws the figure once.
+
+    INPUTS:
+        no_phyla, no_samples, taxonomy_headers -- the plot layout, as
+                    described for build_phyla_figure
+
+    OUTPUT:
+        renderer -- the figure, as returned by build_phyla_figure
+    """
+    layout = (no_phyla, no_samples, tuple(taxonomy_headers))
+
+    if PHYLA_FIGURE.get('LAYOUT') != layout:
+        if 'RENDERER' in PHYLA_FIGURE:
+            import_pyplot().close(PHYLA_FIGURE['RENDERER']['FIGURE'])
+        PHYLA_FIGURE['RENDERER'] = build_phyla_figure(no_phyla, no_samples, \
+            taxonomy_headers)
+        PHYLA_FIGURE['LAYOUT'] = layout
+
+    return PHYLA_FIGURE['RENDERER']
+
+def stacked_bar_bottoms(taxonomy_table):
+    """Finds where each phylum starts in the stacked bars
+
+    INPUT:
+        taxonomy_table -- a numpy array with sample information in the columns 
+                        and phylum frequency information in the rows, or a
+                        three dimensional array stacking the tables for a
+                        batch of figures along the first axis
+
+    OUTPUT:
+        bottoms -- a numpy array the same shape as the taxonomy_table, giving
+                    the sum of the phyla above each row
+    """
+    bottoms = zeros(taxonomy_table.shape)
+    bottoms[..., 1:, :] = cumsum(taxonomy_table[..., :-1, :], axis = -2)
+
+    return bottoms
+
+def update_phyla_figure(renderer, taxonomy_table, bottoms, sample_labels):
+    """Sets the bars and sample labels of a figure to a new sample
+
+    INPUTS:
+        renderer -- the figure, as returned by build_phyla_figure
+
+        taxonomy_table -- a numpy array with sample information in the columns 
+                        and phylum frequency information in the rows
+
+        bottoms -- the start of each bar, as returned by stacked_bar_bottoms
+
+        sample_labels -- a list of the sample labels which correspond to the 
+                        columns in the taxonomy_table
+    """
+    # Resizes the bars
+    for plot_count, phyla in enumerate(taxonomy_table):
+        for face, height, bottom in \
+            zip(renderer['BARS'][plot_count], phyla, bottoms[plot_count]):
+            face.set_height(height)
+            face.set_y(bottom)
 
     # Sets up the x-axis labels
     x_text_labels = sample_labels[:] # copy
     x_text_labels.insert(0, '') # insert at the head of the list
     
-    x_tick_labels = ax1.set_xticklabels(x_text_labels, size = TICK_FONT_SIZE,\
+    renderer['AXES'].set_xticklabels(x_text_labels, size = TICK_FONT_SIZE,\
         rotation = 45, horizontalalignment = 'right')
 
-    # Adds the legend
-    plt.figlegend(patches_watch, taxonomy_headers, 'right')
+def plot_stacked_phyla(taxonomy_table, taxonomy_headers, sample_labels, \
+  file_out, sample_ids=None, bottoms=None, file_format='pdf', dpi=None):
+    """Creates a stacked taxonomy plot at the phylum level
 
-    plt.savefig(file_out, format = 'pdf')
+    INPUTS:
+        taxonomy_table -- a numpy array with sample information in the columns 
+                        and phylum frequency information in the rows
+
+        taxonomy_headers -- a  of the phyla which to the rows in the 
+                        taxonomy_table
+
+        sample_labels -- a list of the sample labels which correspond to the 
+                        rows in the taxonomy_table
+
+        file_out -- a string describing the filename for the output filename,
+                        or an open multi-page pdf (PdfPages) the figure is
+                        added to
+
+        bottoms -- the start of each bar, as returned by stacked_bar_bottoms.
+                        If no value is passed, it is calculated from the
+                        taxonomy_table.
+
+        file_format -- the format the figure is saved in; one of
+                        PLOT_FORMATS
+
+        dpi -- the resolution of a png figure. If no value is passed, the
+                        matplotlib default is used.
+
+    OUTPUT:
+        The rendered figure is saved as a pdf in the at the file_out location.
+    """
+    [no_phyla, no_samples] = taxonomy_table.shape
+
+    if bottoms is None:
+        bottoms = stacked_bar_bottoms(taxonomy_table)
+
+    renderer = get_phyla_figure(no_phyla, no_samples, taxonomy_headers)
+    update_phyla_figure(renderer, taxonomy_table, bottoms, sample_labels)
+
+    with profile_stage('savefig'):
+        renderer['FIGURE'].savefig(file_out, format = file_format, dpi = dpi)
+
+def svg_text(label):
+    """Escapes a label for the text of an svg element
+
+    INPUTS:
+        label -- a unicode string, a utf-8 encoded string or any object
+                    which can be converted to unicode
+
+    OUTPUT:
+        text -- a unicode string with the xml special characters escaped
+    """
+    if isinstance(label, unicode):
+        text = label
+    elif isinstance(label, str):
+        text = label.decode('utf-8')
+    else:
+        text = unicode(label)
+
+    return escape(text)
+
+def render_svg_phyla(taxonomy_table, taxonomy_headers, sample_labels, \
+    bottoms = None):
+    """Draws a stacked taxonomy plot as svg without matplotlib
+
+    The figure has the same size, axes, colors and legend as the figure
+    drawn by plot_stacked_phyla.
+
+    INPUTS:
+        taxonomy_table, taxonomy_headers, sample_labels, bottoms -- the
+                    plotting data, as described for plot_stacked_phyla
+
+    OUTPUT:
+        svg -- a unicode string with the svg document
+    """
+    # Sets constants
+    POINTS_PER_INCH = 72
+    TICK_LENGTH = 4
+    LEGEND_FONT_SIZE = 12
+    LEGEND_SPACING = 1.5
+    FONT = 'font-family="Bitstream Vera Sans, DejaVu Sans, sans-serif"'
+
+    [no_phyla, no_samples] = taxonomy_table.shape
+
+    if bottoms is None:
+        bottoms = stacked_bar_bottoms(taxonomy_table)
+
+    # Finds the figure and axes corners in points from the top left
+    width = FIGURE_SIZE[0]*POINTS_PER_INCH
+    height = FIGURE_SIZE[1]*POINTS_PER_INCH
+    left = AXIS_DIMENSIONS[0, 0]*width
+    right = AXIS_DIMENSIONS[1, 0]*width
+    top = (1 - AXIS_DIMENSIONS[1, 1])*height
+    bottom = (1 - AXIS_DIMENSIONS[0, 1])*height
+
+    # The y-direction is reversed, as in plot_stacked_phyla
+    x_max = X_MIN+no_samples
+    x_scale = (right - left)/(x_max - X_MIN)
+    y_scale = (bottom - top)/(Y_MAX - Y_MIN)
+
+    svg = ['<?xml version="1.0" encoding="utf-8"?>',
+           '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '\
+           'width="%.0fpt" height="%.0fpt" viewBox="0 0 %.0f %.0f">' \
+           % (width, height, width, height),
+           '<rect width="100%" height="100%" fill="#ffffff"/>']
+
+    # Draws the bars
+    colors = ['#%02x%02x%02x' % tuple(c) for c in \
+        (COLORMAP*255).round().astype(int)]
+    for plot_count, phyla in enumerate(taxonomy_table):
+        for bar, (bar_height, bar_bottom) in \
+            enumerate(zip(phyla, bottoms[plot_count])):
+            svg.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" '\
+                'fill="%s"/>' % (left + (bar - BAR_WIDTH/2 - X_MIN)*x_scale, \
+                top + (bar_bottom - Y_MIN)*y_scale, BAR_WIDTH*x_scale, \
+                bar_height*y_scale, colors[plot_count]))
+
+    # Draws the axes and y tick labels
+    svg.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" '\
+        'fill="none" stroke="#000000"/>' % (left, top, right - left, \
+        bottom - top))
+    for y_tick in arange(Y_MIN, Y_MAX + Y_TICK_INTERVAL/2, Y_TICK_INTERVAL):
+        y_pos = top + (y_tick - Y_MIN)*y_scale
+        svg.append('<line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f" '\
+            'stroke="#000000"/>' % (left - TICK_LENGTH, y_pos, left, y_pos))
+        svg.append('<text x="%.2f" y="%.2f" dy="0.35em" font-size="%i" '\
+            'text-anchor="end" %s>%g</text>' % (left - 2*TICK_LENGTH, \
+            y_pos, TICK_FONT_SIZE, FONT, round((Y_MAX - y_tick)*100)))
+    svg.append('<text transform="translate(%.2f,%.2f) rotate(-90)" '\
+        'font-size="%i" text-anchor="middle" %s>Frequency (%%)</text>' \
+        % (left - 3*TICK_FONT_SIZE, (top + bottom)/2, LABEL_FONT_SIZE, FONT))
+
+    # Draws the sample labels under the bars
+    for bar, label in enumerate(sample_labels):
+        x_pos = left + (bar - X_MIN)*x_scale
+        svg.append('<line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f" '\
+            'stroke="#000000"/>' % (x_pos, bottom, x_pos, \
+            bottom + TICK_LENGTH))
+        svg.append('<text transform="translate(%.2f,%.2f) rotate(-45)" '\
+            'dy="0.7em" font-size="%i" text-anchor="end" %s>%s</text>' \
+            % (x_pos, bottom + 2*TICK_LENGTH, TICK_FONT_SIZE, FONT, \
+            svg_text(label)))
+
+    # Adds the legend at the right of the figure
+    row_height = LEGEND_SPACING*LEGEND_FONT_SIZE
+    legend_top = (height - row_height*len(taxonomy_headers))/2
+    legend_left = right + 2*TICK_FONT_SIZE
+    for plot_count, header in enumerate(taxonomy_headers):
+        y_pos = legend_top + plot_count*row_height
+        svg.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" '\
+            'fill="%s"/>' % (legend_left, y_pos + row_height/6, \
+            2*LEGEND_FONT_SIZE, 2*row_height/3, colors[plot_count]))
+        svg.append('<text x="%.2f" y="%.2f" dy="0.35em" font-size="%i" %s>'\
+            '%s</text>' % (legend_left + 2.5*LEGEND_FONT_SIZE, \
+            y_pos + row_height/2, LEGEND_FONT_SIZE, FONT, \
+            svg_text(header)))
+
+    svg.append('</svg>')
+
+    return '\n'.join(svg) + '\n'
+
+def plot_svg_phyla(taxonomy_table, taxonomy_headers, sample_labels, \
+    file_out, bottoms = None):
+    """Saves a stacked taxonomy plot drawn by render_svg_phyla
+
+    INPUTS:
+        taxonomy_table, taxonomy_headers, sample_labels, bottoms -- the
+                    plotting data, as described for plot_stacked_phyla
+
+        file_out -- a string describing the filename for the output filename
+    """
+    svg = render_svg_phyla(taxonomy_table, taxonomy_headers, sample_labels, \
+        bottoms)
+
+    with profile_stage('savefig'):
+        svg_file = open(file_out, 'wb')
+        svg_file.write(svg.encode('utf-8'))
+        svg_file.close()
 
 def load_category_files(category_files,level):
     """
@@ -362,9 +647,11 @@ def load_category_files(category_files,level):
             print '%s is not in the filepath.' % category_file
             watch_count = watch_count + 1
         else:
-            cat_table = parse_biom_table(open(category_file))
-            (common_taxa, cat_ids, cat_summary)  = \
-              summarize_human_taxa(cat_table,level)
+            with profile_stage('parse_biom_table'):
+                cat_table = parse_biom_table(open(category_file))
+            with profile_stage('summarize_human_taxa'):
+                (common_taxa, cat_ids, cat_summary)  = \
+                  summarize_human_taxa(cat_table,level)
             category_tables[category] = {'Groups': cat_ids, \
                                          'Taxa Summary': cat_summary}
 
@@ -373,8 +660,381 @@ def load_category_files(category_files,level):
 
     return category_tables
 
+def phyla_plot_tasks(sample_ids, map_dict, categories, whole_summary, \
+    mp_sample_taxa):
+    """Collects the plotting data for each sample
+
+    INPUTS:
+        sample_ids -- a list of the sample ids to plot
+
+        map_dict -- the mapping data, as returned by map_to_2D_dict
+
+        categories -- the summarized tables for each mapping category, as
+                    returned by load_category_files
+
+        whole_summary -- a numpy array with the phylum frequencies (rows) for
+                    each sample (column) in the OTU table
+
+        mp_sample_taxa -- the phylum frequencies for the Michael Pollan
+                    sample
+
+    OUTPUT:
+        Yields a tuple of the plotting array, the bar labels and the sample
+        id for each sample.
+    """
+    for idx, sample_id in enumerate(sample_ids):       
+        sample_id = sample_id
+
+        # Preallocates a numpy array for the plotting data
+        tax_array = zeros((NUM_TAXA, NUM_CATS_TO_PLOT))        
+        meta_data = map_dict[sample_id] 
+        cat_list = []
+
+        cat_list.append('Your Fecal Sample')
+        cat_list.append('Average Fecal Samples')
+    
+        tax_array[:,0] = whole_summary[:,idx]
+        tax_array[:,1] = mean(whole_summary, 1)
+    
+        cat_watch = 2
+        # Identifies the appropriate metadata categories
+        for cat in categories:
+            # Pulls metadata for the sample and category
+            mapping_key = meta_data[cat]
+            # Pulls taxonomic summary and group descriptions for the category
+            tax_summary = categories[cat]['Taxa Summary']
+            group_descriptions = categories[cat]['Groups']
+            # Amends plotting tables
+            try:
+                mapping_col = group_descriptions.index(mapping_key)
+            except:
+                print group_descriptions
+                print mapping_key
+                print cat 
+                print categories
+                raise ValueError
+            tax_array[:,cat_watch] = tax_summary[:,mapping_col]
+            cat_watch = cat_watch + 1
+            if cat.upper() == 'BMI' or cat.upper() == 'CAT_BMI' or \
+                cat.upper() == 'BMI_CAT':
+                cat_list.append('People with similar BMI')
+            else:
+               cat_list.append(mapping_key)
+
+        tax_array[:,5] = mp_sample_taxa
+        cat_list.append('Michael Pollan')
+
+        yield tax_array, cat_list, sample_id
+
+def stack_plot_tasks(plot_tasks, batch_size = 64):
+    """Adds the bar bottoms to the plotting data, finding the bottoms for a
+    batch of samples at once
+
+    INPUTS:
+        plot_tasks -- an iterable of the plotting data for each sample, as
+                    yielded by phyla_plot_tasks
+
+        batch_size -- the number of samples in each batch
+
+    OUTPUT:
+        Yields a tuple of the plotting array, the bar bottoms, the bar labels
+        and the sample id for each sample.
+    """
+    batch = []
+    for plot_task in plot_tasks:
+        batch.append(plot_task)
+        if len(batch) < batch_size:
+            continue
+        for stacked_task in stack_plot_batch(batch):
+            yield stacked_task
+        batch = []
+
+    for stacked_task in stack_plot_batch(batch):
+        yield stacked_task
+
+def stack_plot_batch(batch):
+    """Finds the bar bottoms for a batch of samples
+
+    INPUT:
+        batch -- a list of the plotting data for each sample, as yielded by
+                    phyla_plot_tasks
+
+    OUTPUT:
+        stacked_tasks -- a list of the plotting data with the bar bottoms,
+                    as yielded by stack_plot_tasks
+    """
+    if len(batch) == 0:
+        return []
+
+    bottoms = stacked_bar_bottoms(array([task[0] for task in batch]))
+
+    return [(tax_array, bottoms[idx], cat_list, sample_id) for \
+        idx, (tax_array, cat_list, sample_id) in enumerate(batch)]
+
+def plot_output_settings(output_dir, file_format = None, dpi = None, \
+    pages_per_file = 0, renderer = 'matplotlib'):
+    """Describes how the figures are saved
+
+    INPUTS:
+        output_dir -- the location of the directory where output files should
+                    be saved, ending in a "/"
+
+        file_format -- the format the figures are saved in; one of
+                    PLOT_FORMATS. If no value is passed, figures drawn by the
+                    svg renderer are saved as svg files and all others as
+                    pdfs.
+
+        dpi -- the resolution of png figures. If no value is passed, the
+                    matplotlib default is used.
+
+        pages_per_file -- the number of figures saved as pages of each pdf.
+                    If this is 0, each figure is saved in its own file.
+
+        renderer -- the library used to draw the figures; one of
+                    PLOT_RENDERERS. The svg renderer only saves svg files.
+
+    OUTPUT:
+        plot_output -- a dictionary of the settings, with the keys
+                    "OUTPUT_DIR", "FORMAT", "DPI", "PAGES_PER_FILE" and
+                    "RENDERER"
+    """
+    if file_format is None and renderer == 'svg':
+        file_format = 'svg'
+    elif file_format is None:
+        file_format = 'pdf'
+
+    if file_format not in PLOT_FORMATS:
+        raise ValueError, "The figure format must be one of %s." \
+            % ', '.join(PLOT_FORMATS)
+
+    if pages_per_file < 0:
+        raise ValueError, "The number of pages per file cannot be negative."
+    elif pages_per_file > 0 and file_format != 'pdf':
+        raise ValueError, "Multi-page files can only be saved as pdfs."
+
+    if renderer not in PLOT_RENDERERS:
+        raise ValueError, "The renderer must be one of %s." \
+            % ', '.join(PLOT_RENDERERS)
+    elif renderer == 'svg' and file_format != 'svg':
+        raise ValueError, "The svg renderer can only save svg files."
+
+    return {'OUTPUT_DIR': output_dir,
+            'FORMAT': file_format,
+            'DPI': dpi,
+            'PAGES_PER_FILE': pages_per_file,
+            'RENDERER': renderer}
+
+def group_plot_tasks(plot_tasks, plot_output):
+    """Groups the plotting data by the file the figures are saved in
+
+    INPUTS:
+        plot_tasks -- an iterable of the plotting data for each sample, as
+                    yielded by stack_plot_tasks
+
+        plot_output -- the output settings, as returned by
+                    plot_output_settings
+
+    OUTPUT:
+        Yields a tuple of the file name and a list of the plotting data for
+        the figures in the file. Multi-page pdfs are named
+        Figure_4_pages_<NUMBER>.pdf; other files are named
+        Figure_4_<SAMPLEID>.<FORMAT>.
+    """
+    pages_per_file = plot_output['PAGES_PER_FILE']
+
+    if pages_per_file == 0:
+        for plot_task in plot_tasks:
+            yield '%s%s.%s' % (FILEPREFIX, plot_task[3], \
+                plot_output['FORMAT']), [plot_task]
+        return
+
+    file_count = 0
+    pages = []
+    for plot_task in plot_tasks:
+        pages.append(plot_task)
+        if len(pages) < pages_per_file:
+            continue
+        file_count = file_count + 1
+        yield '%spages_%04i.pdf' % (FILEPREFIX, file_count), pages
+        pages = []
+
+    if len(pages) > 0:
+        file_count = file_count + 1
+        yield '%spages_%04i.pdf' % (FILEPREFIX, file_count), pages
+
+def plot_phyla_task(plot_task, taxonomy_headers, file_out, \
+    file_format = 'pdf', dpi = None, renderer = 'matplotlib'):
+    """Plots a single sample
+
+    INPUTS:
+        plot_task -- a tuple of the plotting array, bar bottoms, bar labels
+                    and sample id, as yielded by stack_plot_tasks
+
+        taxonomy_headers -- a list of the phyla in the plotting array rows
+
+        file_out, file_format, dpi -- where and how the figure is saved, as
+                    described for plot_stacked_phyla
+
+        renderer -- the library used to draw the figure; one of
+                    PLOT_RENDERERS
+    """
+    (tax_array, bottoms, cat_list, sample_id) = plot_task
+    sample_start = default_timer()
+
+    # Plots the data
+    if renderer == 'svg':
+        with profile_stage('plot_svg_phyla'):
+            plot_svg_phyla(tax_array, taxonomy_headers, cat_list, file_out, \
+                bottoms = bottoms)
+    else:
+        with profile_stage('plot_stacked_phyla'):
+            plot_stacked_phyla(tax_array, taxonomy_headers, cat_list, \
+                file_out, bottoms = bottoms, file_format = file_format, \
+                dpi = dpi)
+    record_sample_time(default_timer() - sample_start)
+
+def plot_phyla_group(plot_group, taxonomy_headers, plot_output):
+    """Plots the samples saved in a single file
+
+    INPUTS:
+        plot_group -- a tuple of the file name and plotting data, as yielded
+                    by group_plot_tasks
+
+        taxonomy_headers -- a list of the phyla in the plotting array rows
+
+        plot_output -- the output settings, as returned by
+                    plot_output_settings
+
+    OUTPUT:
+        index -- a list of (sample id, file name, page) tuples for the
+                    figures in the file. Pages are counted from 1.
+    """
+    (file_name, plot_tasks) = plot_group
+    file_fp = '%s%s' % (plot_output['OUTPUT_DIR'], file_name)
+
+    if plot_output['PAGES_PER_FILE'] > 0:
+        from matplotlib.backends.backend_pdf import PdfPages
+        file_out = PdfPages(file_fp)
+    else:
+        file_out = file_fp
+
+    index = []
+    for page, plot_task in enumerate(plot_tasks):
+        plot_phyla_task(plot_task, taxonomy_headers, file_out, \
+            plot_output['FORMAT'], plot_output['DPI'], plot_output['RENDERER'])
+        index.append((plot_task[3], file_name, page + 1))
+
+    # The fonts shared by the pages are written when the file is closed
+    if plot_output['PAGES_PER_FILE'] > 0:
+        with profile_stage('savefig'):
+            file_out.close()
+
+    return index
+
+def write_plot_index(index_fp, index):
+    """Saves the file and page holding the figure for each sample
+
+    INPUTS:
+        index_fp -- the location of the tab delimited index file
+
+        index -- a list of (sample id, file name, page) tuples, as returned
+                    by plot_phyla_group
+    """
+    index_file = open(index_fp, 'w')
+    index_file.write('#SampleID\tFile\tPage\n')
+    for (sample_id, file_name, page) in index:
+        index_file.write('%s\t%s\t%i\n' % (sample_id, file_name, page))
+    index_file.close()
+
+def init_plot_worker(taxonomy_headers, plot_output, no_phyla, no_samples):
+    """Sets up a plotting worker process with a figure ready to be updated
+
+    INPUTS:
+        taxonomy_headers -- a list of the phyla in the plotting array rows
+
+        plot_output -- the output settings, as returned by
+                    plot_output_settings
+
+        no_phyla, no_samples -- the shape of the plotting arrays
+    """
+    # Drops any profile measurements copied from the parent process, so only
+    # the worker's own are sent back
+    take_profile()
+
+    PLOT_WORKER['HEADERS'] = taxonomy_headers
+    PLOT_WORKER['OUTPUT'] = plot_output
+    if plot_output['RENDERER'] == 'matplotlib':
+        get_phyla_figure(no_phyla, no_samples, taxonomy_headers)
+
+def run_plot_worker(plot_group):
+    """Plots the samples saved in a single file in a worker process
+
+    INPUT:
+        plot_group -- the file name and plotting data, as yielded by
+                    group_plot_tasks
+
+    OUTPUTS:
+        index -- the pages in the file, as returned by plot_phyla_group
+
+        measurements -- the profile measurements for the file, as returned
+                    by take_profile
+    """
+    index = plot_phyla_group(plot_group, PLOT_WORKER['HEADERS'], \
+        PLOT_WORKER['OUTPUT'])
+
+    return index, take_profile()
+
+def plot_parallel_phyla(plot_groups, taxonomy_headers, plot_output, jobs):
+    """Plots the samples with a pool of processes
+
+    Only the plotting arrays and labels are sent to the workers; each worker
+    drawing with matplotlib keeps its own figure, as described for
+    get_phyla_figure.
+
+    INPUTS:
+        plot_groups -- an iterable of the plotting data for each file, as
+                    yielded by group_plot_tasks
+
+        taxonomy_headers -- a list of the phyla in the plotting array rows
+
+        plot_output -- the output settings, as returned by
+                    plot_output_settings
+
+        jobs -- the number of worker processes
+
+    OUTPUT:
+        index -- a list of (sample id, file name, page) tuples for every
+                    figure, in the order the samples were passed
+    """
+    # Sets constants
+    CHUNK_SIZE = 16
+
+    # Multi-page files hold many samples, so each is sent on its own
+    if plot_output['PAGES_PER_FILE'] > 0:
+        chunk_size = 1
+    else:
+        chunk_size = CHUNK_SIZE
+
+    index = []
+    pool = Pool(jobs, init_plot_worker, (taxonomy_headers, plot_output, \
+        NUM_TAXA, NUM_CATS_TO_PLOT))
+    try:
+        for (group_index, measurements) in pool.imap(run_plot_worker, \
+            plot_groups, chunk_size):
+            merge_profile(measurements)
+            index.extend(group_index)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return index
+
 def make_phyla_plots_AGP(otu_table, mapping_data, categories, output_dir, \
-    samples_to_plot = None):
+    samples_to_plot = None, jobs = 1, file_format = None, dpi = None, \
+    pages_per_file = 0, renderer = 'matplotlib'):
     """Creates stacked bar plots for an otu table
     INPUTS:
         otu_table -- an open OTU table
@@ -392,23 +1052,33 @@ def make_phyla_plots_AGP(otu_table, mapping_data, categories, output_dir, \
         samples_to_plot -- a list of sample ids to plot. If no value is passed, 
                     then all samples in the biom table are analyzed.
 
+        jobs -- the number of processes used to plot the samples. Each
+                    process keeps its own figure.
+
+        file_format, dpi, pages_per_file, renderer -- how the figures are
+                    drawn and saved, as described for plot_output_settings
+
     OUTPUTS:
         A pdf of stacked taxonomy will be generated for each sample and saved 
         in the output directory. These will follow the file name format 
-        Figure_4_<SAMPLEID>.pdf
+        Figure_4_<SAMPLEID>.pdf, or Figure_4_<SAMPLEID>.<FORMAT> for other
+        formats. When pages_per_file is set, the figures are saved as pages
+        of the files Figure_4_pages_<NUMBER>.pdf, and the file and page for
+        each sample are listed in Figure_4_index.txt.
     """
     # Sets constants
     LEVEL = 2
-    FILEPREFIX = 'Figure_4_'
     MICHAEL_POLLAN = '000007108.1075657'
-    NUM_TAXA = 9
-    NUM_CATS_TO_PLOT = 6
+
+    plot_output = plot_output_settings(output_dir, file_format, dpi, \
+        pages_per_file, renderer)
     
     # Loads the mapping file
     map_dict = map_to_2D_dict(mapping_data)
     
-    (common_taxa, whole_sample_ids, whole_summary) = \
-        summarize_human_taxa(otu_table, LEVEL)
+    with profile_stage('summarize_human_taxa'):
+        (common_taxa, whole_sample_ids, whole_summary) = \
+            summarize_human_taxa(otu_table, LEVEL)
 
     # Converts final taxa to a clean list
     common_phyla = []
@@ -426,54 +1096,22 @@ def make_phyla_plots_AGP(otu_table, mapping_data, categories, output_dir, \
     mp_sample_pos = whole_sample_ids.index(MICHAEL_POLLAN)
     mp_sample_taxa = whole_summary[:,mp_sample_pos]
 
-    # Loads the category dictionary
-    categories = load_category_files(category_fp, LEVEL)
-
     # Generates a figure for each sample
-    for idx, sample_id in enumerate(sample_ids):       
-        sample_id = sample_id
+    plot_tasks = stack_plot_tasks(phyla_plot_tasks(sample_ids, map_dict, \
+        categories, whole_summary, mp_sample_taxa))
+    plot_groups = group_plot_tasks(plot_tasks, plot_output)
 
-        # Preallocates a numpy array for the plotting data
-        tax_array = zeros((NUM_TAXA, NUM_CATS_TO_PLOT))        
-        meta_data = map_dict[sample_id] 
-        cat_list = []
-
-        cat_list.append('Your Fecal Sample')
-        cat_list.append('Average Fecal Samples')
-    
-        tax_array[:,0] = whole_summary[:,idx]
-        tax_array[:,1] = mean(whole_summary, 1)
-    
-        cat_watch = 2
-        # Identifies the appropriate metadata categories
-        for cat in categories:
-            # Pulls metadata for the sample and category
-            mapping_key = meta_data[cat]
-            # Pulls taxonomic summary and group descriptions for the category
-            tax_summary = categories[cat]['Taxa Summary']
-            group_descriptions = categories[cat]['Groups']
-            # Amends plotting tables
-            try:
-                mapping_col = group_descriptions.index(mapping_key)
-            except:
-                print group_descriptions
-                print mapping_key
-                print cat 
-                print categories
-                raise ValueError
-            tax_array[:,cat_watch] = tax_summary[:,mapping_col]
-            cat_watch = cat_watch + 1
-            if cat.upper() == 'BMI' or cat.upper() == 'CAT_BMI' or \
-                cat.upper() == 'BMI_CAT':
-                cat_list.append('People with similar BMI')
-            else:
-               cat_list.append(mapping_key)
+    if jobs > 1:
+        index = plot_parallel_phyla(plot_groups, common_taxa, plot_output, \
+            jobs)
+    else:
+        index = []
+        for plot_group in plot_groups:
+            index.extend(plot_phyla_group(plot_group, common_taxa, \
+                plot_output))
 
-        tax_array[:,5] = mp_sample_taxa
-        cat_list.append('Michael Pollan')
-        # Plots the data
-        filename = '%s%s%s.pdf' % (output_dir, FILEPREFIX, sample_id)
-        plot_stacked_phyla(tax_array, common_taxa, cat_list, filename)
+    if pages_per_file > 0:
+        write_plot_index('%s%sindex.txt' % (output_dir, FILEPREFIX), index)
 
 # Sets up the command line interface
 ## This uses argparse instead of optparse since optparse is being phased out 
@@ -495,6 +1133,29 @@ parser.add_argument('-c', '--categories', \
 parser.add_argument('-s', '--samples_to_plot', default = None, \
                     help = 'Sample IDs you wish to plot. If no value is '\
                     'specified, all samples are plotted.')
+parser.add_argument('-j', '--jobs', type = int, default = 1, \
+                    help = 'Number of processes used to plot the samples. '\
+                    '[default: %(default)s]')
+parser.add_argument('--format', default = None, choices = PLOT_FORMATS, \
+                    help = 'Format the figures are saved in. [default: svg '\
+                    'with the svg renderer, otherwise pdf]')
+parser.add_argument('--renderer', default = 'matplotlib', \
+                    choices = PLOT_RENDERERS, \
+                    help = 'Library used to draw the figures. The svg '\
+                    'renderer does not use matplotlib and only saves svg '\
+                    'files. [default: %(default)s]')
+parser.add_argument('--dpi', type = int, default = None, \
+                    help = 'Resolution of png figures. If no value is '\
+                    'specified, the matplotlib default is used.')
+parser.add_argument('--pages_per_file', type = int, default = 0, \
+                    help = 'Number of figures saved as pages of each pdf. '\
+                    'The file and page for each sample are listed in '\
+                    'Figure_4_index.txt. If no value is specified, each '\
+                    'figure is saved in its own file.')
+parser.add_argument('--profile', default = None, \
+                    help = 'Path to a JSON file where the wall time, calls '\
+                    'and peak memory of each stage and the per-sample '\
+                    'latencies are saved when the run finishes.')
 
 if __name__ == '__main__':
     # Sets the plotting level at phylum
@@ -502,13 +1163,17 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.profile:
+        start_profile(args.profile)
+
     # Checks the biom table is sane
     if not args.input:
         parser.error("An input BIOM table is required.")
     elif not isfile(args.input):
         raise ValueError, "The supplied biom table does not exist in the path."
     else:
-        otu_table = parse_biom_table(open(args.input, 'U'))     
+        with profile_stage('parse_biom_table'):
+            otu_table = parse_biom_table(open(args.input, 'U'))     
 
     # Checks the mapping file is sane
     if not args.mapping:
@@ -535,7 +1200,8 @@ if __name__ == '__main__':
         categories = {}     
     else:
         category_fp = dict([c.strip().split(':') for c in args.categories.split(',')])
-        categories = load_category_files(category_fp, LEVEL)
+        with profile_stage('load_category_files'):
+            categories = load_category_files(category_fp, LEVEL)
     
     # Deals with the sample list
     if args.samples_to_plot:
@@ -544,4 +1210,6 @@ if __name__ == '__main__':
         samples = None
 
     make_phyla_plots_AGP(otu_table, mapping, output_dir = output_dir, \
-        categories = categories, samples_to_plot = samples)
+        categories = categories, samples_to_plot = samples, jobs = args.jobs, \
+        file_format = args.format, dpi = args.dpi, \
+        pages_per_file = args.pages_per_file, renderer = args.renderer)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+from sys import platform
+from atexit import register
+from contextlib import contextmanager
+from json import dump as dump_json
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from timeit import default_timer
+from numpy import array, percentile
+
+__author__ = "Justine Debelius"
+__copyright__ = "Copyright 2013, The American Gut Project"
+__credits__ = ["Justine Debelius"]
+__license__ = "BSD"
+__version__ = "unversioned"
+__maintainer__ = "Justine Debelius"
+__email__ = "j.debelius@gmail.com"
+
+# Holds the measurements for the run. Nothing is recorded until start_profile
+# is called.
+PROFILE = {'ENABLED': False,
+           'OUTPUT_FP': None,
+           'START': None,
+           'STAGES': {},
+           'SAMPLE_TIMES': []}
+
+def start_profile(profile_fp):
+    """Starts recording stage timings, written as JSON when the program exits
+
+    INPUT:
+        profile_fp -- the location of the JSON profile report
+    """
+    if PROFILE['OUTPUT_FP'] is None:
+        register(write_profile)
+
+    PROFILE['ENABLED'] = True
+    PROFILE['OUTPUT_FP'] = profile_fp
+    PROFILE['START'] = default_timer()
+    PROFILE['STAGES'] = {}
+    PROFILE['SAMPLE_TIMES'] = []
+
+def peak_rss(who = RUSAGE_SELF):
+    """Finds the peak resident memory of the process or its children
+
+    INPUT:
+        who -- RUSAGE_SELF for this process or RUSAGE_CHILDREN for the
+                    largest of the child processes which have finished
+
+    OUTPUT:
+        The peak resident set size in kilobytes
+    """
+    max_rss = getrusage(who).ru_maxrss
+
+    # Mac OS reports bytes rather than kilobytes
+    if platform == 'darwin':
+        max_rss = max_rss / 1024
+
+    return max_rss
+
+def record_stage(stage, wall_time, calls = 1, peak_growth = 0, \
+    lifetime_peak = None):
+    """Adds the time spent in a stage to the profile
+
+    The peak resident memory reported by the system covers the lifetime of
+    the process, so it cannot be split between stages. Each stage keeps
+    the lifetime peak seen when one of its calls finished
+    ("LIFETIME_PEAK_RSS"), and the largest rise in that peak during a single
+    call ("PEAK_RSS_GROWTH"). A stage which did not set a new peak has a
+    growth of zero, whatever it allocated.
+
+    INPUTS:
+        stage -- the name of the stage
+
+        wall_time -- the wall time spent in the stage, in seconds
+
+        calls -- the number of calls the time covers
+
+        peak_growth -- the rise in the lifetime peak resident memory during
+                    the call, in kilobytes
+
+        lifetime_peak -- the lifetime peak resident memory at the end of
+                    the call, in kilobytes. By default, the current peak of
+                    this process is used.
+    """
+    if not PROFILE['ENABLED']:
+        return
+
+    stage_profile = PROFILE['STAGES'].get(stage)
+    if stage_profile is None:
+        stage_profile = {'CALLS': 0, 'WALL_TIME': 0.0, \
+                         'LIFETIME_PEAK_RSS': 0, 'PEAK_RSS_GROWTH': 0}
+        PROFILE['STAGES'][stage] = stage_profile
+
+    if lifetime_peak is None:
+        lifetime_peak = peak_rss()
+
+    stage_profile['CALLS'] = stage_profile['CALLS'] + calls
+    stage_profile['WALL_TIME'] = stage_profile['WALL_TIME'] + wall_time
+    stage_profile['LIFETIME_PEAK_RSS'] = \
+        max(stage_profile['LIFETIME_PEAK_RSS'], lifetime_peak)
+    stage_profile['PEAK_RSS_GROWTH'] = \
+        max(stage_profile['PEAK_RSS_GROWTH'], peak_growth)
+
+@contextmanager
+def profile_stage(stage):
+    """Times the enclosed block as a call to a stage
+
+    Stages may be nested; the time of an inner stage is also counted in the
+    stage enclosing it. When profiling is off, the block is only run.
+
+    INPUT:
+        stage -- the name of the stage
+    """
+    if not PROFILE['ENABLED']:
+        yield
+        return
+
+    start_peak = peak_rss()
+    start = default_timer()
+    try:
+        yield
+    finally:
+        record_stage(stage, default_timer() - start, \
+            peak_growth = peak_rss() - start_peak)
+
+def record_sample_time(wall_time):
+    """Adds the time taken to produce the output for a single sample
+
+    INPUT:
+        wall_time -- the wall time for the sample, in seconds
+    """
+    if PROFILE['ENABLED']:
+        PROFILE['SAMPLE_TIMES'].append(wall_time)
+
+def take_profile():
+    """Removes the measurements recorded so far, so they can be merged into
+    the profile of another process
+
+    OUTPUT:
+        measurements -- a dictionary of the stage ("STAGES") and sample
+                    ("SAMPLE_TIMES") measurements, or None if profiling is
+                    off.
+    """
+    if not PROFILE['ENABLED']:
+        return None
+
+    measurements = {'STAGES': PROFILE['STAGES'],
+                    'SAMPLE_TIMES': PROFILE['SAMPLE_TIMES']}
+    PROFILE['STAGES'] = {}
+    PROFILE['SAMPLE_TIMES'] = []
+
+    return measurements
+
+def merge_profile(measurements):
+    """Adds measurements taken in another process to the profile
+
+    INPUT:
+        measurements -- the measurements, as returned by take_profile
+    """
+    if not PROFILE['ENABLED'] or measurements is None:
+        return
+
+    for stage, stage_profile in measurements['STAGES'].iteritems():
+        record_stage(stage, stage_profile['WALL_TIME'], \
+            stage_profile['CALLS'], stage_profile['PEAK_RSS_GROWTH'], \
+            stage_profile['LIFETIME_PEAK_RSS'])
+
+    PROFILE['SAMPLE_TIMES'].extend(measurements['SAMPLE_TIMES'])
+
+def profile_report():
+    """Summarizes the profile
+
+    OUTPUT:
+        report -- a dictionary with the total wall time, the peak resident
+                    memory of the process and its children, the calls, wall
+                    time, lifetime peak memory and peak memory growth for
+                    each stage (see record_stage), and the count,
+                    mean and percentiles of the per-sample times. Times are
+                    in seconds and memory in kilobytes.
+    """
+    stages = {}
+    for stage, stage_profile in PROFILE['STAGES'].iteritems():
+        stages[stage] = {'calls': stage_profile['CALLS'],
+                         'wall_time': stage_profile['WALL_TIME'],
+                         'per_call': stage_profile['WALL_TIME'] / \
+                            stage_profile['CALLS'],
+                         'lifetime_peak_rss_kb': \
+                            stage_profile['LIFETIME_PEAK_RSS'],
+                         'peak_rss_growth_kb': \
+                            stage_profile['PEAK_RSS_GROWTH']}
+
+    sample_times = array(PROFILE['SAMPLE_TIMES'])
+    samples = {'count': len(sample_times)}
+    if len(sample_times) > 0:
+        samples['mean'] = float(sample_times.mean())
+        samples['max'] = float(sample_times.max())
+        for pct in (50, 90, 99):
+            samples['p%i' % pct] = float(percentile(sample_times, pct))
+
+    return {'wall_time': default_timer() - PROFILE['START'],
+            'peak_rss_kb': peak_rss(RUSAGE_SELF),
+            'peak_child_rss_kb': peak_rss(RUSAGE_CHILDREN),
+            'stages': stages,
+            'samples': samples}
+
+def write_profile():
+    """Saves the profile report as JSON at the location given to
+    start_profile
+    """
+    if not PROFILE['ENABLED']:
+        return
+
+    profile_file = open(PROFILE['OUTPUT_FP'], 'w')
+    dump_json(profile_report(), profile_file, indent = 2, sort_keys = True)
+    profile_file.close()
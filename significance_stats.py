@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+from numpy import (zeros, empty, arange, asarray, sqrt, absolute, newaxis,
+                   errstate, isnan, inf, nan, where, minimum, maximum,
+                   bincount)
+from scipy.stats import t as t_distribution
+from scipy.sparse import issparse
+
+__author__ = "Justine Debelius"
+__copyright__ = "Copyright 2013, The American Gut Project"
+__credits__ = ["Justine Debelius"]
+__license__ = "BSD"
+__version__ = "unversioned"
+__maintainer__ = "Justine Debelius"
+__email__ = "j.debelius@gmail.com"
+
+# Methods which can be used to correct for multiple comparisons.
+# "bonferroni_samples" is the bonferroni correction scaled by the number of
+# population samples, as in reports made before the correction was
+# selectable.
+CORRECTION_METHODS = ('bonferroni', 'holm', 'fdr_bh', 'bonferroni_samples')
+
+def summarize_population(table, block_size = None):
+    """Calculates the table-wide statistics used for leave-one-out comparisons
+
+    INPUT:
+        table -- a numpy array with the relative frequencies of taxonomies
+                    (rows) for each sample (column). This may be a memory
+                    mapped array or a scipy sparse matrix.
+
+        block_size -- the number of columns read from the table at a time.
+                    If no value is passed, the whole table is used at once.
+                    Sparse tables are always used at once.
+
+    OUTPUT:
+        population_summary -- a dictionary keyed to the number of samples
+                    ("NUM_SAMPLES"), and the per-taxon mean ("CENTER"), sum
+                    ("SUM"), sum of squared deviations from the mean
+                    ("SUM_SQ") and number of samples where the taxon is
+                    present ("COUNT").
+    """
+    if issparse(table):
+        return summarize_sparse_population(table)
+
+    (num_taxa, num_samples) = table.shape
+
+    if block_size is None:
+        block_size = max(num_samples, 1)
+
+    table_sum = zeros(num_taxa)
+    count = zeros(num_taxa, dtype = int)
+    for start in range(0, num_samples, block_size):
+        block = table[:, start:(start + block_size)]
+        table_sum += block.sum(1, dtype = 'float64')
+        count += (block > 0).sum(1)
+
+    # The sum of squares is taken around the table mean, so removing a single
+    # sample later does not lose precision to cancellation.
+    center = table_sum / num_samples
+    sum_sq = zeros(num_taxa)
+    for start in range(0, num_samples, block_size):
+        block = table[:, start:(start + block_size)]
+        sum_sq += ((block - center[:, newaxis])**2).sum(1)
+
+    return {'NUM_SAMPLES': num_samples, 'CENTER': center, 'SUM': table_sum,
+            'SUM_SQ': sum_sq, 'COUNT': count}
+
+def summarize_sparse_population(table):
+    """Calculates the table-wide statistics of a sparse table
+
+    The statistics are taken from the stored values, so the table is never
+    expanded to a dense array.
+
+    INPUT:
+        table -- a scipy sparse matrix with the relative frequencies of
+                    taxonomies (rows) for each sample (column)
+
+    OUTPUT:
+        population_summary -- a dictionary of table-wide statistics, as
+                    described for summarize_population
+    """
+    (num_taxa, num_samples) = table.shape
+    entries = table.tocoo()
+
+    table_sum = bincount(entries.row, weights = entries.data, \
+        minlength = num_taxa)
+    count = bincount(entries.row[entries.data > 0], minlength = num_taxa)
+    stored = bincount(entries.row, minlength = num_taxa)
+
+    # Each value which is not stored is a zero, which is the mean away from
+    # the mean
+    center = table_sum / num_samples
+    deviations = entries.data - center[entries.row]
+    sum_sq = bincount(entries.row, weights = deviations**2, \
+        minlength = num_taxa) + (num_samples - stored)*center**2
+
+    return {'NUM_SAMPLES': num_samples, 'CENTER': center, 'SUM': table_sum,
+            'SUM_SQ': sum_sq, 'COUNT': count}
+
+def dense_columns(table, columns = None):
+    """Pulls columns out of a table as a dense array
+
+    INPUTS:
+        table -- a numpy array, memory mapped array or scipy sparse matrix
+
+        columns -- a list of the table columns to pull out. If no value is
+                    passed, all columns are used.
+
+    OUTPUT:
+        sample -- a numpy array of the columns. A dense table with no columns
+                    passed is returned as it is.
+    """
+    if columns is not None:
+        table = table[:, columns]
+
+    if issparse(table):
+        table = table.toarray()
+
+    return table
+
+def leave_one_out_stats(sample, population_summary):
+    """Determines population statistics with a single sample removed
+
+    INPUTS:
+        sample -- a numpy vector containing the taxonomic frequency values
+                    for the sample being removed, or a two dimensional array
+                    where each column is a sample to be removed separately.
+                    The samples must be columns of the table used to build
+                    the summary.
+
+        population_summary -- a dictionary of table-wide statistics, as
+                    returned by summarize_population.
+
+    OUTPUTS:
+        population_mean -- the average frequency of each taxon in the
+                    remaining samples, with the same shape as sample
+
+        population_var -- the sample variance (n - 1) for each taxon in the
+                    remaining samples
+
+        population_count -- the number of remaining samples where each taxon
+                    is present
+
+        num_samples -- the number of samples in the remaining population
+    """
+    # Lines the per-taxon summary up with the sample rows
+    if sample.ndim > 1:
+        expand = (slice(None), newaxis)
+    else:
+        expand = slice(None)
+
+    num_samples = population_summary['NUM_SAMPLES'] - 1
+    center = population_summary['CENTER'][expand]
+
+    # Removes the sample from the sums
+    population_mean = (population_summary['SUM'][expand] - sample) / \
+        num_samples
+    population_count = population_summary['COUNT'][expand] - (sample > 0)
+
+    # Removes the sample from the sum of squares and moves the sum of squares
+    # from the table mean to the new population mean
+    population_ss = population_summary['SUM_SQ'][expand] - \
+        (sample - center)**2 - num_samples*(population_mean - center)**2
+
+    with errstate(divide = 'ignore', invalid = 'ignore'):
+        population_var = population_ss.clip(0) / (num_samples - 1)
+
+    # Taxa missing from the remaining population are exactly zero
+    absent = population_count == 0
+    population_mean[absent] = 0
+    population_var[absent] = 0
+
+    return population_mean, population_var, population_count, num_samples
+
+def reference_stats(sample, population_summary):
+    """Determines population statistics for samples outside the population
+
+    INPUTS:
+        sample -- a numpy vector containing the taxonomic frequency values
+                    for a sample, or a two dimensional array where each
+                    column is a sample. The samples are not part of the
+                    population.
+
+        population_summary -- a dictionary of population statistics, as
+                    returned by summarize_population.
+
+    OUTPUTS:
+        The population mean, variance, count and number of samples, as
+        described for leave_one_out_stats.
+    """
+    # Lines the per-taxon summary up with the sample rows
+    if sample.ndim > 1:
+        expand = (slice(None), newaxis)
+    else:
+        expand = slice(None)
+
+    num_samples = population_summary['NUM_SAMPLES']
+    fill = zeros(sample.shape)
+
+    population_mean = population_summary['CENTER'][expand] + fill
+    with errstate(divide = 'ignore', invalid = 'ignore'):
+        population_var = population_summary['SUM_SQ'][expand] / \
+            (num_samples - 1) + fill
+    population_count = population_summary['COUNT'][expand] + \
+        fill.astype(int)
+
+    return population_mean, population_var, population_count, num_samples
+
+def population_stats(sample, population_summary):
+    """Determines the population statistics each sample is compared against
+
+    INPUTS:
+        sample -- the samples, as described for leave_one_out_stats
+
+        population_summary -- a dictionary of population statistics, as
+                    returned by summarize_population. If the summary is
+                    marked as a reference ("REFERENCE" is true), the samples
+                    are compared to the whole population; otherwise each
+                    sample is removed from the population first.
+
+    OUTPUTS:
+        The population mean, variance, count and number of samples, as
+        described for leave_one_out_stats.
+    """
+    if population_summary.get('REFERENCE', False):
+        return reference_stats(sample, population_summary)
+    else:
+        return leave_one_out_stats(sample, population_summary)
+
+def ttest_1samp_stats(sample, population_mean, population_var, num_samples):
+    """Preforms a case 1 t-test from summarized population statistics
+
+    This matches scipy.stats.ttest_1samp(population, sample, 1) without
+    requiring the full population array.
+
+    INPUTS:
+        sample -- a numpy array containing the taxonomic frequency values
+                    for a single sample, or a two dimensional array with a
+                    sample in each column
+
+        population_mean -- the average population frequency, with the same
+                    shape as sample
+
+        population_var -- the population sample variance, with the same
+                    shape as sample
+
+        num_samples -- the number of samples in the population
+
+    OUTPUTS:
+        t_stat -- a numpy array of t statistics
+
+        p_stat -- a numpy array of two-tailed p values
+    """
+    with errstate(divide = 'ignore', invalid = 'ignore'):
+        t_stat = (population_mean - sample) / \
+            sqrt(population_var / num_samples)
+    p_stat = t_distribution.sf(absolute(t_stat), num_samples - 1)*2
+
+    return t_stat, p_stat
+
+def leave_one_out_ttest(table, population_summary = None, columns = None):
+    """Preforms a case 1 t-test of every sample against the rest of the table
+
+    INPUTS:
+        table -- a numpy array with the relative frequencies of taxonomies
+                    (rows) for each sample (column), or a scipy sparse matrix.
+                    Only the tested columns are made dense.
+
+        population_summary -- a dictionary of table-wide statistics, as
+                    returned by summarize_population. If no value is passed,
+                    it is calculated from the table.
+
+        columns -- a list of the table columns which should be tested. If no
+                    value is passed, all columns in the table are tested.
+
+    OUTPUTS:
+        t_stat -- a numpy array of t statistics with taxa as rows and the
+                    tested samples as columns
+
+        p_stat -- a numpy array of two-tailed p values, with the same shape
+                    as t_stat
+    """
+    if population_summary is None:
+        population_summary = summarize_population(table)
+
+    sample = dense_columns(table, columns)
+
+    (population_mean, population_var, population_count, num_samples) = \
+        leave_one_out_stats(sample, population_summary)
+
+    return ttest_1samp_stats(sample, population_mean, population_var, \
+        num_samples)
+
+def correct_pvalues(p_stat, method = 'bonferroni', num_tests = None):
+    """Corrects p values for multiple comparisons within each sample
+
+    INPUTS:
+        p_stat -- a numpy array of p values with taxa as rows and samples as
+                    columns, or a vector of p values for a single sample.
+                    Taxa with a p value of nan were not tested, and are left
+                    out of the correction.
+
+        method -- a string describing the correction: "bonferroni", "holm"
+                    (Holm-Bonferroni step down), "fdr_bh" (Benjamini-
+                    Hochberg false discovery rate) or "bonferroni_samples"
+                    (bonferroni, with num_tests set to the number of
+                    population samples by the caller).
+
+        num_tests -- the number of comparisons made in each sample. If no
+                    value is passed, the number of tested taxa in each sample
+                    is used.
+
+    OUTPUT:
+        p_corrected -- a numpy array of corrected p values with the same
+                    shape as p_stat. Corrected values are capped at 1.
+    """
+    if method not in CORRECTION_METHODS:
+        raise ValueError, "The correction method must be one of: %s." \
+            % ', '.join(CORRECTION_METHODS)
+
+    p_stat = asarray(p_stat, dtype = float)
+    single_sample = p_stat.ndim == 1
+    if single_sample:
+        p_stat = p_stat[:, newaxis]
+    (num_taxa, num_samples) = p_stat.shape
+
+    if num_tests is None:
+        num_tests = (~isnan(p_stat)).sum(0)
+    else:
+        num_tests = zeros(num_samples) + num_tests
+
+    if method in ('bonferroni', 'bonferroni_samples'):
+        p_corrected = p_stat*num_tests
+
+    else:
+        # Sorts the p values within each sample. Untested taxa sort last.
+        sample_pos = arange(num_samples)
+        p_order = p_stat.argsort(0)
+        p_sorted = p_stat[p_order, sample_pos]
+        rank = arange(num_taxa)[:, newaxis]
+
+        if method == 'holm':
+            p_sorted = maximum.accumulate((num_tests - rank)*p_sorted, 0)
+        else:
+            untested = isnan(p_sorted)
+            p_sorted = where(untested, inf, p_sorted*num_tests/(rank + 1.0))
+            p_sorted = minimum.accumulate(p_sorted[::-1], 0)[::-1]
+            p_sorted[untested] = nan
+
+        p_corrected = empty((num_taxa, num_samples))
+        p_corrected[p_order, sample_pos] = p_sorted
+
+    p_corrected = minimum(p_corrected, 1)
+
+    if single_sample:
+        p_corrected = p_corrected[:, 0]
+
+    return p_corrected
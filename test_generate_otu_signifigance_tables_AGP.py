@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+from numpy import array, delete, nonzero, argsort, random
+from numpy.testing import assert_allclose
+from scipy.sparse import csr_matrix
+from generate_otu_signifigance_tables_AGP import (calculate_tax_rank_1,
+    calculate_tax_rank_batch, tax_rank_from_batch, top_taxa_batch)
+from significance_stats import summarize_population
+
+__author__ = "Justine Debelius"
+__copyright__ = "Copyright 2013, The American Gut Project"
+__credits__ = ["Justine Debelius"]
+__license__ = "BSD"
+__version__ = "unversioned"
+__maintainer__ = "Justine Debelius"
+__email__ = "j.debelius@gmail.com"
+
+def random_taxa_table(seed, num_taxa = 60, num_samples = 80):
+    """Draws a relative frequency table where each taxon is found in a
+    random fraction of the samples, so there are unique, rare, enriched and
+    depleted taxa
+    """
+    generator = random.RandomState(seed)
+    prevalence = generator.uniform(0, 1, num_taxa)**2
+    tax_table = generator.gamma(0.5, 1, (num_taxa, num_samples))
+    tax_table[generator.uniform(size = tax_table.shape) > \
+        prevalence[:, None]] = 0
+    tax_table = tax_table / tax_table.sum(0).clip(1e-12)
+    taxa = array(['k__Bacteria; p__P%i; c__; o__; f__; g__' % idx for idx \
+        in range(num_taxa)])
+
+    return taxa, tax_table
+
+def assert_same_taxa(expected, observed):
+    """Checks two lists of taxa rows, as returned by calculate_tax_rank_1"""
+    assert [row[0] for row in expected] == [row[0] for row in observed]
+    if len(expected) > 0:
+        assert_allclose(array([row[1:] for row in expected], dtype = float), \
+            array([row[1:] for row in observed], dtype = float))
+
+def check_batch_matches_serial(taxa, tax_table, table):
+    tax_rank = calculate_tax_rank_batch(table, summarize_population(table))
+
+    for idx in range(tax_table.shape[1]):
+        (unique, rare, low, high) = calculate_tax_rank_1(tax_table[:, idx], \
+            delete(tax_table, idx, 1), taxa)
+        batch = tax_rank_from_batch(tax_rank, idx, taxa)
+
+        assert list(unique) == list(batch[0])
+        assert list(rare) == list(batch[1])
+        assert_same_taxa(low, batch[2])
+        assert_same_taxa(high, batch[3])
+
+def test_batch_matches_serial():
+    (taxa, tax_table) = random_taxa_table(0)
+    check_batch_matches_serial(taxa, tax_table, tax_table)
+
+def test_batch_matches_serial_sparse():
+    (taxa, tax_table) = random_taxa_table(1)
+    check_batch_matches_serial(taxa, tax_table, csr_matrix(tax_table))
+
+def test_batch_finds_taxa():
+    # Makes sure the comparisons above are not between empty lists
+    (taxa, tax_table) = random_taxa_table(0)
+    tax_rank = calculate_tax_rank_batch(tax_table)
+
+    for category in ('UNIQUE', 'RARE', 'HIGH', 'LOW'):
+        assert tax_rank[category].any()
+
+def test_top_taxa_batch():
+    # Each sample is checked against sorting all of its significant taxa,
+    # including samples with fewer than num_taxa significant taxa
+    NUM_TOP_TAXA = 5
+    (taxa, tax_table) = random_taxa_table(0)
+    tax_rank = calculate_tax_rank_batch(tax_table)
+    tax_rank['HIGH'][NUM_TOP_TAXA - 1:, 0] = False
+    tax_rank['HIGH'][:, 1] = False
+
+    for category in ('HIGH', 'LOW'):
+        top_rows = top_taxa_batch(tax_rank, NUM_TOP_TAXA, category)
+        assert top_rows.shape == (NUM_TOP_TAXA, tax_table.shape[1])
+
+        for idx in range(tax_table.shape[1]):
+            rows = nonzero(tax_rank[category][:, idx])[0]
+            rows = rows[argsort(tax_rank['P_VALUE'][rows, idx], \
+                kind = 'mergesort')][:NUM_TOP_TAXA]
+            found = top_rows[:, idx]
+
+            assert list(found[found >= 0]) == list(rows)
+            assert (found[len(rows):] == -1).all()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+from numpy import array, nan, isnan, random
+from numpy.testing import assert_allclose
+from significance_stats import CORRECTION_METHODS, correct_pvalues
+
+__author__ = "Justine Debelius"
+__copyright__ = "Copyright 2013, The American Gut Project"
+__credits__ = ["Justine Debelius"]
+__license__ = "BSD"
+__version__ = "unversioned"
+__maintainer__ = "Justine Debelius"
+__email__ = "j.debelius@gmail.com"
+
+def reference_correction(p_values, method, num_tests = None):
+    """Corrects the p values for a single sample one value at a time
+
+    INPUTS:
+        p_values -- a list of p values. Untested taxa are nan.
+
+        method -- "bonferroni", "holm" or "fdr_bh"
+
+        num_tests -- the number of comparisons, or None to count the tested
+                    taxa
+
+    OUTPUT:
+        corrected -- a list of corrected p values, capped at 1
+    """
+    tested = [idx for idx, p_value in enumerate(p_values) \
+        if not isnan(p_value)]
+    if num_tests is None:
+        num_tests = len(tested)
+    ordered = sorted(tested, key = lambda idx: p_values[idx])
+
+    corrected = [nan]*len(p_values)
+    if method == 'bonferroni':
+        for idx in tested:
+            corrected[idx] = min(p_values[idx]*num_tests, 1)
+
+    elif method == 'holm':
+        running_max = 0
+        for rank, idx in enumerate(ordered):
+            running_max = max(running_max, (num_tests - rank)*p_values[idx])
+            corrected[idx] = min(running_max, 1)
+
+    else:
+        running_min = 1
+        for rank in range(len(ordered) - 1, -1, -1):
+            idx = ordered[rank]
+            running_min = min(running_min, \
+                p_values[idx]*num_tests/(rank + 1.0))
+            corrected[idx] = running_min
+
+    return corrected
+
+def random_pvalues(seed, num_taxa = 40, num_samples = 6):
+    """Draws a table of p values with some untested taxa"""
+    generator = random.RandomState(seed)
+    p_stat = generator.uniform(size = (num_taxa, num_samples))**3
+    p_stat[generator.uniform(size = p_stat.shape) < 0.2] = nan
+
+    return p_stat
+
+def test_correct_pvalues_matches_reference():
+    for method in ('bonferroni', 'holm', 'fdr_bh'):
+        for seed in range(5):
+            p_stat = random_pvalues(seed)
+            p_corrected = correct_pvalues(p_stat, method)
+            for col in range(p_stat.shape[1]):
+                assert_allclose(p_corrected[:, col], reference_correction( \
+                    list(p_stat[:, col]), method))
+
+def test_correct_pvalues_number_of_tests():
+    p_stat = random_pvalues(0)
+    for method in ('bonferroni', 'holm', 'fdr_bh'):
+        p_corrected = correct_pvalues(p_stat, method, 100)
+        for col in range(p_stat.shape[1]):
+            assert_allclose(p_corrected[:, col], reference_correction( \
+                list(p_stat[:, col]), method, 100))
+
+    assert_allclose(correct_pvalues(p_stat, 'bonferroni_samples', 100), \
+        correct_pvalues(p_stat, 'bonferroni', 100))
+
+def test_correct_pvalues_single_sample():
+    p_stat = random_pvalues(1)
+    for method in CORRECTION_METHODS:
+        assert_allclose(correct_pvalues(p_stat[:, 2], method), \
+            correct_pvalues(p_stat, method)[:, 2])
+
+def test_correct_pvalues_ordering():
+    # Holm rejects every hypothesis rejected by bonferroni, and the false
+    # discovery rate rejects every hypothesis rejected by Holm
+    p_stat = random_pvalues(2, 200, 4)
+    bonferroni = correct_pvalues(p_stat, 'bonferroni') < 0.05
+    holm = correct_pvalues(p_stat, 'holm') < 0.05
+    fdr_bh = correct_pvalues(p_stat, 'fdr_bh') < 0.05
+
+    assert (holm | ~bonferroni).all()
+    assert (fdr_bh | ~holm).all()
+
+def test_correct_pvalues_method():
+    try:
+        correct_pvalues(array([0.01, 0.5]), 'sidak')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError, "An unknown method should raise a ValueError."